@@ -2,4 +2,5 @@
 
 tar -xzf python.tar.gz
 export PATH=miniconda2/bin:$PATH
+export NUMBA_NUM_THREADS=${OMP_NUM_THREADS:-8}
 python process_L57_06.py /mnt/gluster/megarcia/WLS_Landsat/$1 $2
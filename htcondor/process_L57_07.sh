@@ -2,4 +2,4 @@
 
 tar -xzf python.tar.gz
 export PATH=miniconda2/bin:$PATH
-python process_L57_07.py /mnt/gluster/megarcia/WLS_Landsat/$1
+python process_L57_07.py /mnt/gluster/megarcia/WLS_Landsat/$1 ${OMP_NUM_THREADS:-8}
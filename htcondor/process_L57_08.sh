@@ -2,4 +2,4 @@
 
 tar -xzf python.tar.gz
 export PATH=miniconda2/bin:$PATH
-python process_L57_08.py /mnt/gluster/megarcia/WLS_Landsat/$1 $2 $3 $4 $5 $6
+python process_L57_08.py /mnt/gluster/megarcia/WLS_Landsat/$1 $2 $3 $4 $5 $6 --max-memory 10GB --resume --workers ${OMP_NUM_THREADS:-8}
@@ -0,0 +1,5 @@
+#!/bin/bash
+
+tar -xzf python.tar.gz
+export PATH=miniconda2/bin:$PATH
+python process_L57_12.py /mnt/gluster/megarcia/WLS_Landsat/$1 $2 $3 $4 $5 --max-memory 10GB
@@ -41,9 +41,12 @@ main_dirs = ['htcondor', 'source', 'tools']
 #
 scripts = ['process_L57_01.py', 'process_L57_02.py', 'process_L57_03.py',
            'process_L57_04.py', 'process_L57_05.py', 'process_L57_06.py',
-           'process_L57_07.py', 'process_L57_08.py', 'process_L57_09.py']
+           'process_L57_07.py', 'process_L57_08.py', 'process_L57_09.py',
+           'process_L57_10.py', 'process_L57_11.py', 'process_L57_12.py',
+           'process_L57_13.py']
 #
-modules = ['Read_Header_Files.py', 'UTM_Geo_Convert.py']
+modules = ['Read_Header_Files.py', 'UTM_Geo_Convert.py', 'Scene_Stats.py',
+           'Stack_Stats.py', 'Chunk_Store.py', 'Footprint_Stack.py']
 #
 htcondor = ['process_L57_01.sh', 'process_L57_01.sub',
             'process_L57_02.sh', 'process_L57_02.sub',
@@ -54,12 +57,19 @@ htcondor = ['process_L57_01.sh', 'process_L57_01.sub',
             'process_L57_07.sh', 'process_L57_07.sub',
             'process_L57_08.sh', 'process_L57_08.sub',
             'process_L57_09.sh', 'process_L57_09.sub',
+            'process_L57_10.sh', 'process_L57_10.sub',
+            'process_L57_11.sh', 'process_L57_11.sub',
+            'process_L57_12.sh', 'process_L57_12.sub',
+            'process_L57_13.sh', 'process_L57_13.sub',
             'process_L57_dag.sub']
 #
-dependencies = ['os', 'sys', 'datetime', 'glob', 'numpy', 'pandas', 'h5py',
-                'matplotlib']
+dependencies = ['os', 'sys', 'datetime', 'glob', 'argparse', 'numpy', 'pandas',
+                'h5py', 'matplotlib']
 #
-tools = ['process_L57_00.sh']
+optional_dependencies = ['numba', 'mpi4py', 'xarray', 'dask']
+#
+tools = ['process_L57_00.sh', 'rechunk_cube.py', 'year_range_stats.py',
+         'convert_grids.py', 'extract_points.py']
 #
 add_dirs = ['images']
 #
@@ -191,6 +201,13 @@ except ImportError:
     message('- essential python dependency \'glob\' is not available')
     err += 1
 #
+try:
+    import argparse
+    message('- python dependency \'argparse\' is available')
+except ImportError:
+    message('- essential python dependency \'argparse\' is not available')
+    err += 1
+#
 try:
     import numpy
     message('- python dependency \'numpy\' is available')
@@ -228,6 +245,37 @@ if err > 0:
     sys.exit(1)
 message(' ')
 #
+message('checking for optional python package dependencies for this software')
+#
+try:
+    import numba
+    message('- python dependency \'numba\' is available')
+except ImportError:
+    message('- optional python dependency \'numba\' is not available')
+    message('-- process_L57_06.py will use its (slower) NumPy calculations')
+#
+try:
+    import mpi4py
+    message('- python dependency \'mpi4py\' is available')
+except ImportError:
+    message('- optional python dependency \'mpi4py\' is not available')
+    message('-- process_L57_08.py will run on a single node only')
+#
+try:
+    import xarray
+    message('- python dependency \'xarray\' is available')
+except ImportError:
+    message('- optional python dependency \'xarray\' is not available')
+    message('-- the Footprint_Stack module will not be usable')
+#
+try:
+    import dask
+    message('- python dependency \'dask\' is available')
+except ImportError:
+    message('- optional python dependency \'dask\' is not available')
+    message('-- the Footprint_Stack module will not be usable')
+message(' ')
+#
 message('creating top-level directories that will be used for process output')
 for dirname in add_dirs:
     os.system('mkdir %s' % dirname)
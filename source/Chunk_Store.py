@@ -0,0 +1,361 @@
+"""
+Python module 'Chunk_Store.py'
+by Matthew Garcia, PhD student
+Dept. of Forest and Wildlife Ecology
+University of Wisconsin - Madison
+matt.e.garcia@gmail.com
+
+Copyright (C) 2014-2016 by Matthew Garcia
+Licensed Gnu GPL v3; see 'LICENSE_GnuGPLv3.txt' for complete terms
+Send questions, bug reports, any related requests to matt.e.garcia@gmail.com
+See also 'README.md', 'DISCLAIMER.txt', 'ACKNOWLEDGEMENTS.txt'
+Treat others as you would be treated. Pay it forward. Valar dohaeris.
+
+PURPOSE: Chunk-per-file directory store for grids and datacubes, laid out
+         as a Zarr (v2) hierarchy: each group is a directory with a
+         '.zgroup' file, each dataset a directory with a '.zarray' (JSON)
+         description and one zlib-compressed file per chunk, named by its
+         chunk indices ('0.3.0'). Zarr and xarray can open these stores
+         directly, but only numpy and the standard library are needed here.
+         The open store and its datasets act like the parts of h5py.File
+         and h5py.Dataset that this package uses, so the same code can
+         write either one.
+
+DEPENDENCIES: numpy
+
+USAGE: insert 'from Chunk_Store import open_store' near head of script,
+       then (for example)
+        store = open_store('./P26R27/1984-2013_p026r027_ndii_grids.zarr',
+                           'w')
+        store.create_dataset('ndii_cube', (202, 1000, 1000),
+                             dtype=np.float32, chunks=(1, 64, 1000))
+        store['ndii_cube'][0, 0:64, :] = vals
+        store.close()
+
+NOTE: Every chunk is written to a temporary file that is then renamed over
+      the old one, so readers never see part of a chunk and processes that
+      write disjoint sets of whole chunks can share a store without any
+      locking. Writing part of a chunk reads it back first, so two writers
+      must never touch the same chunk at the same time.
+
+INPUT: grids provided by calling script
+
+OUTPUT: directory store on disk
+"""
+
+
+import os
+import json
+import shutil
+import zlib
+import numpy as np
+
+
+# zlib level for chunk files (about the same as h5py's gzip default)
+store_level = 4
+
+
+def open_store(path, mode='r'):
+    """
+    open a directory store like h5py.File: 'r' and 'r+' need an existing
+    store, 'w' replaces any store at path, 'a' opens or creates one
+    """
+    exists = os.path.isfile(os.path.join(path, '.zgroup'))
+    if mode in ['r', 'r+'] and not exists:
+        raise IOError('no directory store at %s' % path)
+    if mode == 'w' and os.path.exists(path):
+        shutil.rmtree(path)
+    if mode == 'w' or (mode == 'a' and not exists):
+        make_group(path)
+    return StoreGroup(path, mode == 'r')
+
+
+def make_group(path):
+    """ new (empty) group directory """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    write_json(os.path.join(path, '.zgroup'), {'zarr_format': 2})
+    return
+
+
+def write_json(file_path, contents):
+    """ replace a small JSON file in one step """
+    temp_path = '%s.%d.tmp' % (file_path, os.getpid())
+    with open(temp_path, 'w') as json_file:
+        json.dump(contents, json_file, indent=4, sort_keys=True)
+    os.rename(temp_path, file_path)
+    return
+
+
+def is_store(path):
+    """ True if path is a directory store (group) """
+    return os.path.isfile(os.path.join(path, '.zgroup'))
+
+
+class StoreGroup(object):
+    """ group (or whole store) directory, used like an h5py.Group """
+
+    def __init__(self, path, read_only=False):
+        self.path = path
+        self.read_only = read_only
+        self.filename = path
+
+    def _full_path(self, name):
+        return os.path.join(self.path, *name.strip('/').split('/'))
+
+    def __contains__(self, name):
+        full_path = self._full_path(name)
+        return os.path.isfile(os.path.join(full_path, '.zarray')) or \
+            os.path.isfile(os.path.join(full_path, '.zgroup'))
+
+    def __getitem__(self, name):
+        full_path = self._full_path(name)
+        if os.path.isfile(os.path.join(full_path, '.zarray')):
+            return StoreArray(full_path, self.read_only)
+        if os.path.isfile(os.path.join(full_path, '.zgroup')):
+            return StoreGroup(full_path, self.read_only)
+        raise KeyError('%s is not in %s' % (name, self.path))
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError('%s is not in %s' % (name, self.path))
+        shutil.rmtree(self._full_path(name))
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        """ names of the groups and datasets in this group """
+        return sorted([name for name in os.listdir(self.path)
+                       if name in self])
+
+    def create_group(self, name):
+        """ new group, making any parent groups that are missing """
+        self._make_parents(name)
+        make_group(self._full_path(name))
+        return self[name]
+
+    def _make_parents(self, name):
+        parts = name.strip('/').split('/')
+        for n in range(1, len(parts)):
+            parent = '/'.join(parts[:n])
+            if parent not in self:
+                make_group(self._full_path(parent))
+        return
+
+    def create_dataset(self, name, shape=None, dtype=None, data=None,
+                       chunks=None, maxshape=None, compression=None):
+        """
+        new dataset, as in h5py; every dataset is resizable and compressed,
+        so maxshape and compression are accepted but not needed, and a
+        dataset without chunks is one chunk
+        """
+        if self.read_only:
+            raise IOError('%s is open read-only' % self.path)
+        if name in self:
+            raise ValueError('%s is already in %s' % (name, self.path))
+        if data is not None:
+            data = np.asarray(data)
+            if data.dtype.kind == 'U':
+                data = np.char.encode(data, 'utf-8')
+            if dtype is not None:
+                data = data.astype(dtype)
+            shape = data.shape
+            dtype = data.dtype
+        shape = tuple([int(n) for n in shape])
+        dtype = np.dtype(dtype if dtype is not None else np.float32)
+        if chunks is None:
+            chunks = shape
+        chunks = tuple([max(int(n), 1) for n in chunks])
+        if dtype.kind == 'S':
+            fill_value = None
+        else:
+            fill_value = 0
+        self._make_parents(name)
+        full_path = self._full_path(name)
+        os.makedirs(full_path)
+        write_json(os.path.join(full_path, '.zarray'),
+                   {'zarr_format': 2, 'shape': list(shape),
+                    'chunks': list(chunks), 'dtype': dtype.str,
+                    'compressor': {'id': 'zlib', 'level': store_level},
+                    'fill_value': fill_value, 'order': 'C',
+                    'filters': None})
+        dataset = StoreArray(full_path)
+        if data is not None:
+            dataset[...] = data
+        return dataset
+
+    def flush(self):
+        """ nothing to do: every write goes straight to its chunk file """
+        return
+
+    def close(self):
+        """ nothing to do: no file handles are kept open """
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class StoreArray(object):
+    """ dataset directory, used like an h5py.Dataset """
+
+    def __init__(self, path, read_only=False):
+        self.path = path
+        self.read_only = read_only
+        with open(os.path.join(path, '.zarray'), 'r') as json_file:
+            self.meta = json.load(json_file)
+        self.shape = tuple(self.meta['shape'])
+        self.chunks = tuple(self.meta['chunks'])
+        self.dtype = np.dtype(str(self.meta['dtype']))
+        self.ndim = len(self.shape)
+        self.maxshape = (None,) * self.ndim
+        self.size = int(np.prod(self.shape))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __iter__(self):
+        for n in range(self.shape[0]):
+            yield self[n]
+
+    def __array__(self, dtype=None, copy=None):
+        vals = self[...]
+        if dtype is not None:
+            vals = vals.astype(dtype)
+        return np.asarray(vals)
+
+    def _chunk_path(self, cidx):
+        if self.ndim == 0:
+            return os.path.join(self.path, '0')
+        return os.path.join(self.path, '.'.join([str(c) for c in cidx]))
+
+    def _read_chunk(self, cidx):
+        chunk_path = self._chunk_path(cidx)
+        if not os.path.isfile(chunk_path):
+            return np.zeros(self.chunks, dtype=self.dtype)
+        with open(chunk_path, 'rb') as chunk_file:
+            raw = zlib.decompress(chunk_file.read())
+        return np.frombuffer(raw, dtype=self.dtype).reshape(self.chunks)
+
+    def _write_chunk(self, cidx, vals):
+        chunk_path = self._chunk_path(cidx)
+        temp_path = '%s.%d.tmp' % (chunk_path, os.getpid())
+        with open(temp_path, 'wb') as chunk_file:
+            chunk_file.write(zlib.compress(
+                np.ascontiguousarray(vals, dtype=self.dtype).tobytes(),
+                store_level))
+        os.rename(temp_path, chunk_path)
+        return
+
+    def _selection(self, key):
+        """ (start, stop) on each axis and the axes indexed by an integer """
+        if key is Ellipsis:
+            key = ()
+        elif not isinstance(key, tuple):
+            key = (key,)
+        if Ellipsis in key:
+            n = key.index(Ellipsis)
+            key = key[:n] + (slice(None),) * (self.ndim - len(key) + 1) + \
+                key[n + 1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        bounds = []
+        dropped = []
+        for axis, (k, n) in enumerate(zip(key, self.shape)):
+            if isinstance(k, slice):
+                start, stop, step = k.indices(n)
+                if step != 1:
+                    raise IndexError('only unit steps are supported')
+                bounds.append((start, max(start, stop)))
+            else:
+                k = int(k)
+                if k < 0:
+                    k += n
+                if not 0 <= k < n:
+                    raise IndexError('index %d is out of range' % k)
+                bounds.append((k, k + 1))
+                dropped.append(axis)
+        return bounds, dropped
+
+    def _chunk_ranges(self, bounds):
+        """ indices of the chunks on each axis that a selection touches """
+        return [range(b0 // c, (b1 + c - 1) // c) if b1 > b0 else range(0)
+                for (b0, b1), c in zip(bounds, self.chunks)]
+
+    def _each_chunk(self, bounds):
+        """
+        chunk indices, the region of the chunk and the region of the
+        selection for each chunk that a selection touches
+        """
+        cidxs = [()]
+        for crange in self._chunk_ranges(bounds):
+            cidxs = [cidx + (c,) for cidx in cidxs for c in crange]
+        for cidx in cidxs:
+            in_chunk = []
+            in_sel = []
+            for c, (b0, b1), n in zip(cidx, bounds, self.chunks):
+                c0 = max(b0, c * n)
+                c1 = min(b1, (c + 1) * n)
+                in_chunk.append(slice(c0 - c * n, c1 - c * n))
+                in_sel.append(slice(c0 - b0, c1 - b0))
+            yield cidx, tuple(in_chunk), tuple(in_sel)
+
+    def __getitem__(self, key):
+        bounds, dropped = self._selection(key)
+        vals = np.zeros([b1 - b0 for b0, b1 in bounds], dtype=self.dtype)
+        for cidx, in_chunk, in_sel in self._each_chunk(bounds):
+            vals[in_sel] = self._read_chunk(cidx)[in_chunk]
+        if len(dropped) > 0:
+            vals = vals.reshape([n for axis, n in enumerate(vals.shape)
+                                 if axis not in dropped])
+        if self.ndim == 0 or len(dropped) == self.ndim:
+            return vals[()]
+        return vals
+
+    def __setitem__(self, key, vals):
+        if self.read_only:
+            raise IOError('%s is open read-only' % self.path)
+        bounds, dropped = self._selection(key)
+        sel_shape = [b1 - b0 for b0, b1 in bounds]
+        vals = np.asarray(vals, dtype=self.dtype)
+        vals = np.broadcast_to(vals, [n for axis, n in enumerate(sel_shape)
+                                      if axis not in dropped])
+        vals = vals.reshape(sel_shape)
+        for cidx, in_chunk, in_sel in self._each_chunk(bounds):
+            whole = all([s.stop - s.start == n
+                         for s, n in zip(in_chunk, self.chunks)])
+            if whole:
+                chunk = vals[in_sel]
+            else:
+                chunk = np.array(self._read_chunk(cidx))
+                chunk[in_chunk] = vals[in_sel]
+            self._write_chunk(cidx, chunk)
+
+    def resize(self, size, axis=None):
+        """
+        new shape (or new size along one axis), as in h5py; chunks that
+        are no longer inside the dataset are removed
+        """
+        if axis is None:
+            shape = tuple([int(n) for n in size])
+        else:
+            shape = list(self.shape)
+            shape[axis] = int(size)
+            shape = tuple(shape)
+        for name in os.listdir(self.path):
+            if name.startswith('.') or name.endswith('.tmp'):
+                continue
+            cidx = [int(c) for c in name.split('.')]
+            if any([c * n >= m for c, n, m in zip(cidx, self.chunks,
+                                                   shape)]):
+                os.remove(os.path.join(self.path, name))
+        self.meta['shape'] = list(shape)
+        write_json(os.path.join(self.path, '.zarray'), self.meta)
+        self.shape = shape
+        self.size = int(np.prod(shape))
+        return
+
+# end Chunk_Store.py
@@ -0,0 +1,181 @@
+"""
+Python module 'Footprint_Stack.py'
+by Matthew Garcia, PhD student
+Dept. of Forest and Wildlife Ecology
+University of Wisconsin - Madison
+matt.e.garcia@gmail.com
+
+Copyright (C) 2014-2016 by Matthew Garcia
+Licensed Gnu GPL v3; see 'LICENSE_GnuGPLv3.txt' for complete terms
+Send questions, bug reports, any related requests to matt.e.garcia@gmail.com
+See also 'README.md', 'DISCLAIMER.txt', 'ACKNOWLEDGEMENTS.txt'
+Treat others as you would be treated. Pay it forward. Valar dohaeris.
+
+PURPOSE: Lazy (time, y, x) view of a footprint's *_clipped.h5 scene stack
+         as an xarray Dataset backed by dask arrays, for ad-hoc analysis
+         without a new stage script. Each scene's grids are wrapped where
+         they sit in its h5 file and read one chunk at a time only when a
+         computation needs them; 'time' comes from the scene file names and
+         'x'/'y' (UTM pixel centers) from 'meta/clip_bounds'.
+
+DEPENDENCIES: h5py, numpy, xarray, dask
+
+USAGE: insert 'from Footprint_Stack import *' near head of script, then
+       (for example)
+        stack = open_footprint('./P26R27', ['level3/ndvi', 'masks/scswumask'])
+        ndvi = stack['ndvi'].where(stack['scswumask'] == 1)
+        ndvi_q90 = ndvi.sel(time=slice('1990', '1999')).chunk(
+            {'time': -1}).quantile(0.9, dim='time').compute()
+        stack.close()
+
+NOTE: Variables are named for the last part of their dataset path
+      ('level3/ndvi' -> 'ndvi'), or 'forest_<type>' for 'masks/forest/*'.
+      Dask chunks are one scene deep and a whole number of the first
+      scene's h5 chunks across, about 100MB each (a full P26R27 grid is
+      about 180MB of float32), so a stack of a few hundred scenes has a few
+      hundred chunks per variable rather than one per h5 chunk; reductions
+      over 'time' should rechunk as above, or over pixel blocks with e.g.
+      chunks=(64, 64). All h5 reads share one lock, since h5py is not safe
+      to call from several threads at once; the files stay open until
+      stack.close(), with xarray before 0.17 (the last for Python 2.7 is
+      0.11) as well as after.
+
+INPUT: *_clipped.h5 files from process_L57_02.py through process_L57_07.py
+
+OUTPUT: xarray Dataset returned to calling script
+"""
+
+
+import glob
+import datetime
+import threading
+import h5py as hdf
+import numpy as np
+import xarray as xr
+import dask.array as da
+
+
+# default grids: every VI and the clear-sky/water/snow mask they were
+#   computed under
+default_names = ['level3/sr', 'level3/msi', 'level3/ndvi', 'level3/evi',
+                 'level3/savi', 'level3/rsr', 'level3/ndii', 'level3/nbr',
+                 'level3/kttc_bgt', 'level3/kttc_grn', 'level3/kttc_wet',
+                 'level3/tcb', 'level3/tcg', 'level3/tcw', 'level3/di',
+                 'masks/scswumask']
+
+
+# one lock for all h5 reads in the process
+h5_lock = threading.Lock()
+
+
+# default size of the dask chunks
+chunk_bytes = 100 << 20
+
+
+class SceneFiles(object):
+    """ the open h5 files behind a stack, closed together """
+
+    def __init__(self, h5files):
+        self.h5files = h5files
+
+    def close(self):
+        """ close every file """
+        for h5file in self.h5files:
+            h5file.close()
+        return
+
+
+def scene_date(scene_file):
+    """ acquisition date from a 'YYYYMMDD_DOY_...' scene file name """
+    return datetime.datetime.strptime(scene_file[:8], '%Y%m%d')
+
+
+def grid_coords(clipbounds):
+    """
+    UTM easting (x) and northing (y) of the pixel centers in a clipped grid
+    from its 'meta/clip_bounds' vector
+    """
+    # [W, N, E, S, Wcol, Nrow, Ecol, Srow, ncols_clip, nrows_clip]
+    W, N, E, S = clipbounds[0:4]
+    ncols = int(clipbounds[8])
+    nrows = int(clipbounds[9])
+    pixelsize = (E - W) / float(ncols)
+    x = W + (np.arange(ncols) + 0.5) * pixelsize
+    y = N - (np.arange(nrows) + 0.5) * pixelsize
+    return x, y
+
+
+def var_name(datapath):
+    """ Dataset variable name for an h5 dataset path """
+    parts = datapath.split('/')
+    if parts[0] == 'masks' and parts[1] == 'forest':
+        return 'forest_%s' % parts[-1]
+    return parts[-1]
+
+
+def layer_chunks(dataset, max_bytes=chunk_bytes):
+    """
+    (rows, cols) dask chunks for one scene's grid: whole multiples of its
+    h5 chunks (or of single rows, if it is not chunked), widened to full
+    rows first, of at most about max_bytes
+    """
+    nrows, ncols = dataset.shape
+    h5_chunks = dataset.chunks
+    if h5_chunks is None:
+        h5_chunks = (1, ncols)
+    chunk_nbytes = h5_chunks[0] * h5_chunks[1] * dataset.dtype.itemsize
+    nchunks = max(1, max_bytes // chunk_nbytes)
+    col_chunks = min(-(-ncols // h5_chunks[1]), nchunks)
+    row_chunks = max(1, nchunks // col_chunks)
+    return (min(h5_chunks[0] * row_chunks, nrows),
+            min(h5_chunks[1] * col_chunks, ncols))
+
+
+def open_footprint(path, names=None, chunks=None):
+    """
+    lazy (time, y, x) Dataset of the named grids in every *_clipped.h5 file
+    in path; chunks=(rows, cols) overrides the default (layer_chunks)
+    """
+    if names is None:
+        names = default_names
+    flist = sorted(glob.glob('%s/*_clipped.h5' % path))
+    if len(flist) == 0:
+        raise IOError('no *_clipped.h5 files in %s' % path)
+    h5files = [hdf.File(scene_path, 'r') for scene_path in flist]
+    first = h5files[0]
+    clipbounds = np.copy(first['meta/clip_bounds'])
+    x, y = grid_coords(clipbounds)
+    scene_files = [scene_path.split('/')[-1] for scene_path in flist]
+    times = np.array([scene_date(scene_file) for scene_file in scene_files],
+                     dtype='datetime64[ns]')
+    doys = [int(scene_file[9:12]) for scene_file in scene_files]
+    data_vars = {}
+    for datapath in names:
+        if chunks is None:
+            layer_shape = layer_chunks(first[datapath])
+        else:
+            layer_shape = chunks
+        layers = [da.from_array(h5file[datapath], chunks=layer_shape,
+                                lock=h5_lock, name='%s:%s' %
+                                (h5file.filename, datapath))
+                  for h5file in h5files]
+        data_vars[var_name(datapath)] = (('time', 'y', 'x'),
+                                         da.stack(layers, axis=0))
+    stack = xr.Dataset(data_vars, coords={'time': times, 'doy': ('time', doys),
+                                          'y': y, 'x': x})
+    stack.attrs['path'] = path
+    stack.attrs['clip_bounds'] = clipbounds
+    if 'meta/projection' in first:
+        # e.g. ['UTM', '15', 'North', 'WGS-84', 'Meters']
+        stack.attrs['projection'] = [str(item.decode('ascii'))
+                                     if isinstance(item, bytes) else str(item)
+                                     for item in first['meta/projection']]
+    open_files = SceneFiles(h5files)
+    if hasattr(stack, 'set_close'):
+        stack.set_close(open_files.close)
+    else:
+        # before xarray 0.17, Dataset.close() closes its _file_obj
+        stack._file_obj = open_files
+    return stack
+
+# end Footprint_Stack.py
@@ -0,0 +1,258 @@
+"""
+Python module 'Scene_Stats.py'
+by Matthew Garcia, PhD student
+Dept. of Forest and Wildlife Ecology
+University of Wisconsin - Madison
+matt.e.garcia@gmail.com
+
+Copyright (C) 2014-2016 by Matthew Garcia
+Licensed Gnu GPL v3; see 'LICENSE_GnuGPLv3.txt' for complete terms
+Send questions, bug reports, any related requests to matt.e.garcia@gmail.com
+See also 'README.md', 'DISCLAIMER.txt', 'ACKNOWLEDGEMENTS.txt'
+Treat others as you would be treated. Pay it forward. Valar dohaeris.
+
+PURPOSE: Single-pass summary statistics (count, minimum, maximum, mean, M2)
+         for scene grids, accumulated over row tiles and merged with the
+         parallel form of Welford's algorithm [Chan et al., 1979], so that
+         partial results from any set of tiles can be combined exactly.
+         Results are kept in the 'stats/' group of each *_clipped.h5 file
+         under the same path as the grid they describe, e.g.
+         'stats/level3/ndvi', so later stages and QA can use them without
+         reading any pixels.
+         Also fixed-bin histograms, accumulated the same way with
+         np.bincount and kept under 'stats/hist/', with Otsu and valley
+         threshold selection that works on the stored counts alone.
+
+DEPENDENCIES: numpy
+
+USAGE: insert 'from Scene_Stats import *' near head of script, then
+       (for example)
+        stats = scene_stats([('level1/b4_refl', b4_refl, scsmask),
+                             ('masks/scsmask', scsmask, None)])
+        npix = stats_total(stats['masks/scsmask'])
+        save_stats(h5file, stats)
+        counts = scene_hist(kttc_wet, scsmask, 500, -0.4, 0.1)
+        threshold = otsu_threshold(counts, -0.4, 0.1)
+
+INPUT: grids and masks provided by calling script
+
+OUTPUT: statistics returned to calling script and/or saved to hdf5 file
+"""
+
+
+import numpy as np
+
+
+# layout of each statistics vector
+stats_tags = ['count', 'minimum', 'maximum', 'mean', 'M2']
+
+
+# fixed histogram ranges for level3 grids (values outside a range are
+#   counted in its end bins)
+vi_hist_ranges = {'sr': [0.0, 30.0], 'msi': [0.0, 5.0], 'ndvi': [-1.0, 1.0],
+                  'evi': [-1.0, 2.5], 'savi': [-1.5, 1.5], 'rsr': [0.0, 30.0],
+                  'ndii': [-1.0, 1.0], 'nbr': [-1.0, 1.0],
+                  'kttc_bgt': [0.0, 1.5], 'kttc_grn': [-0.5, 1.0],
+                  'kttc_wet': [-0.6, 0.4], 'tcb': [-5.0, 5.0],
+                  'tcg': [-5.0, 5.0], 'tcw': [-5.0, 5.0], 'di': [-10.0, 10.0]}
+
+
+def stats_init():
+    """ empty statistics vector """
+    return np.array([0.0, np.inf, -np.inf, 0.0, 0.0])
+
+
+def tile_stats(vals):
+    """ statistics vector for a 1-D array of values """
+    stats = stats_init()
+    nvals = np.size(vals)
+    if nvals > 0:
+        mean = np.mean(vals, dtype=np.float64)
+        stats[0] = nvals
+        stats[1] = np.min(vals)
+        stats[2] = np.max(vals)
+        stats[3] = mean
+        stats[4] = np.sum((vals.astype(np.float64) - mean) ** 2)
+    return stats
+
+
+def stats_merge(stats_a, stats_b):
+    """ combine two statistics vectors (order does not matter) """
+    n_a = stats_a[0]
+    n_b = stats_b[0]
+    if n_b == 0:
+        return np.copy(stats_a)
+    if n_a == 0:
+        return np.copy(stats_b)
+    n = n_a + n_b
+    delta = stats_b[3] - stats_a[3]
+    stats = stats_init()
+    stats[0] = n
+    stats[1] = min(stats_a[1], stats_b[1])
+    stats[2] = max(stats_a[2], stats_b[2])
+    stats[3] = stats_a[3] + delta * n_b / n
+    stats[4] = stats_a[4] + stats_b[4] + delta ** 2 * n_a * n_b / n
+    return stats
+
+
+def scene_stats(grids, tile_rows=256):
+    """
+    accumulate statistics for each (name, grid, mask) tuple in one pass over
+    row tiles; only pixels with mask == 1 are included, or all pixels if
+    mask is None (so the total of a 0/1 mask grid is its allowed count)
+    """
+    stats = {}
+    for name, grid, mask in grids:
+        stats[name] = stats_init()
+    nrows = np.shape(grids[0][1])[0]
+    for r0 in range(0, nrows, tile_rows):
+        r1 = min(r0 + tile_rows, nrows)
+        for name, grid, mask in grids:
+            if mask is None:
+                vals = np.ravel(grid[r0:r1])
+            else:
+                vals = grid[r0:r1][mask[r0:r1] == 1]
+            stats[name] = stats_merge(stats[name], tile_stats(vals))
+    return stats
+
+
+def stats_total(stats):
+    """ sum of values described by a statistics vector """
+    return int(round(stats[0] * stats[3]))
+
+
+def stats_std(stats):
+    """ population standard deviation from a statistics vector """
+    if stats[0] == 0:
+        return 0.0
+    return np.sqrt(stats[4] / stats[0])
+
+
+def save_stats(h5file, stats):
+    """ store statistics vectors in the 'stats/' group of an open h5 file """
+    if 'stats' not in h5file.keys():
+        h5file.create_dataset('stats/stats_tags', data=stats_tags)
+    for name in sorted(stats.keys()):
+        datapath = 'stats/%s' % name
+        if datapath in h5file:
+            del h5file[datapath]
+        h5file.create_dataset(datapath, data=stats[name])
+    return
+
+
+def read_stats(h5file, name):
+    """
+    get a statistics vector from an open h5 file, or None if the stage that
+    produces it has not yet been (re)run
+    """
+    datapath = 'stats/%s' % name
+    if datapath not in h5file:
+        return None
+    return np.copy(h5file[datapath])
+
+
+def hist_edges(nbins, vmin, vmax):
+    """ bin edges of a fixed-bin histogram """
+    return np.linspace(vmin, vmax, nbins + 1)
+
+
+def hist_update(counts, vals, vmin, vmax):
+    """
+    add a 1-D array of values to fixed-bin histogram counts (in place);
+    values outside [vmin, vmax] are counted in the end bins
+    """
+    nbins = len(counts)
+    bins = np.floor((vals - vmin) * (nbins / float(vmax - vmin)))
+    bins = np.clip(bins, 0, nbins - 1).astype(np.int64)
+    counts += np.bincount(bins, minlength=nbins)
+    return counts
+
+
+def scene_hist(grid, mask, nbins, vmin, vmax, tile_rows=256):
+    """
+    accumulate a fixed-bin histogram of grid values where mask == 1 (or all
+    values if mask is None) in one pass over row tiles
+    """
+    counts = np.zeros(nbins, dtype=np.int64)
+    nrows = np.shape(grid)[0]
+    for r0 in range(0, nrows, tile_rows):
+        r1 = min(r0 + tile_rows, nrows)
+        if mask is None:
+            vals = np.ravel(grid[r0:r1])
+        else:
+            vals = grid[r0:r1][mask[r0:r1] == 1]
+        hist_update(counts, vals, vmin, vmax)
+    return counts
+
+
+def otsu_threshold(counts, vmin, vmax):
+    """
+    threshold (upper edge of the lower class) that maximizes the between-class
+    variance of a fixed-bin histogram [Otsu, 1979]; None if there is nothing
+    to separate
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    edges = hist_edges(len(counts), vmin, vmax)
+    centers = (edges[:-1] + edges[1:]) / 2.0
+    total = counts.sum()
+    if total == 0:
+        return None
+    w0 = np.cumsum(counts)[:-1]
+    w1 = total - w0
+    s0 = np.cumsum(counts * centers)[:-1]
+    s1 = np.sum(counts * centers) - s0
+    valid = (w0 > 0) & (w1 > 0)
+    if not valid.any():
+        return None
+    mu0 = np.where(valid, s0 / np.where(w0 > 0, w0, 1), 0.0)
+    mu1 = np.where(valid, s1 / np.where(w1 > 0, w1, 1), 0.0)
+    between = np.where(valid, w0 * w1 * (mu0 - mu1) ** 2, -1.0)
+    return float(edges[np.argmax(between) + 1])
+
+
+def valley_threshold(counts, vmin, vmax, max_iter=10000):
+    """
+    threshold at the lowest bin between the two modes of a fixed-bin
+    histogram, smoothing it (3-bin running mean) until only two local maxima
+    remain [Prewitt and Mendelsohn, 1966]; None if it never becomes bimodal
+    """
+    smoothed = np.asarray(counts, dtype=np.float64)
+    edges = hist_edges(len(smoothed), vmin, vmax)
+    for _ in range(max_iter):
+        interior = smoothed[1:-1]
+        peaks = np.where((interior > smoothed[:-2]) &
+                         (interior >= smoothed[2:]))[0] + 1
+        if len(peaks) <= 2:
+            break
+        padded = np.concatenate(([smoothed[0]], smoothed, [smoothed[-1]]))
+        smoothed = (padded[:-2] + padded[1:-1] + padded[2:]) / 3.0
+    if len(peaks) != 2:
+        return None
+    valley = peaks[0] + np.argmin(smoothed[peaks[0]:peaks[1] + 1])
+    return float((edges[valley] + edges[valley + 1]) / 2.0)
+
+
+def save_hist(h5file, name, counts, vmin, vmax):
+    """ store histogram counts and range under 'stats/hist/' """
+    datapath = 'stats/hist/%s' % name
+    if datapath in h5file:
+        del h5file[datapath]
+    h5file.create_dataset('%s/counts' % datapath, data=counts,
+                          compression='gzip')
+    h5file.create_dataset('%s/range' % datapath, data=[vmin, vmax])
+    return
+
+
+def read_hist(h5file, name):
+    """
+    get histogram counts, vmin and vmax from an open h5 file, or None if the
+    histogram has not been stored
+    """
+    datapath = 'stats/hist/%s' % name
+    if datapath not in h5file:
+        return None
+    counts = np.copy(h5file['%s/counts' % datapath])
+    vmin, vmax = np.copy(h5file['%s/range' % datapath])
+    return counts, vmin, vmax
+
+# end Scene_Stats.py
@@ -0,0 +1,625 @@
+"""
+Python module 'Stack_Stats.py'
+by Matthew Garcia, PhD student
+Dept. of Forest and Wildlife Ecology
+University of Wisconsin - Madison
+matt.e.garcia@gmail.com
+
+Copyright (C) 2014-2016 by Matthew Garcia
+Licensed Gnu GPL v3; see 'LICENSE_GnuGPLv3.txt' for complete terms
+Send questions, bug reports, any related requests to matt.e.garcia@gmail.com
+See also 'README.md', 'DISCLAIMER.txt', 'ACKNOWLEDGEMENTS.txt'
+Treat others as you would be treated. Pay it forward. Valar dohaeris.
+
+PURPOSE: Per-pixel statistics over a footprint's stack of VI grids, for
+         process_L57_08.py and related scripts, either exactly from all the
+         values at once or approximately from compact per-pixel sketches
+         (fixed-bin histograms plus exact moments) that are updated one
+         scene at a time, so memory does not grow with the number of scenes;
+         also chunking and chunk cache settings for the VI cubes, and
+         helpers for sparse cubes that keep only the union mask pixels;
+         and per-pixel trends (OLS, Theil-Sen, Mann-Kendall) for blocks of
+         pixels, for process_L57_10.py, and harmonic seasonal model fits,
+         for process_L57_11.py, with the datacube reading and grid saving
+         those two share
+
+DEPENDENCIES: numpy
+
+USAGE: insert 'from Stack_Stats import *' near head of script, then
+       (for example)
+        nvals, qvals, median, mean, std, maximum = \
+            eval_stats_block(vi_cube[:, rows, cols], [90])
+        tile_rows = tile_rows_for_memory(parse_memory('8GB'),
+                                         exact_pixel_bytes(nfiles),
+                                         nrows, ncols)
+        pixel_index = union_pixel_index(union_mask)
+        vi_median_grid = scatter_pixels(median, pixel_index, (nrows, ncols))
+
+INPUT: VI values provided by calling script
+
+OUTPUT: statistics returned to calling script
+"""
+
+
+import math
+import numpy as np
+
+
+def eval_stats(vals, q):
+    """
+    reference (one pixel) statistics of the valid (> 0) values in a VI time
+    series: number of values, q-th percentile, median, mean, std, maximum
+    """
+    exclude = np.argwhere(vals <= 0.0)
+    if len(exclude) > 0:
+        vals = np.delete(vals, exclude)
+    nvals = len(vals)
+    if nvals == 0:
+        qval = 0.0
+        median = 0.0
+        mean = 0.0
+        std = 0.0
+        maximum = 0.0
+    elif nvals == 1:
+        qval = vals[0]
+        median = vals[0]
+        mean = vals[0]
+        std = 0.0
+        maximum = vals[0]
+    else:
+        qval = np.percentile(vals, q)
+        median = np.percentile(vals, 50)
+        mean = np.mean(vals)
+        std = np.std(vals)
+        maximum = np.amax(vals)
+    return nvals, qval, median, mean, std, maximum
+
+
+def sorted_pctile(vals_sorted, nvals, q):
+    """
+    q-th percentile (linear interpolation, as np.percentile) along axis 0 of
+    a block whose first nvals values in each column are valid and ascending
+    """
+    npix = np.shape(vals_sorted)[1]
+    cols = np.arange(npix)
+    rank = np.maximum(nvals - 1, 0) * (q / 100.0)
+    below = np.floor(rank).astype(np.int64)
+    above = np.minimum(below + 1, np.maximum(nvals - 1, 0))
+    t = rank - below
+    a = vals_sorted[below, cols]
+    b = vals_sorted[above, cols]
+    a = np.where(np.isfinite(a), a, 0.0)
+    b = np.where(np.isfinite(b), b, 0.0)
+    diff = b - a
+    qval = np.where(t >= 0.5, b - diff * (1.0 - t), a + diff * t)
+    return np.where(nvals > 0, qval, 0.0)
+
+
+def eval_stats_block(vals, pctiles):
+    """
+    eval_stats() for a whole (nscenes, npix) block of pixels at once; values
+    <= 0 are treated as missing, and pixels with 0 or 1 valid values get the
+    same results as eval_stats(); returns nvals, a list of percentile arrays
+    (one per entry in pctiles), median, mean, std and maximum
+    """
+    valid = vals > 0.0
+    nvals = np.sum(valid, axis=0)
+    nvals_div = np.maximum(nvals, 1)
+    vals64 = np.where(valid, vals, 0.0).astype(np.float64)
+    mean = np.sum(vals64, axis=0) / nvals_div
+    dev = np.where(valid, vals64 - mean, 0.0)
+    std = np.sqrt(np.sum(dev * dev, axis=0) / nvals_div)
+    del dev
+    # missing values sort to the end of each column
+    vals64[~valid] = np.inf
+    vals64.sort(axis=0)
+    qvals = [sorted_pctile(vals64, nvals, q) for q in pctiles]
+    median = sorted_pctile(vals64, nvals, 50)
+    maximum = sorted_pctile(vals64, nvals, 100)
+    return nvals, qvals, median, mean, std, maximum
+
+
+def parse_memory(mem_str):
+    """
+    number of bytes in a memory size string such as '8GB', '512M' or '2e9'
+    (no suffix means bytes)
+    """
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    mem_str = mem_str.strip().upper()
+    if mem_str.endswith('B'):
+        mem_str = mem_str[:-1]
+    scale = 1
+    if mem_str[-1:] in units:
+        scale = units[mem_str[-1]]
+        mem_str = mem_str[:-1]
+    return int(float(mem_str) * scale)
+
+
+def add_grids_options(parser, max_memory):
+    """
+    add the options that scripts reading a process_L57_08.py grids file
+    share (memory limit, seasonal window and output format) to an
+    argparse parser
+    """
+    parser.add_argument('--max-memory', default=max_memory,
+                        help='memory limit for the blocks in progress, '
+                             'e.g. 8GB')
+    parser.add_argument('--doy', default=None,
+                        help='day of year window of the grids file')
+    parser.add_argument('--months', default=None,
+                        help='month window of the grids file')
+    parser.add_argument('--output-format', choices=['h5', 'zarr'],
+                        default='h5', help='hdf5 files or directory stores')
+    return
+
+
+def window_tag(doy, months):
+    """
+    seasonal window part of a grids file name, e.g. '_doy150-250' or
+    '_m6-8' ('' for no window)
+    """
+    tag = ''
+    if doy is not None:
+        tag += '_doy%s' % doy.replace(',', '+')
+    if months is not None:
+        tag += '_m%s' % months.replace(',', '+')
+    return tag
+
+
+# approximate bytes needed per (scene, pixel) value of a tile: the float32
+# tile itself plus the float64 working arrays of eval_stats_block()
+tile_cell_bytes = 48
+
+
+def exact_pixel_bytes(nfiles):
+    """ approximate bytes per pixel of a tile evaluated exactly """
+    return nfiles * tile_cell_bytes
+
+
+def tile_rows_for_memory(max_bytes, pixel_bytes, nrows, ncols,
+                         chunk_rows=None, grid_bytes=1,
+                         reserve_bytes=256 * 1024 ** 2):
+    """
+    number of grid rows per tile so that tiles needing pixel_bytes per pixel
+    (exact_pixel_bytes() or sketch_pixel_bytes(), times the number of tiles
+    in progress) fit in max_bytes, less grid_bytes per pixel of full grids
+    kept in memory (masks, outputs) and reserve_bytes for the interpreter
+    and open h5 files; rounded down to a multiple of the input chunk rows
+    when a tile spans at least one chunk
+    """
+    avail = max_bytes - reserve_bytes - nrows * ncols * grid_bytes
+    tile_rows = int(avail // (pixel_bytes * ncols))
+    tile_rows = max(1, min(tile_rows, nrows))
+    if chunk_rows is not None and chunk_rows <= tile_rows < nrows:
+        tile_rows = (tile_rows // chunk_rows) * chunk_rows
+    return tile_rows
+
+
+# edge length of the spatial chunks in a time-major ('time' layout) cube
+cube_tile = 64
+
+
+def cube_chunks(layout, nfiles, nrows, ncols, tile_rows):
+    """
+    chunk shape of a (time, row, col) VI cube: one scene by a band of rows
+    for the 'scene' layout, or all scenes by cube_tile x cube_tile pixels for
+    the 'time' layout, so that a pixel's time series is in a single chunk
+    """
+    if layout == 'time':
+        return (nfiles, min(cube_tile, nrows), min(cube_tile, ncols))
+    return (1, min(tile_rows, nrows), min(ncols, 1024))
+
+
+def cube_cache(shape, chunks, itemsize=4, nbands=1):
+    """
+    h5py chunk cache settings (rdcc_nbytes, rdcc_nslots) for reading a
+    chunked cube, big enough to keep nbands full-width bands of chunks
+    (every time chunk of every chunk column; for a sparse cube, every time
+    chunk of nbands runs of pixels) so each chunk is decompressed once per
+    pass over the cube; rdcc_nslots is a prime about 100 times the number
+    of cached chunks, as the HDF5 documentation suggests
+    """
+    nchunks = nbands * (-(-shape[0] // chunks[0]))
+    if len(shape) == 3:
+        nchunks *= -(-shape[2] // chunks[2])
+    nbytes = max(nchunks * int(np.prod(chunks)) * itemsize, 1024 ** 2)
+    nslots = max(100 * nchunks, 521)
+    while any(nslots % p == 0 for p in range(2, int(np.sqrt(nslots)) + 1)):
+        nslots += 1
+    return nbytes, nslots
+
+
+def sparse_cube_chunks(layout, nfiles, npix):
+    """
+    chunk shape of a sparse (time, union pixel) VI cube: one scene by a run
+    of pixels for the 'scene' layout, or all scenes by a shorter run for
+    the 'time' layout
+    """
+    if layout == 'time':
+        return (nfiles, max(min(cube_tile * cube_tile, npix), 1))
+    return (1, max(min(65536, npix), 1))
+
+
+def union_pixel_index(mask):
+    """ flat (row-major) indices of the mask == 1 pixels of a grid """
+    return np.flatnonzero(mask == 1)
+
+
+def gather_pixels(grids, pixel_index):
+    """
+    values at the pixel_index locations of a (rows, cols) grid or an
+    (n, rows, cols) stack of grids, as (npix,) or (n, npix)
+    """
+    grids = np.asarray(grids)
+    return grids.reshape(grids.shape[:-2] + (-1,))[..., pixel_index]
+
+
+def scatter_pixels(vals, pixel_index, shape, fill=0.0):
+    """
+    (rows, cols) grid, or (n, rows, cols) stack of grids, with (npix,) or
+    (n, npix) values at the pixel_index locations and fill elsewhere
+    """
+    vals = np.asarray(vals)
+    grids = np.full(vals.shape[:-1] + (int(np.prod(shape)),), fill,
+                    dtype=vals.dtype)
+    grids[..., pixel_index] = vals
+    return grids.reshape(vals.shape[:-1] + tuple(shape))
+
+
+def pixel_blocks(npix, block):
+    """ (start, end) runs of at most block pixels """
+    return [(p0, min(p0 + block, npix)) for p0 in range(0, npix, block)]
+
+
+def cube_blocks(cube, union_mask, block, max_bytes):
+    """
+    (start, end, values) of each run of at most block union mask pixels of
+    a dense (time, rows, cols) or sparse (time, npix) VI datacube, in flat
+    index order, with (time, end - start) values; a dense cube is read in
+    bands of rows whose union mask pixels fit max_bytes as float64
+    """
+    nfiles = cube.shape[0]
+    nrows, ncols = np.shape(union_mask)
+    if len(cube.shape) == 2:
+        # sparse cube: (time, union pixel) values, read in runs of pixels
+        for p0, p1 in pixel_blocks(cube.shape[1], block):
+            yield p0, p1, np.array(cube[:, p0:p1])
+        return
+    band_rows = tile_rows_for_memory(max_bytes, nfiles * 8, nrows, ncols,
+                                     chunk_rows=cube.chunks[1])
+    u0 = 0
+    for r0 in range(0, nrows, band_rows):
+        r1 = min(r0 + band_rows, nrows)
+        band_index = union_pixel_index(union_mask[r0:r1, :])
+        if len(band_index) == 0:
+            continue
+        band_vals = np.array(cube[:, r0:r1, :]).reshape(
+            (nfiles, -1))[:, band_index]
+        for p0, p1 in pixel_blocks(len(band_index), block):
+            yield u0 + p0, u0 + p1, band_vals[:, p0:p1]
+        u0 += len(band_index)
+
+
+def save_pixel_grids(h5file, grids, pixel_index, shape, chunks):
+    """
+    add (datapath, values, fill) grids made from flat union mask pixel
+    values to an open grids file (h5py File or Chunk_Store group),
+    replacing any that are there
+    """
+    for datapath, vals, fill in grids:
+        if datapath in h5file:
+            del h5file[datapath]
+        h5file.create_dataset(datapath, data=scatter_pixels(
+            vals, pixel_index, shape, fill=fill), dtype=np.float32,
+            chunks=chunks, compression='gzip')
+    return
+
+
+def save_meta(h5file, items):
+    """
+    (datapath, value) metadata in an open grids file, replacing any that
+    are there
+    """
+    for datapath, value in items:
+        if datapath in h5file:
+            del h5file[datapath]
+        h5file.create_dataset(datapath, data=value)
+    return
+
+
+def sketch_dtype(nfiles):
+    """ smallest unsigned integer type that can count nfiles values """
+    if nfiles < 2 ** 8:
+        return np.uint8
+    elif nfiles < 2 ** 16:
+        return np.uint16
+    else:
+        return np.uint32
+
+
+def sketch_pixel_bytes(nbins, nfiles):
+    """
+    approximate bytes per pixel of a tile evaluated with sketches: counts,
+    their cumulative sums and comparison masks, and the moments
+    """
+    itemsize = np.dtype(sketch_dtype(nfiles)).itemsize
+    return nbins * (3 * itemsize + 1) + 64
+
+
+def sketch_init(npix, nbins, nfiles):
+    """
+    empty per-pixel sketches: fixed-bin histogram counts (npix, nbins) and
+    exact moments (4, npix) holding nvals, mean, M2 and maximum
+    """
+    counts = np.zeros((npix, nbins), dtype=sketch_dtype(nfiles))
+    moments = np.zeros((4, npix), dtype=np.float64)
+    return counts, moments
+
+
+def value_bins(x, nbins, vmin, vmax):
+    """ fixed-bin histogram bin of each value, clipped to the end bins """
+    bins = np.floor((x - vmin) * (nbins / float(vmax - vmin)))
+    return np.clip(bins, 0, nbins - 1).astype(np.int64)
+
+
+def sketch_update(counts, moments, vals, vmin, vmax):
+    """
+    add one scene's values (one per pixel, <= 0 treated as missing) to the
+    sketches in place; values outside [vmin, vmax] are counted in the end
+    bins, and the moments are updated with Welford's algorithm
+    """
+    pix = np.flatnonzero(vals > 0.0)
+    x = vals[pix].astype(np.float64)
+    counts[pix, value_bins(x, np.shape(counts)[1], vmin, vmax)] += 1
+    n = moments[0, pix] + 1.0
+    delta = x - moments[1, pix]
+    mean = moments[1, pix] + delta / n
+    moments[2, pix] += delta * (x - mean)
+    moments[0, pix] = n
+    moments[1, pix] = mean
+    moments[3, pix] = np.maximum(moments[3, pix], x)
+    return
+
+
+def sketch_order_stat(counts, cum, r, vmin, width):
+    """
+    estimate of the r-th (0-based) smallest value at each pixel, spreading
+    the values counted in a bin evenly across it
+    """
+    nbins = np.shape(counts)[1]
+    pix = np.arange(np.shape(counts)[0])
+    b = np.sum(cum <= r[:, np.newaxis], axis=1)
+    b = np.minimum(b, nbins - 1)
+    n_b = counts[pix, b].astype(np.float64)
+    before = cum[pix, b] - n_b
+    frac = (r - before + 0.5) / np.maximum(n_b, 1.0)
+    return vmin + (b + frac) * width
+
+
+def sketch_pctile(counts, cum, nvals, maximum, q, vmin, vmax):
+    """
+    q-th percentile estimate (linear interpolation between estimated order
+    statistics, as np.percentile); see eval_stats_sketch() for error bounds
+    """
+    width = (vmax - vmin) / float(np.shape(counts)[1])
+    rank = np.maximum(nvals - 1, 0) * (q / 100.0)
+    below = np.floor(rank)
+    above = np.minimum(below + 1, np.maximum(nvals - 1, 0))
+    t = rank - below
+    a = sketch_order_stat(counts, cum, below, vmin, width)
+    b = sketch_order_stat(counts, cum, above, vmin, width)
+    qval = np.minimum(a + (b - a) * t, maximum)
+    qval = np.where(nvals == 1, maximum, qval)
+    return np.where(nvals > 0, qval, 0.0)
+
+
+def sums_update(counts, sums, vals, vmin, vmax):
+    """
+    add one scene's values (one per pixel, <= 0 treated as missing) to
+    fixed-bin histogram counts and to (4, npix) running sums of count, sum,
+    sum of squares and maximum, in place; unlike the Welford moments these
+    can be summed over any set of years
+    """
+    pix = np.flatnonzero(vals > 0.0)
+    x = vals[pix].astype(np.float64)
+    counts[pix, value_bins(x, np.shape(counts)[1], vmin, vmax)] += 1
+    sums[0, pix] += 1.0
+    sums[1, pix] += x
+    sums[2, pix] += x * x
+    sums[3, pix] = np.maximum(sums[3, pix], x)
+    return
+
+
+def moments_from_sums(sums):
+    """
+    (4, npix) nvals, mean, M2 and maximum, as used by eval_stats_sketch(),
+    from (4, npix) count, sum, sum of squares and maximum
+    """
+    nvals = sums[0]
+    mean = sums[1] / np.maximum(nvals, 1.0)
+    M2 = np.maximum(sums[2] - sums[1] * mean, 0.0)
+    return np.array([nvals, mean, M2, sums[3]])
+
+
+def eval_stats_sketch(counts, moments, pctiles, vmin, vmax):
+    """
+    eval_stats_block() results from per-pixel sketches: nvals, mean, std and
+    maximum are exact; each estimated order statistic falls in the same bin
+    as the exact one, so for values inside [vmin, vmax] the percentiles and
+    median are within one bin width, (vmax - vmin) / nbins, of the exact
+    results (values above vmax are only bounded by the exact maximum)
+    """
+    nvals = moments[0].astype(np.int64)
+    mean = moments[1]
+    std = np.sqrt(moments[2] / np.maximum(nvals, 1))
+    maximum = moments[3]
+    cum = np.cumsum(counts, axis=1, dtype=counts.dtype)
+    qvals = [sketch_pctile(counts, cum, nvals, maximum, q, vmin, vmax)
+             for q in pctiles]
+    median = sketch_pctile(counts, cum, nvals, maximum, 50, vmin, vmax)
+    return nvals, qvals, median, mean, std, maximum
+
+
+def date_strings(dates):
+    """ 'YYYY_DOY' strings from a 'dates' dataset """
+    return [str(date.decode('ascii')) if isinstance(date, bytes)
+            else str(date) for date in dates]
+
+
+def decimal_years(dates, year0):
+    """
+    time in years since 1 January of year0 for 'YYYY_DOY' date strings
+    """
+    return np.array([int(date[:4]) - year0 + (int(date[5:8]) - 1) / 365.25
+                     for date in dates], dtype=np.float64)
+
+
+def trend_pixel_bytes(nfiles):
+    """
+    approximate bytes per pixel of a block evaluated by trend_block(): the
+    float64 slopes, signs and masks of every pair of scenes, plus the
+    working arrays of the regression
+    """
+    npairs = nfiles * (nfiles - 1) // 2
+    return npairs * 24 + nfiles * tile_cell_bytes
+
+
+def ols_trend(vals, valid, t):
+    """
+    ordinary least squares slope, intercept (at t = 0) and R^2 along axis 0
+    of an (nscenes, npix) block, using only the valid values of each pixel
+    """
+    w = valid.astype(np.float64)
+    nvals = np.maximum(np.sum(w, axis=0), 1.0)
+    t_mean = np.dot(t, w) / nvals
+    y_mean = np.sum(vals * w, axis=0) / nvals
+    dt = (t[:, None] - t_mean) * w
+    dy = (vals - y_mean) * w
+    Stt = np.sum(dt * dt, axis=0)
+    Sty = np.sum(dt * dy, axis=0)
+    Syy = np.sum(dy * dy, axis=0)
+    del dt, dy
+    slope = np.where(Stt > 0.0, Sty / np.where(Stt > 0.0, Stt, 1.0), 0.0)
+    intercept = y_mean - slope * t_mean
+    ok = (Stt > 0.0) & (Syy > 0.0)
+    r2 = np.where(ok, Sty * Sty / np.where(ok, Stt * Syy, 1.0), 0.0)
+    return slope, intercept, r2
+
+
+def tie_sums(vals, valid):
+    """
+    sum over groups of tied valid values of g(g - 1)(2g + 5) along axis 0,
+    for the Mann-Kendall variance; a value that is the m-th of its group in
+    sorted order adds 6m^2 - 6, which sums to the same thing
+    """
+    vals_sorted = np.where(valid, vals, np.inf)
+    vals_sorted.sort(axis=0)
+    nscenes = np.shape(vals)[0]
+    if nscenes < 2:
+        return np.zeros(np.shape(vals)[1])
+    tied = (vals_sorted[1:] == vals_sorted[:-1]) & \
+        np.isfinite(vals_sorted[1:])
+    pos = np.arange(1, nscenes)[:, None]
+    start = np.maximum.accumulate(np.where(tied, 0, pos), axis=0)
+    m = np.where(tied, pos - start + 1, 1).astype(np.float64)
+    return np.sum(6.0 * m * m - 6.0, axis=0)
+
+
+def trend_block(vals, t, min_obs):
+    """
+    per-pixel trends of an (nscenes, npix) block of VI values at times t
+    (years): values <= 0 are treated as missing, as in eval_stats_block(),
+    and pixels with fewer than min_obs valid values get zeros; returns
+    nvals, OLS slope, intercept and R^2, Theil-Sen slope (median of the
+    pairwise slopes) and the Mann-Kendall Z score and two-sided p-value
+    (variance corrected for tied values, not for tied dates)
+    """
+    valid = vals > 0.0
+    nvals = np.sum(valid, axis=0)
+    vals64 = np.where(valid, vals, 0.0).astype(np.float64)
+    slope, intercept, r2 = ols_trend(vals64, valid, t)
+    ties = tie_sums(vals64, valid)
+    i, j = np.triu_indices(len(t), 1)
+    dt = t[j] - t[i]
+    pairs = valid[i] & valid[j]
+    dy = vals64[j] - vals64[i]
+    S = np.sum(np.where(pairs, np.sign(dy) * np.sign(dt)[:, None], 0.0),
+               axis=0)
+    pairs &= (dt != 0.0)[:, None]
+    npairs = np.sum(pairs, axis=0)
+    pair_slopes = np.where(pairs, dy / np.where(dt != 0.0, dt, 1.0)[:, None],
+                           np.inf)
+    del dy
+    pair_slopes.sort(axis=0)
+    sen_slope = sorted_pctile(pair_slopes, npairs, 50)
+    del pair_slopes
+    n = nvals.astype(np.float64)
+    var_S = (n * (n - 1.0) * (2.0 * n + 5.0) - ties) / 18.0
+    mk_z = np.where(var_S > 0.0, (S - np.sign(S)) /
+                    np.sqrt(np.where(var_S > 0.0, var_S, 1.0)), 0.0)
+    mk_p = np.frompyfunc(math.erfc, 1, 1)(np.abs(mk_z) /
+                                           np.sqrt(2.0)).astype(np.float64)
+    enough = nvals >= max(min_obs, 2)
+    trends = [np.where(enough, x, 0.0)
+              for x in [slope, intercept, r2, sen_slope, mk_z]]
+    return [nvals] + trends + [np.where(enough, mk_p, 1.0)]
+
+
+def harmonic_terms(nharmonics, trend):
+    """
+    names of the coefficients in a harmonic model: mean, optional linear
+    trend (per year), then a cosine and a sine term per harmonic
+    """
+    terms = ['mean']
+    if trend:
+        terms.append('trend')
+    for h in range(1, nharmonics + 1):
+        terms += ['cos%d' % h, 'sin%d' % h]
+    return terms
+
+
+def harmonic_design(t, nharmonics, trend):
+    """
+    (ntimes, nterms) design matrix of a harmonic model at times t (years),
+    columns in harmonic_terms() order; the annual cycle has period 1
+    """
+    columns = [np.ones_like(t)]
+    if trend:
+        columns.append(t)
+    for h in range(1, nharmonics + 1):
+        columns += [np.cos(2.0 * np.pi * h * t), np.sin(2.0 * np.pi * h * t)]
+    return np.column_stack(columns)
+
+
+def harmonic_pixel_bytes(nfiles, nterms):
+    """ approximate bytes per pixel of a block fitted by harmonic_fit() """
+    return nfiles * tile_cell_bytes + nterms * (nterms + 2) * 16
+
+
+def harmonic_fit(vals, X, min_obs, max_cond=1.0e8):
+    """
+    per-pixel least squares fits of the design matrix X (ntimes, nterms) to
+    the valid (> 0) values of an (ntimes, npix) block, all at once from the
+    normal equations of each pixel's own set of valid values; returns
+    nvals, (nterms, npix) coefficients and the RMSE of the fitted values,
+    all zero where a pixel has fewer than min_obs (or nterms + 1) values
+    or too narrow a spread of dates to fit every term
+    """
+    nterms = np.shape(X)[1]
+    npix = np.shape(vals)[1]
+    valid = vals > 0.0
+    nvals = np.sum(valid, axis=0)
+    w = valid.astype(np.float64)
+    y = np.where(valid, vals, 0.0).astype(np.float64)
+    G = np.einsum('tp,ti,tj->pij', w, X, X)
+    b = np.einsum('tp,ti->pi', y, X)
+    fit = nvals >= max(min_obs, nterms + 1)
+    fit[fit] = np.linalg.cond(G[fit]) < max_cond
+    coefs = np.zeros((nterms, npix))
+    if np.any(fit):
+        coefs[:, fit] = np.linalg.solve(G[fit], b[fit][:, :, None])[:, :, 0].T
+    resid = (y - np.dot(X, coefs)) * w
+    rmse = np.sqrt(np.sum(resid * resid, axis=0) / np.maximum(nvals, 1))
+    return nvals, coefs, np.where(fit, rmse, 0.0)
+
+# end Stack_Stats.py
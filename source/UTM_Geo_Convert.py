@@ -23,6 +23,8 @@ USAGE: insert 'from UTM_Geo_Convert import *' near head of script, then
         UTM_coords = geographic_to_utm(stn_lon, stn_lat, UTMzone)
         stn_easting = int(round(UTM_coords[1],0))
         stn_northing = int(round(UTM_coords[2],0))
+       or, for many points in the same zone with a single transform,
+        eastings, northings = geographic_to_utm_points(lons, lats, 15)
 
 INPUT: coordinates provided by calling script
 
@@ -91,6 +93,30 @@ def geographic_to_utm(lon, lat, zonepref=-1):
     return zone, easting, northing
 
 
+def geographic_to_utm_points(lons, lats, zone, northern=1):
+    """
+    convert sequences of geographic coordinates (longitude, latitude)
+            to UTM eastings and northings in one zone, building the
+            transform once for all of the points
+    """
+    utm_coordinate_system = osr.SpatialReference()
+    # Set unprojected geographic coordinate system
+    utm_coordinate_system.SetWellKnownGeogCS("WGS84")
+    utm_coordinate_system.SetUTM(int(zone), int(northern))
+    # Clone ONLY the unprojected geographic coordinate system
+    geog_coordinate_system = utm_coordinate_system.CloneGeogCS()
+    # Create transform component with (<from>, <to>)
+    geog_to_utm_transform = \
+        osr.CoordinateTransformation(geog_coordinate_system,
+                                     utm_coordinate_system)
+    points = [(float(lon), float(lat), 0.0) for lon, lat in zip(lons, lats)]
+    # Note returned 'alt' (altitude) is currently unused
+    utm_points = geog_to_utm_transform.TransformPoints(points)
+    eastings = [point[0] for point in utm_points]
+    northings = [point[1] for point in utm_points]
+    return eastings, northings
+
+
 def utm_to_utm(easting_in, northing_in, zone_in, zone_out):
     """
     convert from UTM coordinates (zone_in, easting, northing)
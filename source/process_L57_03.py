@@ -44,7 +44,7 @@ def csmask_interpret(mask):
     interpret csmw2/Fmask values
     0 = clear, 1 = water, 2 = shadow, 4 = cloud, 255 = missing
     """
-    fmask = np.where(mask <= 1, 1.0, 0.0)
+    fmask = (mask <= 1).astype(np.uint8)
     return fmask
 
 
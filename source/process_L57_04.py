@@ -13,7 +13,8 @@ Treat others as you would be treated. Pay it forward. Valar dohaeris.
 
 PURPOSE: Convert image values (int) to reflectance (float) with some QC
 
-DEPENDENCIES: h5py, numpy, pandas
+DEPENDENCIES: h5py, numpy
+              Scene_Stats depends on numpy
 
 USAGE: '$ python process_L57_04.py ./P26R27 0'
 
@@ -28,7 +29,7 @@ import datetime
 import glob
 import h5py as hdf
 import numpy as np
-import pandas as pd
+from Scene_Stats import scene_stats, stats_total, save_stats
 
 
 def message(char_string):
@@ -42,22 +43,19 @@ def message(char_string):
 
 def calc_refl(inarr):
     """
-    scale and convert integer reflectance values to decimal
-    and generate masks for negative/spurious values
+    scale and convert integer reflectance values to decimal (float32)
+    and generate masks (uint8) for nodata and negative/spurious values
     """
-    nd = np.where(inarr == -9999, 0, 1)
-    in_df = pd.DataFrame(inarr)
-    nnans = in_df.isnull().sum().sum()
+    nd = (inarr != -9999).astype(np.uint8)
+    midarr1 = inarr.astype(np.float32)
+    nans = np.isnan(midarr1)
+    nnans = np.count_nonzero(nans)
     if nnans > 0:
-        print '-- masking %d NaN values' % nnans
-        _ = in_df.fillna(-8888, inplace=True)
-    midarr0 = np.array(in_df)
-    midarr1 = midarr0 / 10000.0
-    sp1 = np.where(midarr1 <= 0.0, 0, 1)
-    sp2 = np.where(midarr1 > 1.0, 0, 1)
-    spurious = sp1 * sp2
-    midarr2 = np.where(midarr1 > 0.0, midarr1, -9999)
-    outarr = np.where(midarr2 <= 1.0, midarr2, -9999)
+        message('-- masking %d NaN values' % nnans)
+        midarr1[nans] = -8888
+    midarr1 /= np.float32(10000.0)
+    spurious = ((midarr1 > 0.0) & (midarr1 <= 1.0)).astype(np.uint8)
+    outarr = np.where(spurious == 1, midarr1, np.float32(-9999))
     return outarr, nd, spurious
 
 
@@ -95,7 +93,7 @@ with hdf.File(scene_path, 'r') as h5file:
     b4 = np.copy(h5file['level0/b4_clip'])
     b5 = np.copy(h5file['level0/b5_clip'])
     b7 = np.copy(h5file['level0/b7_clip'])
-    csmask = np.copy(h5file['masks/csmask'])
+    csmask = np.array(h5file['masks/csmask'], dtype=np.uint8)
 #
 # convert individual bands to reflectance values
 message('- converting band values to decimal reflectance')
@@ -103,22 +101,36 @@ b1_refl, nodata1, spurious1 = calc_refl(b1)
 b2_refl, nodata2, spurious2 = calc_refl(b2)
 b3_refl, nodata3, spurious3 = calc_refl(b3)
 b4_refl, nodata4, spurious4 = calc_refl(b4)
-b4_refl_npix = (b4_refl != -9999).sum()
-message('--- raw band 4 (NIR) reflectance contains %d data pixels' %
-        b4_refl_npix)
 b5_refl, nodata5, spurious5 = calc_refl(b5)
 b7_refl, nodata7, spurious7 = calc_refl(b7)
 # combine nodata masks
 nodata = nodata1 * nodata2 * nodata3 * nodata4 * nodata5 * nodata7
-message('- nodata mask allows %d pixels' % nodata.sum())
 # combine spurious values masks
 smask = spurious1 * spurious2 * spurious3 * spurious4 * spurious5 * spurious7
-message('- spurious values mask allows %d pixels' % smask.sum())
 # combine nodata and spurious values masks with cloud/shadow mask
-message('- cloud/shadow mask allows %d pixels' % csmask.sum())
 scsmask = nodata * smask * csmask
+#
+# summary statistics for bands (over their own valid pixels) and masks
+message('- accumulating band and mask statistics')
+stats = scene_stats([('level1/b1_refl', b1_refl, spurious1),
+                     ('level1/b2_refl', b2_refl, spurious2),
+                     ('level1/b3_refl', b3_refl, spurious3),
+                     ('level1/b4_refl', b4_refl, spurious4),
+                     ('level1/b5_refl', b5_refl, spurious5),
+                     ('level1/b7_refl', b7_refl, spurious7),
+                     ('masks/nodata', nodata, None),
+                     ('masks/smask', smask, None),
+                     ('masks/csmask', csmask, None),
+                     ('masks/scsmask', scsmask, None)])
+message('--- raw band 4 (NIR) reflectance contains %d data pixels' %
+        stats['level1/b4_refl'][0])
+message('- nodata mask allows %d pixels' % stats_total(stats['masks/nodata']))
+message('- spurious values mask allows %d pixels' %
+        stats_total(stats['masks/smask']))
+message('- cloud/shadow mask allows %d pixels' %
+        stats_total(stats['masks/csmask']))
 message('- combined nodata/spurious/cloud/shadow mask allows %d pixels' %
-        scsmask.sum())
+        stats_total(stats['masks/scsmask']))
 #
 # store all calculated fields to h5 file
 message('- saving calculation results to %s' % scene_file)
@@ -159,6 +171,8 @@ with hdf.File(scene_path, 'r+') as h5file:
     h5file.create_dataset('level1/b7_refl', data=b7_refl,
                           dtype=np.float32, compression='gzip')
     message('-- saved 6 reflectance bands (level 1)')
+    save_stats(h5file, stats)
+    message('-- saved %d band and mask statistics' % len(stats))
 message(' ')
 #
 message('process_L57_04.py completed at %s' %
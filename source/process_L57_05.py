@@ -14,8 +14,13 @@ Treat others as you would be treated. Pay it forward. Valar dohaeris.
 PURPOSE: Create/apply surface water mask using KTTC Wetness calculation
 
 DEPENDENCIES: h5py, numpy, matplotlib
+              Scene_Stats depends on numpy
 
 USAGE: '$ python process_L57_05.py ./P26R27 0'
+       '$ python process_L57_05.py ./P26R27 0 0 otsu' to select the water
+         threshold from the scene's KTTC Wet histogram ('otsu' or 'valley';
+         the default 'fixed' uses the water_threshold value below); the third
+         argument (1/0) turns the histogram plot on/off
 
 INPUT: Outputs of process_L57_04.py
 
@@ -32,7 +37,9 @@ import matplotlib as mpl
 mpl.use('Agg')
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
-import matplotlib.path as path
+import matplotlib.path as mpath
+from Scene_Stats import scene_stats, stats_total, save_stats, read_stats, \
+    scene_hist, hist_edges, otsu_threshold, valley_threshold, save_hist
 
 
 def message(char_string):
@@ -45,17 +52,16 @@ def message(char_string):
 
 
 def apply_mask(bx, mask):
-    bx_masked = np.where(mask == 1, bx, -9999)
+    bx_masked = np.where(mask == 1, bx, np.float32(-9999))
     return bx_masked
 
 
 def wmask_create(kttcwet, threshold):
     """
     create surface water mask from KTTC Wet component
-    TO DO: determine water threshold dynamically from kttc_wet histogram
     """
     message('-- creating water mask with threshold KTTC Wet = %f' % threshold)
-    mask = np.where(kttcwet < threshold, 1, 0)
+    mask = (kttcwet < threshold).astype(np.uint8)
     return mask
 
 
@@ -69,13 +75,13 @@ def calc_kttc_comp(c, b1, b2, b3, b4, b5, b7, mask):
     return kttc_comp_masked
 
 
-def plot_hist(bx, nbins, bx_min, bx_max):
+def plot_hist(n, bx_min, bx_max):
     """
-    plot histogram
+    plot histogram from (already accumulated) fixed-bin counts
     code from http://matplotlib.org/examples/api/histogram_path_demo.html
     """
     fig, ax = plt.subplots()
-    n, bins = np.histogram(bx, bins=nbins, range=(bx_min, bx_max))
+    bins = hist_edges(len(n), bx_min, bx_max)
     # get corners of histogram bins
     left = np.array(bins[:-1])
     right = np.array(bins[1:])
@@ -83,9 +89,10 @@ def plot_hist(bx, nbins, bx_min, bx_max):
     top = bottom + n
     # need (numrects x numsides x 2) numpy array for the path helper function
     #   to build a compound path
-    XY = np.array([[left, bottom], [left, top], [right, top], [right, bottom]])
+    XY = np.array([[left, left, right, right],
+                   [bottom, top, top, bottom]]).T
     # get Path object
-    barpath = path.Path.make_compound_path_from_polys(XY)
+    barpath = mpath.Path.make_compound_path_from_polys(XY)
     # make patch
     patch = patches.PathPatch(barpath, facecolor='blue', edgecolor='gray',
                               alpha=0.8)
@@ -104,15 +111,28 @@ kttc_wet_coeffs = [0.0315, 0.2021, 0.3102, 0.1594, -0.6806, -0.6109]
 
 # KTTC Wet value for creation of water mask
 #   (kttc_wet >= water_threshold --> water)
-# TO DO: determine water threshold dynamically from kttc_wet histogram
 water_threshold = -0.012
 
 
+# KTTC Wet histogram bins and range, stored with each scene and used for
+#   'otsu'/'valley' water threshold selection
+kttc_wet_nbins = 500
+kttc_wet_range = [-0.4, 0.1]
+
+
 message(' ')
 message('process_L57_05.py started at %s' %
         datetime.datetime.now().isoformat())
 message(' ')
 #
+if len(sys.argv) < 5:
+    threshold_method = 'fixed'
+else:
+    threshold_method = sys.argv[4].lower()
+if threshold_method not in ['fixed', 'otsu', 'valley']:
+    message('input error: water threshold method must be fixed/otsu/valley')
+    sys.exit(1)
+#
 if len(sys.argv) < 4:
     plot_histogram = 0
 else:
@@ -147,35 +167,71 @@ with hdf.File(scene_path, 'r') as h5file:
     b4_refl = np.copy(h5file['level1/b4_refl'])
     b5_refl = np.copy(h5file['level1/b5_refl'])
     b7_refl = np.copy(h5file['level1/b7_refl'])
-    scsmask = np.copy(h5file['masks/scsmask'])
+    scsmask = np.array(h5file['masks/scsmask'], dtype=np.uint8)
+    scsmask_stats = read_stats(h5file, 'masks/scsmask')
 #
 # get KTTC Wet component for water mask
 message('- calculating KTTC Wet')
 kttc_wet = calc_kttc_comp(kttc_wet_coeffs, b1_refl, b2_refl, b3_refl,
                           b4_refl, b5_refl, b7_refl, scsmask)
+message('- accumulating KTTC Wet histogram')
+kttc_wet_hist = scene_hist(kttc_wet, scsmask, kttc_wet_nbins,
+                           kttc_wet_range[0], kttc_wet_range[1])
 if plot_histogram:
-    plot_hist(kttc_wet, 500, -0.4, 0.1)
+    plot_hist(kttc_wet_hist, kttc_wet_range[0], kttc_wet_range[1])
+# select water threshold
+thresholds = {'fixed': water_threshold,
+              'otsu': otsu_threshold(kttc_wet_hist, kttc_wet_range[0],
+                                     kttc_wet_range[1]),
+              'valley': valley_threshold(kttc_wet_hist, kttc_wet_range[0],
+                                         kttc_wet_range[1])}
+for method in ['otsu', 'valley']:
+    if thresholds[method] is None:
+        message('-- no %s threshold found in KTTC Wet histogram' % method)
+        thresholds[method] = -9999
+    else:
+        message('-- %s threshold from KTTC Wet histogram = %f' %
+                (method, thresholds[method]))
+if thresholds[threshold_method] == -9999:
+    message('-- using fixed threshold instead')
+    threshold_method = 'fixed'
 # create surface water mask
-wmask = wmask_create(kttc_wet, water_threshold)
-message('-- water mask allows %d pixels' % wmask.sum())
+wmask = wmask_create(kttc_wet, thresholds[threshold_method])
 # create a combined nodata/spurious/cloud/shadow/water mask
-message('-- input nodata/spurious/cloud/shadow mask allows %d pixels' %
-        scsmask.sum())
 scswmask = scsmask * wmask
-message('-- nodata/spurious/cloud/shadow/water mask allows %d pixels' %
-        scswmask.sum())
 # apply combined mask to band reflectances
 message('- applying nodata/spurious/cloud/shadow/water mask to bands')
 b1_refl_scswmask = apply_mask(b1_refl, scswmask)
 b2_refl_scswmask = apply_mask(b2_refl, scswmask)
 b3_refl_scswmask = apply_mask(b3_refl, scswmask)
 b4_refl_scswmask = apply_mask(b4_refl, scswmask)
-b4_refl_masked_npix = (b4_refl_scswmask != -9999).sum()
-message('-- masked band 4 (NIR) reflectance contains %d data pixels' %
-        b4_refl_masked_npix)
 b5_refl_scswmask = apply_mask(b5_refl, scswmask)
 b7_refl_scswmask = apply_mask(b7_refl, scswmask)
 #
+# summary statistics for KTTC Wet, masks, and masked bands
+message('- accumulating band and mask statistics')
+stats_grids = [('level1/kttc_wet', kttc_wet, scsmask),
+               ('masks/wmask', wmask, None),
+               ('masks/scswmask', scswmask, None),
+               ('level2/b1_refl_scswmask', b1_refl_scswmask, scswmask),
+               ('level2/b2_refl_scswmask', b2_refl_scswmask, scswmask),
+               ('level2/b3_refl_scswmask', b3_refl_scswmask, scswmask),
+               ('level2/b4_refl_scswmask', b4_refl_scswmask, scswmask),
+               ('level2/b5_refl_scswmask', b5_refl_scswmask, scswmask),
+               ('level2/b7_refl_scswmask', b7_refl_scswmask, scswmask)]
+if scsmask_stats is None:
+    stats_grids.append(('masks/scsmask', scsmask, None))
+stats = scene_stats(stats_grids)
+if scsmask_stats is None:
+    scsmask_stats = stats.pop('masks/scsmask')
+message('-- water mask allows %d pixels' % stats_total(stats['masks/wmask']))
+message('-- input nodata/spurious/cloud/shadow mask allows %d pixels' %
+        stats_total(scsmask_stats))
+message('-- nodata/spurious/cloud/shadow/water mask allows %d pixels' %
+        stats_total(stats['masks/scswmask']))
+message('-- masked band 4 (NIR) reflectance contains %d data pixels' %
+        stats['level2/b4_refl_scswmask'][0])
+#
 # store all calculated fields to hdf5 file
 message('- saving calculation results to %s' % scene_file)
 with hdf.File(scene_path, 'r+') as h5file:
@@ -188,8 +244,13 @@ with hdf.File(scene_path, 'r+') as h5file:
     if 'meta' in h5file['masks'].keys():
         del h5file['masks/meta']
     h5file.create_dataset('masks/meta/wmask_kttc_wet_threshold',
-                          data=water_threshold)
-    message('-- saved 1 metadata item (mask level)')
+                          data=thresholds[threshold_method])
+    h5file.create_dataset('masks/meta/wmask_threshold_method',
+                          data=threshold_method)
+    for method in ['fixed', 'otsu', 'valley']:
+        h5file.create_dataset('masks/meta/wmask_kttc_wet_threshold_%s' %
+                              method, data=thresholds[method])
+    message('-- saved 5 metadata items (mask level)')
     if 'wmask' in h5file['masks'].keys():
         del h5file['masks/wmask']
     h5file.create_dataset('masks/wmask', data=wmask, dtype=np.int8,
@@ -217,6 +278,11 @@ with hdf.File(scene_path, 'r+') as h5file:
     h5file.create_dataset('level2/b7_refl_scswmask', data=b7_refl_scswmask,
                           dtype=np.float32, compression='gzip')
     message('-- saved 6 fully masked reflectance bands (level2)')
+    save_stats(h5file, stats)
+    message('-- saved %d band and mask statistics' % len(stats))
+    save_hist(h5file, 'level1/kttc_wet', kttc_wet_hist, kttc_wet_range[0],
+              kttc_wet_range[1])
+    message('-- saved 1 KTTC Wet histogram')
 message(' ')
 #
 message('process_L57_05.py completed at %s' %
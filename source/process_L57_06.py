@@ -14,8 +14,18 @@ Treat others as you would be treated. Pay it forward. Valar dohaeris.
 PURPOSE: Calculate various vegetation indices
 
 DEPENDENCIES: h5py, numpy
+              Scene_Stats depends on numpy
+              numba (optional) for the fused multi-threaded index kernels;
+                without it the NumPy calculations below are used instead
 
 USAGE: '$ python process_L57_06.py ./P26R27 0'
+       '$ python process_L57_06.py ./P26R27 0 numpy' to force the NumPy path
+       '$ python process_L57_06.py ./P26R27 0 numba 1' to also store a
+         fixed-bin histogram of each index in the 'stats/hist/' group
+
+NOTE: The numba kernels use every core available to the process; set
+      NUMBA_NUM_THREADS to limit that (the HTCondor wrapper script sets it to
+      match request_cpus).
 
 INPUT: Outputs of process_L57_05.py
 
@@ -28,6 +38,13 @@ import datetime
 import glob
 import h5py as hdf
 import numpy as np
+from Scene_Stats import scene_stats, stats_std, save_stats, read_stats, \
+    scene_hist, save_hist, vi_hist_ranges
+try:
+    from numba import njit, prange
+    numba_available = True
+except ImportError:
+    numba_available = False
 
 
 def message(char_string):
@@ -40,15 +57,15 @@ def message(char_string):
 
 
 def apply_mask(bx, mask):
-    bx_masked = np.where(mask == 1, bx, -9999)
+    bx_masked = np.where(mask == 1, bx, np.float32(-9999))
     return bx_masked
 
 
 def calc_ratio(bn, bd, mask):
-    zero = np.where(bd == 0, 1, 0)
-    if zero.sum() > 0:
-        message('*** ERROR: denominator = 0 at %d locations' % zero.sum())
-    ratio = np.where(bd != 0, bn / bd, 0.0)
+    nzero = np.count_nonzero(bd == 0)
+    if nzero > 0:
+        message('*** ERROR: denominator = 0 at %d locations' % nzero)
+    ratio = np.where(bd != 0, bn / bd, np.float32(0.0))
     ratio_masked = apply_mask(ratio, mask)
     return ratio_masked
 
@@ -56,10 +73,10 @@ def calc_ratio(bn, bd, mask):
 def calc_ndxi(b3, b4, mask):
     ndxi_num = b4 - b3
     ndxi_den = b3 + b4
-    zero = np.where(ndxi_den == 0, 1, 0)
-    if zero.sum() > 0:
-        message('*** ERROR: denominator = 0 at %d locations' % zero.sum())
-    ndxi = np.where(ndxi_den != 0, ndxi_num / ndxi_den, 0.0)
+    nzero = np.count_nonzero(ndxi_den == 0)
+    if nzero > 0:
+        message('*** ERROR: denominator = 0 at %d locations' % nzero)
+    ndxi = np.where(ndxi_den != 0, ndxi_num / ndxi_den, np.float32(0.0))
     ndxi_masked = apply_mask(ndxi, mask)
     return ndxi_masked
 
@@ -71,10 +88,10 @@ def calc_evi(b1, b3, b4, mask):
     L = 1.0
     evi_num = G * (b4 - b3)
     evi_den = b4 + C1 * b3 - C2 * b1 + L
-    zero = np.where(evi_den == 0, 1, 0)
-    if zero.sum() > 0:
-        message('*** ERROR: denominator = 0 at %d locations' % zero.sum())
-    evi = np.where(evi_den != 0, evi_num / evi_den, 0.0)
+    nzero = np.count_nonzero(evi_den == 0)
+    if nzero > 0:
+        message('*** ERROR: denominator = 0 at %d locations' % nzero)
+    evi = np.where(evi_den != 0, evi_num / evi_den, np.float32(0.0))
     evi_masked = apply_mask(evi, mask)
     return evi_masked
 
@@ -83,21 +100,20 @@ def calc_savi(b3, b4, mask):
     L = 0.5
     savi_num = (1 + L) * (b4 - b3)
     savi_den = b4 + b3 + L
-    zero = np.where(savi_den == 0, 1, 0)
-    if zero.sum() > 0:
-        message('*** ERROR: denominator = 0 at %d locations' % zero.sum())
-    savi = np.where(savi_den != 0, savi_num / savi_den, 0.0)
+    nzero = np.count_nonzero(savi_den == 0)
+    if nzero > 0:
+        message('*** ERROR: denominator = 0 at %d locations' % nzero)
+    savi = np.where(savi_den != 0, savi_num / savi_den, np.float32(0.0))
     savi_masked = apply_mask(savi, mask)
     return savi_masked
 
 
-def calc_rsr(b3, b4, b5, mask):
+def calc_rsr(b3, b4, b5, mask, b5_stats):
     sr = calc_ratio(b4, b3, mask)
-    b5_nan = np.where(mask == 0, np.nan, b5)
-    b5_nan_min = np.nanmin(b5_nan)
-    b5_nan_max = np.nanmax(b5_nan)
-    red_factor_den = b5_nan_max - b5_nan_min
-    red_factor_num = b5 - b5_nan_min
+    b5_min = np.float32(b5_stats[1])
+    b5_max = np.float32(b5_stats[2])
+    red_factor_den = b5_max - b5_min
+    red_factor_num = b5 - b5_min
     red_factor = 1 - (red_factor_num / red_factor_den)
     rsr = sr * red_factor
     rsr_masked = apply_mask(rsr, mask)
@@ -111,11 +127,10 @@ def calc_kttc_comp(c, b1, b2, b3, b4, b5, b7, mask):
     return kttc_comp_masked
 
 
-def calc_tcx(kttc_x, mask):
-    kttc_x_nan = np.where(mask == 0, np.nan, kttc_x)
-    kttc_x_mean = np.nanmean(kttc_x_nan)
-    kttc_x_std = np.nanstd(kttc_x_nan)
-    tcx = (kttc_x_nan - kttc_x_mean) / kttc_x_std
+def calc_tcx(kttc_x, mask, kttc_x_stats):
+    kttc_x_mean = np.float32(kttc_x_stats[3])
+    kttc_x_std = np.float32(stats_std(kttc_x_stats))
+    tcx = (kttc_x - kttc_x_mean) / kttc_x_std
     tcx_masked = apply_mask(tcx, mask)
     return tcx_masked
 
@@ -126,6 +141,158 @@ def calc_di(tcb, tcg, tcw, mask):
     return di_masked
 
 
+def index_stats(vi_names, vi_grids, mask):
+    """
+    accumulate summary statistics for masked level3 grids in one pass
+    """
+    grids = [('level3/%s' % vi_name, vi_grid, mask)
+             for vi_name, vi_grid in zip(vi_names, vi_grids)]
+    return scene_stats(grids)
+
+
+def calc_indices_numpy(b1, b2, b3, b4, b5, b7, mask, b5_stats):
+    """
+    calculate all vegetation indices with the NumPy functions above
+    """
+    message('-- simple ratio (SR)')
+    sr = calc_ratio(b4, b3, mask)
+    message('-- moisture stress index (MSI)')
+    msi = calc_ratio(b5, b4, mask)
+    message('-- normalized difference vegetation index (NDVI)')
+    ndvi = calc_ndxi(b3, b4, mask)
+    message('-- enhanced vegetation index (EVI)')
+    evi = calc_evi(b1, b3, b4, mask)
+    message('-- soil-adjusted vegetation index (SAVI)')
+    savi = calc_savi(b3, b4, mask)
+    message('-- reduced simple ratio (RSR)')
+    rsr = calc_rsr(b3, b4, b5, mask, b5_stats)
+    message('-- normalized difference infrared index (NDII)')
+    ndii = calc_ndxi(b5, b4, mask)
+    message('-- normalized burn ratio (NBR)')
+    nbr = calc_ndxi(b7, b4, mask)
+    message('-- KTTC brightness component (Bgt)')
+    kttc_bgt = calc_kttc_comp(kttc_bgt_coeffs, b1, b2, b3, b4, b5, b7, mask)
+    message('-- KTTC greenness component (Grn)')
+    kttc_grn = calc_kttc_comp(kttc_grn_coeffs, b1, b2, b3, b4, b5, b7, mask)
+    message('-- KTTC wetness component (Wet)')
+    kttc_wet = calc_kttc_comp(kttc_wet_coeffs, b1, b2, b3, b4, b5, b7, mask)
+    stats = index_stats(vi_names[:11], [sr, msi, ndvi, evi, savi, rsr, ndii,
+                                        nbr, kttc_bgt, kttc_grn, kttc_wet],
+                        mask)
+    message('-- Tasseled Cap normalized brightness (TCB)')
+    tcb = calc_tcx(kttc_bgt, mask, stats['level3/kttc_bgt'])
+    message('-- Tasseled Cap normalized greenness (TCG)')
+    tcg = calc_tcx(kttc_grn, mask, stats['level3/kttc_grn'])
+    message('-- Tasseled Cap normalized wetness (TCW)')
+    tcw = calc_tcx(kttc_wet, mask, stats['level3/kttc_wet'])
+    message('-- disturbance index (DI)')
+    di = calc_di(tcb, tcg, tcw, mask)
+    stats.update(index_stats(vi_names[11:], [tcb, tcg, tcw, di], mask))
+    return [sr, msi, ndvi, evi, savi, rsr, ndii, nbr, kttc_bgt, kttc_grn,
+            kttc_wet, tcb, tcg, tcw, di], stats
+
+
+if numba_available:
+    @njit(parallel=True, cache=True)
+    def fused_indices(b1, b2, b3, b4, b5, b7, mask, kttc_coeffs, out, nzero):
+        """
+        calculate SR, MSI, NDVI, EVI, SAVI, NDII, NBR and the three KTTC
+        components (out[0] through out[9], in that order) in one pass over
+        the pixels, with the same denominator guarding and -9999 fill as
+        the NumPy functions; zero denominators are counted per row in nzero
+        """
+        nrows, ncols = mask.shape
+        for j in prange(nrows):
+            for i in range(ncols):
+                x1 = b1[j, i]
+                x2 = b2[j, i]
+                x3 = b3[j, i]
+                x4 = b4[j, i]
+                x5 = b5[j, i]
+                x7 = b7[j, i]
+                # float32 arithmetic in the same order as the NumPy path
+                dens = (x3, x4, x3 + x4,
+                        x4 + np.float32(6.0) * x3 - np.float32(7.5) * x1 +
+                        np.float32(1.0),
+                        x4 + x3 + np.float32(0.5), x5 + x4, x7 + x4)
+                for k in range(7):
+                    if dens[k] == 0:
+                        nzero[j, k] += 1
+                if mask[j, i] != 1:
+                    for k in range(10):
+                        out[k, j, i] = -9999.0
+                    continue
+                nums = (x4, x5, x4 - x3, np.float32(2.5) * (x4 - x3),
+                        np.float32(1.5) * (x4 - x3), x4 - x5, x4 - x7)
+                for k in range(7):
+                    if dens[k] != 0:
+                        out[k, j, i] = nums[k] / dens[k]
+                    else:
+                        out[k, j, i] = 0.0
+                for k in range(3):
+                    out[7 + k, j, i] = kttc_coeffs[k, 0] * x1 + \
+                        kttc_coeffs[k, 1] * x2 + kttc_coeffs[k, 2] * x3 + \
+                        kttc_coeffs[k, 3] * x4 + kttc_coeffs[k, 4] * x5 + \
+                        kttc_coeffs[k, 5] * x7
+        return
+
+    @njit(parallel=True, cache=True)
+    def fused_normalized(sr, b5, kttc, mask, b5_min, b5_max, kttc_mean,
+                         kttc_std, out):
+        """
+        calculate RSR, TCB, TCG, TCW and DI (out[0] through out[4], in that
+        order) in one pass over the pixels, given scene-wide band 5 extremes
+        and KTTC component means/standard deviations
+        """
+        nrows, ncols = mask.shape
+        for j in prange(nrows):
+            for i in range(ncols):
+                if mask[j, i] != 1:
+                    for k in range(5):
+                        out[k, j, i] = -9999.0
+                    continue
+                red_factor = 1.0 - (b5[j, i] - b5_min) / (b5_max - b5_min)
+                out[0, j, i] = sr[j, i] * red_factor
+                for k in range(3):
+                    out[1 + k, j, i] = \
+                        (kttc[k, j, i] - kttc_mean[k]) / kttc_std[k]
+                out[4, j, i] = out[1, j, i] - (out[2, j, i] + out[3, j, i])
+        return
+
+
+def calc_indices_numba(b1, b2, b3, b4, b5, b7, mask, b5_stats):
+    """
+    calculate all vegetation indices with the fused numba kernels
+    """
+    nrows, ncols = np.shape(mask)
+    kttc_coeffs = np.array([kttc_bgt_coeffs, kttc_grn_coeffs,
+                            kttc_wet_coeffs], dtype=np.float32)
+    message('-- SR, MSI, NDVI, EVI, SAVI, NDII, NBR, KTTC Bgt/Grn/Wet')
+    out1 = np.empty((10, nrows, ncols), dtype=np.float32)
+    nzero = np.zeros((nrows, 7), dtype=np.int64)
+    fused_indices(b1, b2, b3, b4, b5, b7, mask, kttc_coeffs, out1, nzero)
+    for k, vi_name in enumerate(['SR', 'MSI', 'NDVI', 'EVI', 'SAVI', 'NDII',
+                                 'NBR']):
+        if nzero[:, k].sum() > 0:
+            message('*** ERROR: %s denominator = 0 at %d locations' %
+                    (vi_name, nzero[:, k].sum()))
+    stats = index_stats(['sr', 'msi', 'ndvi', 'evi', 'savi', 'ndii', 'nbr',
+                         'kttc_bgt', 'kttc_grn', 'kttc_wet'], out1, mask)
+    message('-- RSR, TCB, TCG, TCW, DI')
+    kttc_mean = np.zeros(3, dtype=np.float32)
+    kttc_std = np.zeros(3, dtype=np.float32)
+    for k, kttc_name in enumerate(['kttc_bgt', 'kttc_grn', 'kttc_wet']):
+        kttc_mean[k] = stats['level3/%s' % kttc_name][3]
+        kttc_std[k] = stats_std(stats['level3/%s' % kttc_name])
+    out2 = np.empty((5, nrows, ncols), dtype=np.float32)
+    fused_normalized(out1[0], b5, out1[7:10], mask, np.float32(b5_stats[1]),
+                     np.float32(b5_stats[2]), kttc_mean, kttc_std, out2)
+    stats.update(index_stats(['rsr', 'tcb', 'tcg', 'tcw', 'di'], out2, mask))
+    return [out1[0], out1[1], out1[2], out1[3], out1[4], out2[0], out1[5],
+            out1[6], out1[7], out1[8], out1[9], out2[1], out2[2], out2[3],
+            out2[4]], stats
+
+
 # KTTC component coefficients for Landsat TM/ETM+ surface reflectance values
 #   from Crist [1985]
 kttc_bgt_coeffs = [0.2043, 0.4158, 0.5524, 0.5741, 0.3124, 0.2303]
@@ -133,11 +300,33 @@ kttc_grn_coeffs = [-0.1603, -0.2819, -0.4934, 0.7940, -0.0002, -0.1446]
 kttc_wet_coeffs = [0.0315, 0.2021, 0.3102, 0.1594, -0.6806, -0.6109]
 
 
+# level3 grid names, in the order returned by calc_indices_*()
+vi_names = ['sr', 'msi', 'ndvi', 'evi', 'savi', 'rsr', 'ndii', 'nbr',
+            'kttc_bgt', 'kttc_grn', 'kttc_wet', 'tcb', 'tcg', 'tcw', 'di']
+
+
+# fixed histogram bins for level3 grids (ranges are in Scene_Stats)
+vi_hist_nbins = 256
+
+
 message(' ')
 message('process_L57_06.py started at %s' %
         datetime.datetime.now().isoformat())
 message(' ')
 #
+if len(sys.argv) < 5:
+    save_histograms = 0
+else:
+    save_histograms = int(sys.argv[4])
+#
+if len(sys.argv) < 4:
+    backend = 'numba'
+else:
+    backend = sys.argv[3].lower()
+if backend == 'numba' and not numba_available:
+    message('NOTE: numba is not available, using NumPy calculations')
+    backend = 'numpy'
+#
 if len(sys.argv) < 3:
     message('input error: expected scene number')
     sys.exit(1)
@@ -168,42 +357,27 @@ with hdf.File(scene_path, 'r') as h5file:
     b4_refl = np.copy(h5file['level2/b4_refl_scswmask'])
     b5_refl = np.copy(h5file['level2/b5_refl_scswmask'])
     b7_refl = np.copy(h5file['level2/b7_refl_scswmask'])
-    scswmask = np.copy(h5file['masks/scswmask'])
+    scswmask = np.array(h5file['masks/scswmask'], dtype=np.uint8)
+    b5_stats = read_stats(h5file, 'level2/b5_refl_scswmask')
+if b5_stats is None:
+    b5_stats = scene_stats([('b5', b5_refl, scswmask)])['b5']
 #
-message('- calculating various vegetation indices and applying mask')
-message('-- simple ratio (SR)')
-sr = calc_ratio(b4_refl, b3_refl, scswmask)
-message('-- moisture stress index (MSI)')
-msi = calc_ratio(b5_refl, b4_refl, scswmask)
-message('-- normalized difference vegetation index (NDVI)')
-ndvi = calc_ndxi(b3_refl, b4_refl, scswmask)
-message('-- enhanced vegetation index (EVI)')
-evi = calc_evi(b1_refl, b3_refl, b4_refl, scswmask)
-message('-- soil-adjusted vegetation index (SAVI)')
-savi = calc_savi(b3_refl, b4_refl, scswmask)
-message('-- reduced simple ratio (RSR)')
-rsr = calc_rsr(b3_refl, b4_refl, b5_refl, scswmask)
-message('-- normalized difference infrared index (NDII)')
-ndii = calc_ndxi(b5_refl, b4_refl, scswmask)
-message('-- normalized burn ratio (NBR)')
-nbr = calc_ndxi(b7_refl, b4_refl, scswmask)
-message('-- KTTC brightness component (Bgt)')
-kttc_bgt = calc_kttc_comp(kttc_bgt_coeffs, b1_refl, b2_refl, b3_refl,
-                          b4_refl, b5_refl, b7_refl, scswmask)
-message('-- KTTC greenness component (Grn)')
-kttc_grn = calc_kttc_comp(kttc_grn_coeffs, b1_refl, b2_refl, b3_refl,
-                          b4_refl, b5_refl, b7_refl, scswmask)
-message('-- KTTC wetness component (Wet)')
-kttc_wet = calc_kttc_comp(kttc_wet_coeffs, b1_refl, b2_refl, b3_refl,
-                          b4_refl, b5_refl, b7_refl, scswmask)
-message('-- Tasseled Cap normalized brightness (TCB)')
-tcb = calc_tcx(kttc_bgt, scswmask)
-message('-- Tasseled Cap normalized greenness (TCG)')
-tcg = calc_tcx(kttc_grn, scswmask)
-message('-- Tasseled Cap normalized wetness (TCW)')
-tcw = calc_tcx(kttc_wet, scswmask)
-message('-- disturbance index (DI)')
-di = calc_di(tcb, tcg, tcw, scswmask)
+message('- calculating various vegetation indices and applying mask (%s)' %
+        backend)
+if backend == 'numba':
+    calc_indices = calc_indices_numba
+else:
+    calc_indices = calc_indices_numpy
+vi_grids, stats = calc_indices(b1_refl, b2_refl, b3_refl, b4_refl, b5_refl,
+                               b7_refl, scswmask, b5_stats)
+sr, msi, ndvi, evi, savi, rsr, ndii, nbr, kttc_bgt, kttc_grn, kttc_wet, \
+    tcb, tcg, tcw, di = vi_grids
+if save_histograms:
+    message('- accumulating vegetation index histograms')
+    vi_hists = [scene_hist(vi_grid, scswmask, vi_hist_nbins,
+                           vi_hist_ranges[vi_name][0],
+                           vi_hist_ranges[vi_name][1])
+                for vi_name, vi_grid in zip(vi_names, vi_grids)]
 #
 # save all calculated fields to h5 file
 message('- saving calculation results to %s' % scene_file)
@@ -250,6 +424,13 @@ with hdf.File(scene_path, 'r+') as h5file:
     h5file.create_dataset('level3/di', data=di, dtype=np.float32,
                           compression='gzip')
     message('-- saved masked DI (level 3)')
+    save_stats(h5file, stats)
+    message('-- saved %d vegetation index statistics' % len(stats))
+    if save_histograms:
+        for vi_name, vi_hist in zip(vi_names, vi_hists):
+            save_hist(h5file, 'level3/%s' % vi_name, vi_hist,
+                      vi_hist_ranges[vi_name][0], vi_hist_ranges[vi_name][1])
+        message('-- saved %d vegetation index histograms' % len(vi_hists))
 h5file.close()
 message(' ')
 #
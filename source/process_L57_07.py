@@ -16,6 +16,8 @@ PURPOSE: Create forest masks based on NLCD datasets
 DEPENDENCIES: h5py, numpy
 
 USAGE: '$ python process_L57_07.py ./P26R27'
+       '$ python process_L57_07.py ./P26R27 8' to process scenes with 8
+         worker processes
 
 INPUT: Outputs of process_L57_02.py and process_L57_05.py
 
@@ -26,6 +28,7 @@ OUTPUT:
 import sys
 import datetime
 import glob
+import multiprocessing as mp
 import h5py as hdf
 import numpy as np
 
@@ -39,6 +42,74 @@ def message(char_string):
     return
 
 
+def forest_lut():
+    """
+    256-entry lookup table from NLCD land cover codes to forest class bits
+    """
+    lut = np.zeros(256, dtype=np.uint8)
+    lut[41] = forest_bits['deciduous']
+    lut[42] = forest_bits['evergreen']
+    lut[43] = forest_bits['mixed']
+    # wooded wetlands designation in NLCD 1992 product
+    lut[91] = forest_bits['wetlands']
+    # wooded wetlands designation in NLCD 2001, 2006, 2011 products
+    lut[90] = forest_bits['wetlands']
+    return lut
+
+
+def classify_landcover(lcmap, lut):
+    """
+    generate forest masks from a land cover map with one table lookup
+    """
+    # lc_clip is stored as int8, so codes > 127 (e.g. 255) come back negative
+    lcbits = lut[lcmap.astype(np.uint8)]
+    masks = {}
+    for name, bit in forest_bits.items():
+        masks[name] = ((lcbits & bit) > 0).astype(np.uint8)
+    masks['all'] = (lcbits > 0).astype(np.uint8)
+    return masks
+
+
+def save_scene_masks(scene_path):
+    """
+    combine one scene's scswmask with the forest masks for its NLCD year and
+    the union mask, and save everything to the scene file in one write pass
+    (runs in worker processes; uses forest_masks and mask_union set up in
+    the main process before the pool is started)
+    """
+    with hdf.File(scene_path, 'r+') as h5file:
+        scswmask = np.array(h5file['masks/scswmask'], dtype=np.uint8)
+        lc_year = int(np.copy(h5file['nlcd/meta/year']))
+        masks = dict(forest_masks[lc_year])
+        masks['union'] = mask_union
+        combined = {}
+        for name, tag in [('deciduous', 'd'), ('evergreen', 'e'),
+                          ('mixed', 'm'), ('wetlands', 'w'), ('all', 'f'),
+                          ('union', 'u')]:
+            combined['scsw%smask' % tag] = scswmask * masks[name]
+        del h5file['meta/last_updated']
+        h5file.create_dataset('meta/last_updated',
+                              data=datetime.datetime.now().isoformat())
+        del h5file['meta/at']
+        h5file.create_dataset('meta/at', data='process_L57_07 (forest masks)')
+        if 'forest' in h5file['masks'].keys():
+            del h5file['masks/forest']
+        for name in sorted(masks.keys()):
+            h5file.create_dataset('masks/forest/%s' % name, data=masks[name],
+                                  dtype=np.int8, compression='gzip')
+        for name in sorted(combined.keys()):
+            if name in h5file['masks'].keys():
+                del h5file['masks/%s' % name]
+            h5file.create_dataset('masks/%s' % name, data=combined[name],
+                                  dtype=np.int8, compression='gzip')
+    return lc_year, np.sum(masks['all']), np.sum(combined['scswfmask']), \
+        np.sum(combined['scswumask'])
+
+
+# forest class bits in the NLCD lookup table
+forest_bits = {'deciduous': 1, 'evergreen': 2, 'mixed': 4, 'wetlands': 8}
+
+
 message(' ')
 message('process_L57_07.py started at %s' %
         datetime.datetime.now().isoformat())
@@ -55,111 +126,57 @@ h5list = sorted(glob.glob('%s/*_clipped.h5' % path))
 message('found %d Landsat files' % len(h5list))
 message(' ')
 #
-for i, scene_path in enumerate(h5list):
-    path_parts = scene_path.split('/')
-    scene_file = path_parts[-1]
-    message('extracting fields from %s' % scene_file)
+if len(sys.argv) < 3:
+    nprocs = 1
+else:
+    nprocs = int(sys.argv[2])
+#
+# NLCD year of each scene (small reads only)
+message('collecting land cover years')
+scene_years = []
+for scene_path in h5list:
+    with hdf.File(scene_path, 'r') as h5file:
+        scene_years.append(int(np.copy(h5file['nlcd/meta/year'])))
+#
+# generate forest masks once per NLCD year, and the union mask from those
+lut = forest_lut()
+forest_masks = {}
+for lc_year in sorted(set(scene_years)):
+    scene_path = h5list[scene_years.index(lc_year)]
+    message('generating masks from %d land cover map in %s' %
+            (lc_year, scene_path.split('/')[-1]))
     with hdf.File(scene_path, 'r') as h5file:
-        ndii = np.copy(h5file['level3/ndii'])
-        scswmask = np.copy(h5file['masks/scswmask'])
         lcmap = np.copy(h5file['nlcd/lc_clip'])
-    #
-    # generate forest mask from land cover map
-    message('generating masks from available land cover map')
-    mask_deciduous = np.where(lcmap == 41, 1, 0)
-    mask_evergreen = np.where(lcmap == 42, 1, 0)
-    mask_mixed = np.where(lcmap == 43, 1, 0)
-    # wooded wetlands designation in NLCD 1992 product
-    mask_wetlands_1992 = np.where(lcmap == 91, 1, 0)
-    # wooded wetlands designation in NLCD 2001, 2006, 2011 products
-    mask_wetlands_2001 = np.where(lcmap == 90, 1, 0)
-    mask_wetlands = np.logical_or(mask_wetlands_1992, mask_wetlands_2001)
-    mask_all = mask_deciduous + mask_evergreen + mask_mixed + mask_wetlands
-    message('- all-forest mask allows %d pixels' % np.sum(mask_all))
-    scswdmask = scswmask * mask_deciduous
-    scswemask = scswmask * mask_evergreen
-    scswmmask = scswmask * mask_mixed
-    scswwmask = scswmask * mask_wetlands
-    scswfmask = scswmask * mask_all
-    message('- complete all-forest mask allows %d pixels' % scswfmask.sum())
-    if i == 0:
-        mask_union = mask_all
+    forest_masks[lc_year] = classify_landcover(lcmap, lut)
+    message('- all-forest mask allows %d pixels' %
+            np.sum(forest_masks[lc_year]['all']))
+    if len(forest_masks) == 1:
+        mask_union = np.copy(forest_masks[lc_year]['all'])
     else:
-        mask_union = np.logical_or(mask_union, mask_all)
-    #
-    message('saving forest masks to %s' % scene_file)
-    with hdf.File(scene_path, 'r+') as h5file:
-        del h5file['meta/last_updated']
-        h5file.create_dataset('meta/last_updated',
-                              data=datetime.datetime.now().isoformat())
-        del h5file['meta/at']
-        h5file.create_dataset('meta/at', data='process_L57_07 (forest masks)')
-        message('- saved processing metadata items')
-        if 'forest' in h5file['masks'].keys():
-            del h5file['masks/forest']
-        h5file.create_dataset('masks/forest/deciduous', data=mask_deciduous,
-                              dtype=np.int8, compression='gzip')
-        h5file.create_dataset('masks/forest/evergreen', data=mask_evergreen,
-                              dtype=np.int8, compression='gzip')
-        h5file.create_dataset('masks/forest/mixed', data=mask_mixed,
-                              dtype=np.int8, compression='gzip')
-        h5file.create_dataset('masks/forest/wetlands', data=mask_wetlands,
-                              dtype=np.int8, compression='gzip')
-        h5file.create_dataset('masks/forest/all', data=mask_all,
-                              dtype=np.int8, compression='gzip')
-        message('- saved 5 forest land cover masks')
-        if 'scswdmask' in h5file['masks'].keys():
-            del h5file['masks/scswdmask']
-        h5file.create_dataset('masks/scswdmask', data=scswdmask,
-                              dtype=np.int8, compression='gzip')
-        if 'scswemask' in h5file['masks'].keys():
-            del h5file['masks/scswemask']
-        h5file.create_dataset('masks/scswemask', data=scswemask,
-                              dtype=np.int8, compression='gzip')
-        if 'scswmmask' in h5file['masks'].keys():
-            del h5file['masks/scswmmask']
-        h5file.create_dataset('masks/scswmmask', data=scswmmask,
-                              dtype=np.int8, compression='gzip')
-        if 'scswwmask' in h5file['masks'].keys():
-            del h5file['masks/scswwmask']
-        h5file.create_dataset('masks/scswwmask', data=scswwmask,
-                              dtype=np.int8, compression='gzip')
-        if 'scswfmask' in h5file['masks'].keys():
-            del h5file['masks/scswfmask']
-        h5file.create_dataset('masks/scswfmask', data=scswfmask,
-                              dtype=np.int8, compression='gzip')
-        message('- saved 5 combined masks')
-    message(' ')
-#
-message('union mask over all years allows %d pixels' % mask_union.sum())
+        mask_union |= forest_masks[lc_year]['all']
+message('union mask over %d land cover years allows %d pixels' %
+        (len(forest_masks), mask_union.sum()))
 message(' ')
 #
-for scene_path in h5list:
-    path_parts = scene_path.split('/')
-    scene_file = path_parts[-1]
-    message('adding union mask to %s' % scene_file)
-    with hdf.File(scene_path, 'r+') as h5file:
-        scswmask = np.copy(h5file['masks/scswmask'])
-        scswumask = scswmask * mask_union
-        message('- complete union mask allows %d pixels' % scswumask.sum())
-        del h5file['meta/last_updated']
-        h5file.create_dataset('meta/last_updated',
-                              data=datetime.datetime.now().isoformat())
-        del h5file['meta/at']
-        h5file.create_dataset('meta/at',
-                              data='process_L57_07 (forest union mask)')
-        message('- saved processing metadata items')
-        if 'union' in h5file['masks/forest'].keys():
-            del h5file['masks/forest/union']
-        h5file.create_dataset('masks/forest/union', data=mask_union,
-                              dtype=np.int8, compression='gzip')
-        message('- saved 1 forest land cover mask')
-        if 'scswumask' in h5file['masks'].keys():
-            del h5file['masks/scswumask']
-        h5file.create_dataset('masks/scswumask', data=scswumask,
-                              dtype=np.int8, compression='gzip')
-        message('- saved 1 combined union mask')
-    message(' ')
+message('saving forest and combined masks to %d files (%d processes)' %
+        (len(h5list), nprocs))
+if nprocs > 1:
+    pool = mp.Pool(nprocs)
+    results = pool.imap(save_scene_masks, h5list)
+else:
+    pool = None
+    results = (save_scene_masks(scene_path) for scene_path in h5list)
+for scene_path, result in zip(h5list, results):
+    lc_year, all_npix, scswf_npix, scswu_npix = result
+    message('- %s (%d land cover): all-forest mask allows %d pixels' %
+            (scene_path.split('/')[-1], lc_year, all_npix))
+    message('-- complete all-forest mask allows %d pixels' % scswf_npix)
+    message('-- complete union mask allows %d pixels' % scswu_npix)
+    message('-- saved 6 forest land cover masks and 6 combined masks')
+if pool is not None:
+    pool.close()
+    pool.join()
+message(' ')
 #
 message('process_L57_07.py completed at %s' %
         datetime.datetime.now().isoformat())
@@ -11,17 +11,149 @@ Send questions, bug reports, any related requests to matt.e.garcia@gmail.com
 See also 'README.md', 'DISCLAIMER.txt', 'ACKNOWLEDGEMENTS.txt'
 Treat others as you would be treated. Pay it forward. Valar dohaeris.
 
-PURPOSE: Calculate VI statistics over a user-specified period
+PURPOSE: Calculate VI statistics over a user-specified period, for one or
+         more VIs and percentiles in a single pass over the scene files
 
 DEPENDENCIES: h5py, numpy
+              mpi4py (optional) to share the tiles among MPI ranks
+              Stack_Stats, Scene_Stats and Chunk_Store depend on numpy
 
-USAGE: '$ python process_L57_08.py ./P26R27'
+USAGE: '$ python process_L57_08.py ./P26R27 p026r027 1984 2013 NDII 90'
+       or, for several VIs and percentiles from the same reads,
+       '$ python process_L57_08.py ./P26R27 p026r027 1984 2013 \
+            NDVI,NDII,NBR 50,75,90'
+       (one output file per VI, each with all of the percentile grids)
+       with options
+       '--max-memory 8GB' to limit the memory used by the tiles in progress
+       '--no-cube' to skip writing the VI datacube to the output file
+       '--cube-layout time' to chunk the datacube for time series access
+           (all scenes x 64 x 64 pixels) instead of by scene
+       '--quantiles sketch' to estimate the percentile and median grids from
+           per-pixel fixed-bin histograms instead of exact sorting
+       '--sketch-bins 100' to set the number of histogram bins
+       '--workers 8' to evaluate tiles in 8 parallel processes (default 1)
+       '--append' to add scenes that are not yet in existing output files
+       '--cube-storage sparse' to store the datacube as (time, union pixel)
+           values with their flat grid locations in 'pixel_index'
+       '--doy 150-250' and/or '--months 6-8' to use only scenes acquired in
+           a seasonal window (comma-separated days/months and ranges; a
+           range like '330-60' wraps around the end of the year)
+       '--year-summaries' to also keep per-pixel summaries for each year,
+           for tools/year_range_stats.py
+       '--resume' to finish the tiles left undone by an interrupted run
+           (or start over if there are none)
+       '--output-format zarr' to write each VI's grids and datacube to a
+           directory store (<...>_grids.zarr) instead of an hdf5 file
+       '--mpi' to share the tiles among the ranks of an MPI job, e.g.
+           '$ mpirun -n 4 python process_L57_08.py ./P26R27 p026r027 \
+                1984 2013 NDVI,NDII,NBR 50,75,90 --mpi'
 
-NOTE: The datacube approach takes a LOT of memory, 72GB for the P26R27
-      footprint with 202 images (other footprints will have more...). It's
-      almost certain that you should only run this script on a cluster with
-      at least 96GB installed RAM, and then still run it alone (no other
-      scripts at the same time).
+NOTE: The full datacube would take a LOT of memory, 36GB (float32) for the
+      P26R27 footprint with 202 images (other footprints will have more...).
+      Instead, the stack is processed in spatial tiles (bands of rows) that
+      are read from every scene, evaluated and written before moving on, so
+      peak memory is set by --max-memory rather than by the number of
+      scenes. Give the job a bit more than --max-memory (e.g. an 11GB slot
+      for --max-memory 10GB, as measured by tests/test_memory_budget.py).
+      With --max-memory larger than the whole cube there is a single tile,
+      as before.
+
+      With '--quantiles sketch' each scene is read once and added to
+      per-pixel histograms over (0, vmax] of the VI's range (vi_hist_ranges
+      in Scene_Stats) plus exact count/mean/M2/max, so the memory per pixel
+      depends on the number of bins, not the number of scenes. nvals, mean,
+      std and max are still exact; percentiles and median are within one bin
+      width (vmax / nbins, 0.01 for NDII with 100 bins) of the exact values
+      for values inside the range.
+
+      With '--workers N' the tiles are handed out to a pool of N processes.
+      The union mask and output grids live in shared memory (RawArray), so
+      nothing large is pickled: each worker opens the scene files itself,
+      writes its statistics straight into the shared output grids, and
+      leaves its masked VI tile in one of N + 1 shared cube slots, while the
+      main process saves finished tiles to the tile files. The memory
+      limit covers all workers together.
+
+      The default 'scene' cube layout (one scene by a band of rows per
+      chunk) suits reading whole grids; '--cube-layout time' puts each
+      pixel's full time series in one chunk and rounds the tiles to whole
+      chunk rows, for per-pixel and per-tile temporal analyses. Open the
+      cube with the chunk cache from Stack_Stats.cube_cache() (or see
+      tools/rechunk_cube.py to convert an existing file).
+
+      With '--append' only the scenes whose dates are not already in the
+      output file(s) are read. The existing file for the same footprint, VI
+      and first year with the latest last year (up to year_end) is only
+      read: the new scenes are appended to the (resizable) datacube and
+      'dates' of a copy of it, which replaces it under the name for the new
+      year range once the append is complete. In sketch mode the persisted
+      per-pixel histograms and moments ('<vi>_sketch', '<vi>_moments', one
+      row per union mask pixel in flat index order) are updated from the
+      new scenes alone, so adding 10 scenes to a 200-scene stack costs about
+      5% of a full run. Exact percentiles need all of the values, so exact mode
+      appends read the old values back from the datacube (which must have
+      been written). Appends run tile by tile in this process.
+
+      Statistics are only needed at union mask pixels, and scswumask is 0
+      everywhere else, so tiles are kept in memory as (scene, union pixel)
+      float32 values. '--cube-storage sparse' writes the datacube the same
+      way, as a (time, npix) '<vi>_cube' plus 'pixel_index'; use
+      Stack_Stats.scatter_pixels() to make 2-D grids from it. For footprints
+      with 40-60% forest cover that is about half the size of the dense cube.
+
+      Seasonal windows are applied to the dates in the scene file names
+      before any file is opened, so skipped scenes cost nothing. The window
+      is recorded in 'meta/doy_window' and 'meta/month_window' and tagged
+      in the output file name, e.g. 1984-2013_p026r027_ndii_doy150-250_grids.h5
+
+      With '--year-summaries' each output file also gets a '<vi>_years'
+      group with one layer per year of per-pixel count, sum, sumsq and max
+      (one column per union mask pixel, as in '<vi>_sketch') and a 'hist'
+      of --sketch-bins bins over 'hist_range'. Unlike the Welford moments,
+      these simply add up, so tools/year_range_stats.py can make the usual
+      statistics grids for any run of years (e.g. 1990-1999, or a rolling
+      10-year window) from the layers alone, with the sketch mode accuracy.
+      Appends add to the layers of the years that get new scenes.
+
+      Each output file is made as a work copy (<...>_grids.h5.part) that
+      is renamed into place only once it is complete, so an interrupted run
+      never leaves a half-written output file behind, and never changes the
+      file that it appends to. Until then, each finished tile is kept in a
+      small hdf5 file of its own in a tile directory (<...>_grids.h5.tiles,
+      with the settings of the run), written under a temporary name and
+      renamed once it is complete, and the work copy is made from the tile
+      files at the end. With '--resume', a run for the same scenes goes on
+      from the tiles missing from its tile directories, with the same tile
+      rows and settings, so a preempted or evicted HTCondor job only loses
+      the tiles in progress. A tile file that cannot be read is done again;
+      settings that cannot be read (or do not match) start the run over. An
+      interrupted append is always resumed by the next '--append' run with
+      the same scenes. The price is that every tile is written twice, and
+      an append copies the existing file.
+
+      An hdf5 file can only have one writer, so all output goes through the
+      main process. With '--output-format zarr' the same datasets and
+      metadata go to a chunk-per-file directory store instead (see
+      Chunk_Store, readable by Zarr and xarray), where each chunk file is
+      replaced in one step. The statistics grids are chunked by tile, so
+      with '--workers N' each worker writes its own tiles of the grids (and
+      of a dense datacube whose chunk rows fit the tiles) straight to the
+      work copy of the store, and only the tile files and the other
+      datasets go through the main process. The tile files still hold
+      every tile's grid and cube rows, so a resumed run can use another
+      number of workers or a new store. tools/convert_grids.py converts
+      between the two formats.
+
+      With '--mpi' the tiles are dealt out to the MPI ranks in turn (one
+      process per rank, with --max-memory per rank). Every rank reads only
+      its own tiles' rows from the scene files, evaluates them as above and
+      saves them to the tile directories itself (which all ranks need to
+      see), so no tile results are sent between ranks; once every rank is
+      done, rank 0 makes the output files from the tile files, so the
+      output is the same as from a single process. With '--output-format
+      zarr' every rank writes its own tiles of the grids straight to the
+      stores. An error in any rank ends the whole MPI job. Appends run in
+      rank 0 only.
 
 INPUT: Outputs of process_L57_06.py and process_L57_07.py
 
@@ -29,11 +161,22 @@ OUTPUT:
 """
 
 
+import os
 import sys
 import datetime
+import argparse
 import glob
+import shutil
+import multiprocessing as mp
 import h5py as hdf
 import numpy as np
+from Stack_Stats import eval_stats_block, parse_memory, \
+    tile_rows_for_memory, exact_pixel_bytes, sketch_pixel_bytes, \
+    sketch_dtype, sketch_update, eval_stats_sketch, cube_chunks, cube_tile, \
+    sparse_cube_chunks, union_pixel_index, scatter_pixels, sums_update, \
+    date_strings
+from Scene_Stats import vi_hist_ranges
+from Chunk_Store import open_store, is_store
 
 
 def message(char_string):
@@ -45,30 +188,552 @@ def message(char_string):
     return
 
 
-def eval_stats(vals, q):
-    exclude = np.argwhere(vals <= 0.0)
-    if len(exclude) > 0:
-        vals = np.delete(vals, exclude)
-    nvals = len(vals)
-    if nvals == 0:
-        qval = 0.0
-        median = 0.0
-        mean = 0.0
-        std = 0.0
-        maximum = 0.0
-    elif nvals == 1:
-        qval = vals[0]
-        median = vals[0]
-        mean = vals[0]
-        std = 0.0
-        maximum = vals[0]
+def shared_array(shape, dtype):
+    """
+    zeroed numpy array in shared memory, which worker processes started
+    after it is made can read and write without pickling
+    """
+    nvals = int(np.prod(shape))
+    nbytes = max(nvals * np.dtype(dtype).itemsize, 1)
+    return np.frombuffer(mp.RawArray('b', nbytes), dtype=dtype,
+                         count=nvals).reshape(shape)
+
+
+def parse_window(window, vmax):
+    """
+    set of allowed values (1 to vmax) in a window string of comma-separated
+    values and ranges, e.g. '150-250' or '12,1-2'; a range whose start is
+    after its end wraps around, e.g. '330-60'
+    """
+    allowed = set()
+    for part in window.split(','):
+        bounds = [int(bound) for bound in part.split('-')]
+        if len(bounds) == 1:
+            allowed.add(bounds[0])
+        elif bounds[0] <= bounds[1]:
+            allowed.update(range(bounds[0], bounds[1] + 1))
+        else:
+            allowed.update(range(bounds[0], vmax + 1))
+            allowed.update(range(1, bounds[1] + 1))
+    return allowed
+
+
+def is_outfile(file_path, vi_name):
+    """
+    whether a file is an output file of this script for a VI, with its
+    dates and union mask, and its sketches if it was made with them
+    """
+    try:
+        h5outfile = open_grids(file_path, 'r')
+    except (IOError, OSError):
+        return False
+    try:
+        needed = ['dates', 'union_mask', '%s_nvals' % vi_name]
+        if file_settings(h5outfile, vi_name)[0]:
+            needed.append('%s_sketch' % vi_name)
+        return all([datapath in h5outfile for datapath in needed])
+    except (IOError, OSError, KeyError, ValueError):
+        return False
+    finally:
+        h5outfile.close()
+
+
+def find_outfile(vi_name):
+    """
+    existing output file for a VI to append to: the one for this year
+    range, or else the one with the same first year and the latest last
+    year before year_end (None if there is neither); files of the same
+    name that this script did not make are passed over
+    """
+    outfile = '%s/%d-%d_%s_%s%s_grids%s' % \
+        (path, year_begin, year_end, footprint, vi_name, window_tag,
+         grids_ext)
+    if os.path.exists(outfile) and is_outfile(outfile, vi_name):
+        return outfile
+    candidates = []
+    for file_path in glob.glob('%s/%d-*_%s_%s%s_grids%s' %
+                               (path, year_begin, footprint, vi_name,
+                                window_tag, grids_ext)):
+        file_year_end = int(file_path.split('/')[-1][5:9])
+        if file_year_end < year_end and is_outfile(file_path, vi_name):
+            candidates.append((file_year_end, file_path))
+    if len(candidates) == 0:
+        return None
+    return sorted(candidates)[-1][1]
+
+
+def file_settings(h5outfile, vi_name):
+    """
+    quantile method, sketch bins, datacube and per-year summary settings
+    that an existing output file was made with
+    """
+    if 'meta/quantiles' in h5outfile:
+        file_sketch = \
+            date_strings([h5outfile['meta/quantiles'][()]])[0] == 'sketch'
+    else:
+        file_sketch = False
+    file_bins = sketch_bins
+    if file_sketch:
+        file_bins = int(h5outfile['meta/sketch_bins'][()])
+    file_years = '%s_years/years' % vi_name in h5outfile
+    if file_years:
+        file_bins = h5outfile['%s_years/hist' % vi_name].shape[2]
+    file_cube = '%s_cube' % vi_name in h5outfile
+    file_sparse = sparse_cube
+    if file_cube:
+        file_sparse = h5outfile['%s_cube' % vi_name].ndim == 2
+    return file_sketch, file_bins, file_cube, file_sparse, file_years
+
+
+def remove_output(file_path):
+    """ delete an hdf5 file or a directory store, if it is there """
+    if os.path.isdir(file_path):
+        shutil.rmtree(file_path)
+    elif os.path.exists(file_path):
+        os.remove(file_path)
+    return
+
+
+def replace_output(work_path, outfile):
+    """
+    put a finished work copy in place of an output file: an hdf5 file is
+    renamed over the old one in one step, a directory store replaces the
+    old one as soon as that is moved aside
+    """
+    if os.path.isdir(work_path) and os.path.exists(outfile):
+        remove_output('%s.old' % outfile)
+        os.rename(outfile, '%s.old' % outfile)
+        os.rename(work_path, outfile)
+        remove_output('%s.old' % outfile)
+    else:
+        os.rename(work_path, outfile)
+    return
+
+
+def start_checkpoint(vi_name):
+    """
+    (re)start the tile directory of a VI's output file with the settings
+    of this run, which tile files are added to as tiles are finished
+    """
+    tile_dir = tile_dirs[vi_name]
+    if os.path.isdir(tile_dir):
+        shutil.rmtree(tile_dir)
+    os.makedirs(tile_dir)
+    settings_path = '%s/settings.h5' % tile_dir
+    with hdf.File(settings_path + '.tmp', 'w') as h5file:
+        h5file.create_dataset('dates', data=','.join(old_dates + dates_all))
+        h5file.create_dataset('old_outfile',
+                              data=old_outfiles.get(vi_name, ''))
+        h5file.create_dataset('union_mask', data=union_mask, dtype=np.uint8,
+                              compression='gzip')
+        h5file.create_dataset('pctiles', data=pctiles)
+        h5file.create_dataset('tile_rows', data=tile_rows)
+        h5file.create_dataset('cube_layout', data=cube_layout)
+        h5file.create_dataset('settings',
+                              data=[int(use_sketch), sketch_bins,
+                                    int(write_cube), int(sparse_cube),
+                                    int(year_summaries)])
+    os.rename(settings_path + '.tmp', settings_path)
+    return
+
+
+def read_checkpoint(vi_name):
+    """
+    settings, tile rows, cube layout and finished tiles of an interrupted
+    run for a VI's output file with the same scenes, union mask and
+    percentiles (None if there is none, or its settings cannot be read); a
+    tile file that cannot be read is left to be done again
+    """
+    settings_path = '%s/settings.h5' % tile_dirs[vi_name]
+    if not os.path.isfile(settings_path):
+        return None
+    try:
+        with hdf.File(settings_path, 'r') as h5file:
+            if date_strings([h5file['dates'][()]])[0] != \
+                    ','.join(old_dates + dates_all) or \
+                    date_strings([h5file['old_outfile'][()]])[0] != \
+                    old_outfiles.get(vi_name, '') or \
+                    list(h5file['pctiles']) != pctiles or \
+                    not np.array_equal(np.array(h5file['union_mask'],
+                                                dtype=np.uint8), union_mask):
+                return None
+            settings = [int(n) for n in h5file['settings']]
+            checkpoint_rows = int(h5file['tile_rows'][()])
+            layout = date_strings([h5file['cube_layout'][()]])[0]
+    except (IOError, OSError, KeyError):
+        message('- cannot read %s' % settings_path)
+        return None
+    done = np.zeros((nrows + checkpoint_rows - 1) // checkpoint_rows,
+                    dtype=np.uint8)
+    for t in range(len(done)):
+        tile_path = '%s/%d.h5' % (tile_dirs[vi_name], t)
+        if not os.path.isfile(tile_path):
+            continue
+        try:
+            with hdf.File(tile_path, 'r') as h5tilefile:
+                done[t] = int(h5tilefile['tile'][0]) == t
+        except (IOError, OSError, KeyError):
+            message('- cannot read %s, doing tile %d again' %
+                    (tile_path, t + 1))
+    return settings, checkpoint_rows, layout, done
+
+
+def create_outfile(vi_name):
+    """ new work copy of a VI's output file, with empty grids and cube """
+    h5outfile = open_grids(work_paths[vi_name], 'w')
+    h5outfile.create_dataset('meta/filename', data=outfiles[vi_name])
+    h5outfile.create_dataset('meta/created',
+                             data=datetime.datetime.now().isoformat())
+    h5outfile.create_dataset('meta/by', data='M. Garcia, UW-Madison')
+    h5outfile.create_dataset('meta/last_updated',
+                             data=datetime.datetime.now().isoformat())
+    h5outfile.create_dataset('meta/at',
+                             data='process_L57_08 (union mask + vi datacube)')
+    h5outfile.create_dataset('meta/UTM_zone', data=UTM_zone)
+    h5outfile.create_dataset('meta/UTM_bounds', data=UTM_bounds)
+    h5outfile.create_dataset('union_mask', data=union_mask, dtype=np.int8,
+                             compression='gzip')
+    h5outfile.create_dataset('dates', data=dates_all, maxshape=(None,),
+                             compression='gzip')
+    if use_sketch:
+        h5outfile.create_dataset('meta/quantiles', data='sketch')
     else:
-        qval = np.percentile(vals, q)
-        median = np.percentile(vals, 50)
-        mean = np.mean(vals)
-        std = np.std(vals)
-        maximum = np.amax(vals)
-    return nvals, qval, median, mean, std, maximum
+        h5outfile.create_dataset('meta/quantiles', data='exact')
+    h5outfile.create_dataset('meta/tile_rows', data=tile_rows)
+    if options.doy is not None:
+        h5outfile.create_dataset('meta/doy_window', data=options.doy)
+    if options.months is not None:
+        h5outfile.create_dataset('meta/month_window', data=options.months)
+    if (write_cube and sparse_cube) or year_summaries:
+        h5outfile.create_dataset('pixel_index',
+                                 data=union_pixel_index(union_mask),
+                                 dtype=np.int64, compression='gzip')
+    if use_sketch:
+        h5outfile.create_dataset('meta/sketch_bins', data=sketch_bins)
+        h5outfile.create_dataset('meta/sketch_range',
+                                 data=sketch_ranges[vi_name])
+        h5outfile.create_dataset('%s_sketch' % vi_name,
+                                 (union_npix, sketch_bins), dtype=np.uint16,
+                                 chunks=(min(4096, max(union_npix, 1)),
+                                         sketch_bins),
+                                 compression='gzip')
+        h5outfile.create_dataset('%s_moments' % vi_name, (4, union_npix),
+                                 dtype=np.float64,
+                                 chunks=(4, min(4096, max(union_npix, 1))),
+                                 compression='gzip')
+    if year_summaries:
+        group = h5outfile.create_group('%s_years' % vi_name)
+        group.create_dataset('years', data=year_list, maxshape=(None,))
+        group.create_dataset('hist_range', data=sketch_ranges[vi_name])
+        for name, dtype in zip(year_sums_names, year_sums_dtypes):
+            group.create_dataset(name, (len(year_list), union_npix),
+                                 maxshape=(None, union_npix), dtype=dtype,
+                                 chunks=(1, min(4096, max(union_npix, 1))),
+                                 compression='gzip')
+        group.create_dataset('hist', (len(year_list), union_npix,
+                                      sketch_bins),
+                             maxshape=(None, union_npix, sketch_bins),
+                             dtype=np.uint16,
+                             chunks=(1, min(4096, max(union_npix, 1)),
+                                     sketch_bins),
+                             compression='gzip')
+    if write_cube and sparse_cube:
+        datapath = '%s_cube' % vi_name
+        h5outfile.create_dataset(datapath, (nfiles, union_npix),
+                                 maxshape=(None, union_npix),
+                                 dtype=np.float32, chunks=cube_chunk_shape,
+                                 compression='gzip')
+    elif write_cube:
+        datapath = '%s_cube' % vi_name
+        h5outfile.create_dataset(datapath, (nfiles, nrows, ncols),
+                                 maxshape=(None, nrows, ncols),
+                                 dtype=np.float32, chunks=cube_chunk_shape,
+                                 compression='gzip')
+    for datapath in stats_names[vi_name]:
+        h5outfile.create_dataset(datapath, (nrows, ncols), dtype=np.float32,
+                                 chunks=out_chunks, compression='gzip')
+    return h5outfile
+
+
+def copy_outfile(vi_name):
+    """
+    work copy of the output file that a VI's new scenes are appended to,
+    with room for them (the file itself is left as it is)
+    """
+    work_path = work_paths[vi_name]
+    remove_output(work_path)
+    if os.path.isdir(old_outfiles[vi_name]):
+        shutil.copytree(old_outfiles[vi_name], work_path)
+    else:
+        shutil.copyfile(old_outfiles[vi_name], work_path)
+    h5outfile = open_grids(work_path, 'r+')
+    del h5outfile['meta/filename']
+    h5outfile.create_dataset('meta/filename', data=outfiles[vi_name])
+    for datapath in ['meta/tiles_done', 'meta/tile_npix']:
+        if datapath in h5outfile:
+            del h5outfile[datapath]
+    del h5outfile['dates']
+    h5outfile.create_dataset('dates', data=old_dates + dates_all,
+                             maxshape=(None,), compression='gzip')
+    if 'meta/tile_rows' in h5outfile:
+        del h5outfile['meta/tile_rows']
+    h5outfile.create_dataset('meta/tile_rows', data=tile_rows)
+    if write_cube:
+        h5outfile['%s_cube' % vi_name].resize(nold + nfiles, axis=0)
+    if year_summaries:
+        group = h5outfile['%s_years' % vi_name]
+        for name in year_sums_names + ['hist']:
+            group[name].resize(len(year_list), axis=0)
+        del group['years']
+        group.create_dataset('years', data=year_list, maxshape=(None,))
+    for datapath in stats_names[vi_name]:
+        if datapath not in h5outfile:
+            h5outfile.create_dataset(datapath, (nrows, ncols),
+                                     dtype=np.float32, chunks=out_chunks,
+                                     compression='gzip')
+    return h5outfile
+
+
+def eval_tile(tile):
+    """
+    read one tile (rows r0:r1) of the scswumask grid and each VI grid from
+    every scene, evaluate its union mask pixels into the shared output grids,
+    and leave the masked VI tiles and sketches in a free shared slot for the
+    main process to save, along with any per-year summaries; when
+    appending, the existing values, sketches or per-year summaries are read
+    back from the existing output files first (runs in worker processes;
+    uses the shared arrays and settings made in the main process before the
+    pool is started)
+    """
+    global h5infiles
+    t, r0, r1, u0 = tile
+    if h5infiles is None:
+        h5infiles = [hdf.File(scene_path, 'r') for scene_path in h5list]
+    idx = union_pixel_index(union_mask[r0:r1, :])
+    nidx = len(idx)
+    if write_cube or use_sketch or year_summaries:
+        slot = free_slots.get()
+    else:
+        slot = None
+    if write_cube:
+        tile_cubes = cube_slots[slot, :, :, :nidx]
+    elif not use_sketch:
+        tile_cubes = np.zeros((nvis, nfiles, nidx), dtype=np.float32)
+    if use_sketch:
+        sketches = []
+        for vi_name in vi_names:
+            v = len(sketches)
+            counts = sketch_slots[slot, v, :nidx, :]
+            moments = moment_slots[slot, v, :, :nidx]
+            if nold > 0 and nidx > 0:
+                h5oldfile = h5oldfiles[vi_name]
+                counts[:, :] = h5oldfile['%s_sketch' % vi_name][u0:u0 + nidx]
+                moments[:, :] = \
+                    h5oldfile['%s_moments' % vi_name][:, u0:u0 + nidx]
+            else:
+                counts[:, :] = 0
+                moments[:, :] = 0.0
+            sketches.append((counts, moments))
+    if year_summaries:
+        layers = []
+        for vi_name in vi_names:
+            v = len(layers)
+            counts = year_hist_slots[slot, v, :, :nidx, :]
+            sums = year_sum_slots[slot, v, :, :, :nidx]
+            counts[:, :, :] = 0
+            sums[:, :, :] = 0.0
+            if nold > 0 and nidx > 0:
+                group = h5oldfiles[vi_name]['%s_years' % vi_name]
+                for a, year in enumerate(active_years):
+                    if year not in old_years:
+                        continue
+                    y = year_list.index(year)
+                    counts[a, :, :] = group['hist'][y, u0:u0 + nidx, :]
+                    for i, name in enumerate(year_sums_names):
+                        sums[a, i, :] = group[name][y, u0:u0 + nidx]
+            layers.append((counts, sums))
+    tile_npix = np.zeros(nfiles, dtype=np.int64)
+    for k, h5infile in enumerate(h5infiles):
+        scswumask = np.array(h5infile['masks/scswumask'][r0:r1, :],
+                             dtype=np.uint8)
+        tile_npix[k] = np.sum(scswumask)
+        for v, vi_name in enumerate(vi_names):
+            vi_grid = np.array(h5infile['level3/' + vi_name][r0:r1, :],
+                               dtype=np.float32)
+            vi_vals = (vi_grid * scswumask).ravel()[idx]
+            if use_sketch:
+                counts, moments = sketches[v]
+                sketch_update(counts, moments, vi_vals,
+                              sketch_ranges[vi_name][0],
+                              sketch_ranges[vi_name][1])
+            if write_cube or not use_sketch:
+                tile_cubes[v, k, :] = vi_vals
+            if year_summaries:
+                counts, sums = layers[v]
+                a = scene_year_slots[k]
+                sums_update(counts[a], sums[a], vi_vals,
+                            sketch_ranges[vi_name][0],
+                            sketch_ranges[vi_name][1])
+    if nidx > 0:
+        for v, vi_name in enumerate(vi_names):
+            if use_sketch:
+                counts, moments = sketches[v]
+                returns = eval_stats_sketch(counts, moments, pctiles,
+                                            sketch_ranges[vi_name][0],
+                                            sketch_ranges[vi_name][1])
+            else:
+                vals = tile_cubes[v]
+                if nold > 0:
+                    datapath = '%s_cube' % vi_name
+                    if sparse_cube:
+                        old_vals = np.array(
+                            h5oldfiles[vi_name][datapath][:nold,
+                                                          u0:u0 + nidx],
+                            dtype=np.float32)
+                    else:
+                        old_vals = np.array(
+                            h5oldfiles[vi_name][datapath][:nold, r0:r1, :],
+                            dtype=np.float32).reshape((nold, -1))[:, idx]
+                    vals = np.concatenate((old_vals, vals))
+                returns = eval_stats_block(vals, pctiles)
+            for grid, vals in zip(out_grids[vi_name], [returns[0]] +
+                                  returns[1] + list(returns[2:])):
+                grid[r0:r1, :].flat[idx] = vals
+    if direct_writes:
+        # whole chunks of the directory stores, so workers can write them
+        #   at the same time
+        for v, vi_name in enumerate(vi_names):
+            store = open_store(work_paths[vi_name], 'r+')
+            for datapath, grid in zip(stats_names[vi_name],
+                                      out_grids[vi_name]):
+                store[datapath][r0:r1, :] = grid[r0:r1, :]
+            if direct_cube:
+                store['%s_cube' % vi_name][:, r0:r1, :] = \
+                    scatter_pixels(cube_slots[slot, v, :, :nidx], idx,
+                                   (r1 - r0, ncols))
+    return t, r0, r1, u0, slot, nidx, tile_npix
+
+
+def tile_arrays(slot, v, nidx):
+    """
+    (name, array) of each part of a shared slot that holds one VI's results
+    for a tile, as saved in its tile file
+    """
+    arrays = []
+    if write_cube:
+        arrays.append(('cube', cube_slots[slot, v, :, :nidx]))
+    if use_sketch:
+        arrays.append(('sketch', sketch_slots[slot, v, :nidx, :]))
+        arrays.append(('moments', moment_slots[slot, v, :, :nidx]))
+    if year_summaries:
+        arrays.append(('year_hist', year_hist_slots[slot, v, :, :nidx, :]))
+        arrays.append(('year_sums', year_sum_slots[slot, v, :, :, :nidx]))
+    return arrays
+
+
+def save_tile(result):
+    """
+    keep a finished tile's results in a tile file for each VI: its rows of
+    the statistics grids and the contents of its slot, written under a
+    temporary name and renamed once complete, so a tile file is either
+    whole or missing; rows that also went straight to a store are marked
+    with the store's creation time
+    """
+    t, r0, r1, u0, slot, nidx, tile_npix = result
+    for v, vi_name in enumerate(vi_names):
+        tile_path = '%s/%d.h5' % (tile_dirs[vi_name], t)
+        with hdf.File(tile_path + '.tmp', 'w') as h5tilefile:
+            h5tilefile.create_dataset('tile', data=[t, r0, r1, u0, nidx])
+            h5tilefile.create_dataset('tile_npix', data=tile_npix)
+            if direct_writes:
+                h5tilefile.create_dataset('store_created',
+                                          data=store_created[vi_name])
+                h5tilefile.create_dataset('direct_cube',
+                                          data=int(direct_cube))
+            grids = h5tilefile.create_dataset(
+                'grids', (len(stats_names[vi_name]), r1 - r0, ncols),
+                dtype=np.float32, compression='gzip')
+            for g, grid in enumerate(out_grids[vi_name]):
+                grids[g] = grid[r0:r1, :]
+            if nidx > 0:
+                for name, array in tile_arrays(slot, v, nidx):
+                    h5tilefile.create_dataset(name, data=array,
+                                              compression='gzip')
+        os.rename(tile_path + '.tmp', tile_path)
+    return
+
+
+def write_tile(h5outfile, vi_name, h5tilefile):
+    """
+    put the results in a tile file into a VI's output file, except for the
+    rows that its worker already wrote straight to this same store
+    """
+    t, r0, r1, u0, nidx = [int(n) for n in h5tilefile['tile']]
+    in_store = direct_writes and 'store_created' in h5tilefile and \
+        date_strings([h5tilefile['store_created'][()]])[0] == \
+        store_created[vi_name]
+    if not in_store:
+        grids = h5tilefile['grids']
+        for g, datapath in enumerate(stats_names[vi_name]):
+            h5outfile[datapath][r0:r1, :] = grids[g]
+    write_cube_rows = 'cube' in h5tilefile and \
+        not (in_store and int(h5tilefile['direct_cube'][()]))
+    if write_cube_rows and sparse_cube:
+        h5outfile['%s_cube' % vi_name][nold:nold + nfiles, u0:u0 + nidx] = \
+            h5tilefile['cube'][...]
+    elif write_cube_rows:
+        h5outfile['%s_cube' % vi_name][nold:nold + nfiles, r0:r1, :] = \
+            scatter_pixels(np.array(h5tilefile['cube']),
+                           union_pixel_index(union_mask[r0:r1, :]),
+                           (r1 - r0, ncols))
+    if 'sketch' in h5tilefile:
+        h5outfile['%s_sketch' % vi_name][u0:u0 + nidx, :] = \
+            h5tilefile['sketch'][...]
+        h5outfile['%s_moments' % vi_name][:, u0:u0 + nidx] = \
+            h5tilefile['moments'][...]
+    if 'year_hist' in h5tilefile:
+        group = h5outfile['%s_years' % vi_name]
+        for a, year in enumerate(active_years):
+            y = year_list.index(year)
+            group['hist'][y, u0:u0 + nidx, :] = h5tilefile['year_hist'][a]
+            for i, name in enumerate(year_sums_names):
+                group[name][y, u0:u0 + nidx] = h5tilefile['year_sums'][a, i]
+    return
+
+
+def abort_ranks(exc_type, exc_value, exc_traceback):
+    """
+    print an exception that stops one MPI rank, then end the whole MPI job
+    rather than leave the other ranks waiting for it
+    """
+    sys.__excepthook__(exc_type, exc_value, exc_traceback)
+    sys.stderr.flush()
+    comm.Abort(1)
+    return
+
+
+def start_tiles():
+    """
+    hand this process's tiles (all of them, or its MPI rank's share) out to
+    a pool of worker processes, or evaluate them here as they are asked for
+    """
+    if workers > 1:
+        pool = mp.Pool(workers)
+        return pool, pool.imap_unordered(eval_tile, own_tiles)
+    return None, (eval_tile(tile) for tile in own_tiles)
+
+
+# default limit on the memory used by all tiles of the stack in progress
+max_memory = '8GB'
+
+
+# default number of bins in each per-pixel sketch
+sketch_nbins = 100
+
+
+# per-year summaries kept along with each year's histogram counts
+year_sums_names = ['count', 'sum', 'sumsq', 'max']
+year_sums_dtypes = [np.uint16, np.float64, np.float64, np.float32]
 
 
 message(' ')
@@ -81,14 +746,14 @@ if len(sys.argv) < 7:
     # footprint = 'p026r027'
     # year_begin = 1984
     # year_end = 2013
-    # vi_name = 'NDII'
-    # pctile = 90
+    # vi_names = 'NDVI,NDII,NBR'
+    # pctiles = '50,75,90'
 else:
     footprint = sys.argv[2]
     year_begin = int(sys.argv[3])
     year_end = int(sys.argv[4])
-    vi_name = sys.argv[5]
-    pctile = int(sys.argv[6])
+    vi_names = [vi_name.strip().lower() for vi_name in sys.argv[5].split(',')]
+    pctiles = [int(pctile) for pctile in sys.argv[6].split(',')]
 #
 if len(sys.argv) < 2:
     message('input error: need directory path')
@@ -96,121 +761,437 @@ if len(sys.argv) < 2:
 else:
     path = sys.argv[1]
 #
+parser = argparse.ArgumentParser(
+    prog='process_L57_08.py path footprint year_begin year_end vi_names '
+         'pctiles')
+parser.add_argument('--max-memory', default=max_memory,
+                    help='memory limit for the tiles in progress, e.g. 8GB')
+parser.add_argument('--no-cube', action='store_true',
+                    help='do not write the VI datacubes')
+parser.add_argument('--cube-layout', choices=['scene', 'time'],
+                    default='scene',
+                    help='datacube chunks by scene or by pixel time series')
+parser.add_argument('--quantiles', choices=['exact', 'sketch'],
+                    default='exact',
+                    help='exact percentiles or per-pixel sketch estimates')
+parser.add_argument('--sketch-bins', type=int, default=sketch_nbins,
+                    help='number of histogram bins in each sketch')
+parser.add_argument('--workers', type=int, default=1,
+                    help='number of worker processes')
+parser.add_argument('--append', action='store_true',
+                    help='add new scenes to existing output files')
+parser.add_argument('--cube-storage', choices=['dense', 'sparse'],
+                    default='dense',
+                    help='datacube as full grids or as union mask pixels')
+parser.add_argument('--doy', default=None,
+                    help='day of year window, e.g. 150-250')
+parser.add_argument('--months', default=None,
+                    help='month window, e.g. 6-8')
+parser.add_argument('--year-summaries', action='store_true',
+                    help='keep per-year summaries for year range queries')
+parser.add_argument('--resume', action='store_true',
+                    help='finish the tiles left by an interrupted run')
+parser.add_argument('--output-format', choices=['h5', 'zarr'], default='h5',
+                    help='output as hdf5 files or as directory stores')
+parser.add_argument('--mpi', action='store_true',
+                    help='share the tiles among MPI ranks (needs mpi4py)')
+options = parser.parse_args(sys.argv[7:])
+max_bytes = parse_memory(options.max_memory)
+write_cube = not options.no_cube
+use_sketch = options.quantiles == 'sketch'
+sparse_cube = options.cube_storage == 'sparse'
+sketch_bins = options.sketch_bins
+year_summaries = options.year_summaries
+workers = max(options.workers, 1)
+if options.output_format == 'zarr':
+    grids_ext = '.zarr'
+    open_grids = open_store
+else:
+    grids_ext = '.h5'
+    open_grids = hdf.File
+nvis = len(vi_names)
+mpi_rank = 0
+mpi_size = 1
+if options.mpi:
+    try:
+        from mpi4py import MPI
+    except ImportError:
+        message('input error: --mpi needs the mpi4py package')
+        sys.exit(1)
+    comm = MPI.COMM_WORLD
+    sys.excepthook = abort_ranks
+    mpi_rank = comm.Get_rank()
+    mpi_size = comm.Get_size()
+    if mpi_rank > 0:
+        sys.stdout = open(os.devnull, 'w')
+    if options.append and mpi_size > 1:
+        message('- appending tiles in MPI rank 0 only')
+        if mpi_rank > 0:
+            sys.exit(0)
+        mpi_size = 1
+    if workers > 1:
+        message('- one process per MPI rank')
+        workers = 1
+#
 message('working in directory %s' % path)
 years = np.arange(year_begin, year_end + 1).astype(int)
+window_tag = ''
+if options.doy is not None:
+    doys = parse_window(options.doy, 366)
+    window_tag += '_doy%s' % options.doy.replace(',', '+')
+if options.months is not None:
+    months = parse_window(options.months, 12)
+    window_tag += '_m%s' % options.months.replace(',', '+')
 flist = sorted(glob.glob('%s/*_clipped.h5' % path))
 h5list = []
 for file_path in flist:
     path_parts = file_path.split('/')
     h5yr = int(path_parts[-1][:4])
-    if h5yr in years:
-        h5list.append(file_path)
+    if h5yr not in years:
+        continue
+    if options.doy is not None and int(path_parts[-1][9:12]) not in doys:
+        continue
+    if options.months is not None and \
+            int(path_parts[-1][4:6]) not in months:
+        continue
+    h5list.append(file_path)
 message('found %d Landsat files in specified date range' % len(h5list))
-nfiles = len(h5list)
+if window_tag != '':
+    message('- using only scenes in seasonal window (%s)' % window_tag[1:])
+if len(h5list) == 0:
+    message('input error: no scenes to process')
+    sys.exit(1)
 #
 message('extracting metadata info and union (forest) mask from %s' % h5list[0])
 with hdf.File(h5list[0], 'r') as h5infile:
     projection = np.copy(h5infile['meta/projection'])
     clipbounds = np.copy(h5infile['meta/clip_bounds'])
-    union_mask = np.copy(h5infile['masks/forest/union'])
-UTM_zone = int(projection[1].tolist())
+    union_mask = np.array(h5infile['masks/forest/union'], dtype=np.uint8)
+    vi_chunks = h5infile['level3/' + vi_names[0]].chunks
+UTM_zone = int(projection[1])
 UTM_bounds = clipbounds[0:4]
 nrows, ncols = np.shape(union_mask)
 union_npix = np.sum(union_mask)
 #
 dates_all = []
-message('collecting %d %s grids' % (nfiles, vi_name))
-vi_cube = np.zeros((nfiles, nrows, ncols))
-for k, scene_path in enumerate(h5list):
+for scene_path in h5list:
     path_parts = scene_path.split('/')
     scene_file = path_parts[-1]
-    message('- extracting grids from %s' % scene_file)
     yyyy = scene_file[:4]
     doy = scene_file[9:12]
-    date = '%s_%s' % (yyyy, doy)
-    dates_all.append(date)
-    with hdf.File(scene_path, 'r') as h5infile:
-        scswumask = np.copy(h5infile['masks/scswumask'])
-        vi_grid = np.copy(h5infile['level3/' + vi_name.lower()])
-        vi_grid_masked = vi_grid * scswumask
-        vi_cube[k, :, :] = vi_grid_masked[:, :]
-    area_pct = float(np.sum(scswumask)) / float(union_npix) * 100.0
-    message('-- grid %s has %d available pixels (%.1f%s of full union mask)' %
-            (date, np.sum(scswumask), area_pct, '%'))
-message(' ')
+    dates_all.append('%s_%s' % (yyyy, doy))
+year_list = sorted(set([int(date[:4]) for date in dates_all]))
+old_years = []
 #
-outfile = '%s/%d-%d_%s_%s_grids.h5' % \
-    (path, year_begin, year_end, footprint, vi_name.lower())
-message('writing %s datacube to %s' % (vi_name, outfile))
-with hdf.File(outfile, 'w') as h5outfile:
-    h5outfile.create_dataset('meta/filename', data=outfile)
-    h5outfile.create_dataset('meta/created',
-                             data=datetime.datetime.now().isoformat())
-    h5outfile.create_dataset('meta/by', data='M. Garcia, UW-Madison')
-    h5outfile.create_dataset('meta/last_updated',
-                             data=datetime.datetime.now().isoformat())
-    h5outfile.create_dataset('meta/at',
-                             data='process_L57_08 (union mask + vi datacube)')
-    h5outfile.create_dataset('meta/UTM_zone', data=UTM_zone)
-    h5outfile.create_dataset('meta/UTM_bounds', data=UTM_bounds)
-    h5outfile.create_dataset('union_mask', data=union_mask, dtype=np.int8,
-                             compression='gzip')
-    h5outfile.create_dataset('dates', data=dates_all, compression='gzip')
-    datapath = '%s_cube' % vi_name.lower()
-    h5outfile.create_dataset(datapath, data=vi_cube, dtype=np.float32,
-                             compression='gzip')
+outfiles = {}
+work_paths = {}
+tile_dirs = {}
+for vi_name in vi_names:
+    outfiles[vi_name] = '%s/%d-%d_%s_%s%s_grids%s' % \
+        (path, year_begin, year_end, footprint, vi_name, window_tag,
+         grids_ext)
+    work_paths[vi_name] = '%s.part' % outfiles[vi_name]
+    tile_dirs[vi_name] = '%s.tiles' % outfiles[vi_name]
+old_outfiles = {}
+h5oldfiles = {}
+old_dates = []
+nold = 0
+cube_layout = options.cube_layout
+if options.append:
+    # existing output files set the quantile method, sketches and cube;
+    #   they are only read here, and replaced once the append is complete
+    for vi_name in vi_names:
+        old_outfile = find_outfile(vi_name)
+        if old_outfile is None:
+            message('input error: no existing %s output file to append to' %
+                    vi_name.upper())
+            sys.exit(1)
+        old_outfiles[vi_name] = old_outfile
+        h5outfile = open_grids(old_outfile, 'r')
+        h5oldfiles[vi_name] = h5outfile
+        file_dates = date_strings(h5outfile['dates'])
+        if len(h5oldfiles) == 1:
+            old_dates = file_dates
+        elif file_dates != old_dates:
+            message('input error: output files have different dates')
+            sys.exit(1)
+        if not np.array_equal(np.array(h5outfile['union_mask'],
+                                       dtype=np.uint8), union_mask):
+            message('input error: union mask has changed since %s was made' %
+                    old_outfile)
+            sys.exit(1)
+        use_sketch, sketch_bins, write_cube, sparse_cube, year_summaries = \
+            file_settings(h5outfile, vi_name)
+        datapath = '%s_cube' % vi_name
+        if write_cube and h5outfile[datapath].maxshape[0] is not None:
+            message('input error: %s in %s is not resizable' %
+                    (datapath, old_outfile))
+            sys.exit(1)
+        if year_summaries:
+            old_years = [int(year) for year
+                         in h5outfile['%s_years/years' % vi_name]]
+    if not use_sketch and not write_cube:
+        message('input error: appending exact statistics needs the datacube')
+        sys.exit(1)
+    nold = len(old_dates)
+    new_scenes = [(scene_path, date) for scene_path, date
+                  in zip(h5list, dates_all) if date not in old_dates]
+    h5list = [scene_path for scene_path, date in new_scenes]
+    dates_all = [date for scene_path, date in new_scenes]
+    year_list = old_years + sorted(set([int(date[:4]) for date in dates_all
+                                        if int(date[:4]) not in old_years]))
+    message('appending %d new scenes to %d existing ones' %
+            (len(h5list), nold))
+    if len(h5list) == 0:
+        for vi_name in vi_names:
+            h5oldfiles[vi_name].close()
+        message(' ')
+        message('process_L57_08.py completed at %s' %
+                datetime.datetime.now().isoformat())
+        message(' ')
+        sys.exit(0)
+    if workers > 1:
+        message('- appending tiles in this process only')
+        workers = 1
+direct_writes = options.output_format == 'zarr' and \
+    (workers > 1 or mpi_size > 1)
+resume = False
+tiles_done = None
+if options.append or options.resume:
+    # the tile directories of an interrupted run for the same scenes set
+    #   the tile rows and everything else it was made with (an append also
+    #   has to have been made from the same existing files)
+    checkpoints = [read_checkpoint(vi_name) for vi_name in vi_names]
+    resume = None not in checkpoints and \
+        len(set([tuple(checkpoint[0]) + checkpoint[1:3]
+                 for checkpoint in checkpoints])) == 1
+    if resume and options.append:
+        resume = checkpoints[0][0] == [int(use_sketch), sketch_bins,
+                                       int(write_cube), int(sparse_cube),
+                                       int(year_summaries)]
+    if resume:
+        settings, tile_rows, cube_layout, tiles_done = checkpoints[0]
+        use_sketch, write_cube, sparse_cube, year_summaries = \
+            [bool(setting) for setting in [settings[0]] + settings[2:]]
+        sketch_bins = settings[1]
+        for checkpoint in checkpoints[1:]:
+            tiles_done &= checkpoint[3]
+    elif options.resume:
+        message('- no unfinished run for these scenes, starting over')
+if mpi_size > 1:
+    # every rank has read any tile directories before rank 0 starts them
+    #   over
+    comm.Barrier()
+nfiles = len(h5list)
+scene_years = [int(date[:4]) for date in dates_all]
+active_years = sorted(set(scene_years))
+scene_year_slots = [active_years.index(year) for year in scene_years]
+nactive = len(active_years)
+#
+if write_cube and cube_layout == 'time' and not options.append:
+    chunk_rows = cube_tile
+elif vi_chunks is None:
+    chunk_rows = None
+else:
+    chunk_rows = vi_chunks[0]
+if use_sketch or year_summaries:
+    sketch_ranges = {}
+    for vi_name in vi_names:
+        if options.append and use_sketch:
+            sketch_ranges[vi_name] = \
+                list(np.copy(h5oldfiles[vi_name]['meta/sketch_range']))
+        elif options.append:
+            sketch_ranges[vi_name] = list(np.copy(
+                h5oldfiles[vi_name]['%s_years/hist_range' % vi_name]))
+        else:
+            sketch_ranges[vi_name] = [max(vi_hist_ranges[vi_name][0], 0.0),
+                                      vi_hist_ranges[vi_name][1]]
+        message('%s histograms have %d bins over (%.2f, %.2f]' %
+                (vi_name.upper(), sketch_bins, sketch_ranges[vi_name][0],
+                 sketch_ranges[vi_name][1]))
+if use_sketch:
+    work_bytes = sketch_pixel_bytes(sketch_bins, nold + nfiles)
+else:
+    work_bytes = exact_pixel_bytes(nold + nfiles)
+stats_names = {}
+for vi_name in vi_names:
+    stats_names[vi_name] = ['%s_nvals' % vi_name] + \
+        ['%s_%dpctile' % (vi_name, pctile) for pctile in pctiles] + \
+        ['%s_median' % vi_name, '%s_mean' % vi_name, '%s_std' % vi_name,
+         '%s_max' % vi_name]
+if workers > 1:
+    nslots = workers + 1
+else:
+    nslots = 1
+if use_sketch:
+    pixel_bytes = nslots * nvis * work_bytes
+else:
+    pixel_bytes = workers * nvis * work_bytes
+if write_cube:
+    pixel_bytes += nslots * nvis * nfiles * 4
+if year_summaries:
+    pixel_bytes += nslots * nvis * nactive * (sketch_bins * 2 + 32)
+grid_bytes = 1 + 4 * sum([len(names) for names in stats_names.values()])
+if not resume:
+    tile_rows = tile_rows_for_memory(max_bytes, pixel_bytes, nrows, ncols,
+                                     chunk_rows=chunk_rows,
+                                     grid_bytes=grid_bytes)
+ntiles = (nrows + tile_rows - 1) // tile_rows
+out_chunks = (tile_rows, min(ncols, 1024))
+if sparse_cube:
+    cube_chunk_shape = sparse_cube_chunks(cube_layout, nfiles,
+                                          union_npix)
+else:
+    cube_chunk_shape = cube_chunks(cube_layout, nfiles, nrows, ncols,
+                                   tile_rows)
+message('processing %d x %d grids in %d tiles of %d rows (%s limit)' %
+        (nrows, ncols, ntiles, tile_rows, options.max_memory))
+if resume:
+    message('- resuming with the tile rows of the unfinished run, '
+            '%d tiles already done' % np.sum(tiles_done))
 message(' ')
 #
-message('evaluating %s values at %d union mask locations' %
-        (vi_name, union_npix))
-vi_nvals = np.zeros(np.shape(union_mask))
-vi_qval = np.zeros(np.shape(union_mask))
-vi_median = np.zeros(np.shape(union_mask))
-vi_mean = np.zeros(np.shape(union_mask))
-vi_std = np.zeros(np.shape(union_mask))
-vi_max = np.zeros(np.shape(union_mask))
+# shared inputs, outputs and slots, then the worker pool (started before
+#   any h5 file is opened in this process)
+union_mask_shared = shared_array((nrows, ncols), np.uint8)
+union_mask_shared[:, :] = union_mask
+union_mask = union_mask_shared
+out_grids = {}
+for vi_name in vi_names:
+    out_grids[vi_name] = [shared_array((nrows, ncols), np.float32)
+                          for datapath in stats_names[vi_name]]
+tiles = []
+for t, r0 in enumerate(range(0, nrows, tile_rows)):
+    r1 = min(r0 + tile_rows, nrows)
+    if tiles_done is None or not tiles_done[t]:
+        tiles.append((t, r0, r1, int(np.sum(union_mask[:r0, :]))))
+own_tiles = tiles[mpi_rank::mpi_size]
+tile_union_npix = max([0] + [np.sum(union_mask[r0:r1, :])
+                             for t, r0, r1, u0 in tiles])
+if write_cube:
+    cube_slots = shared_array((nslots, nvis, nfiles, tile_union_npix),
+                              np.float32)
+if use_sketch:
+    sketch_slots = shared_array((nslots, nvis, tile_union_npix, sketch_bins),
+                                sketch_dtype(nold + nfiles))
+    moment_slots = shared_array((nslots, nvis, 4, tile_union_npix),
+                                np.float64)
+if year_summaries:
+    year_hist_slots = shared_array((nslots, nvis, nactive, tile_union_npix,
+                                    sketch_bins), np.uint16)
+    year_sum_slots = shared_array((nslots, nvis, nactive, 4,
+                                   tile_union_npix), np.float64)
+if write_cube or use_sketch or year_summaries:
+    free_slots = mp.Queue()
+    for slot in range(nslots):
+        free_slots.put(slot)
+h5infiles = None
+direct_cube = False
+store_created = {}
+if not direct_writes:
+    pool, results = start_tiles()
+#
+if mpi_rank == 0 and not resume:
+    # every tile directory has the settings of this run before any tile
+    #   is saved
+    for vi_name in vi_names:
+        start_checkpoint(vi_name)
+if mpi_rank == 0 and direct_writes:
+    # the worker pool can start after the work copies of the directory
+    #   stores are made, since they hold no open files
+    for vi_name in vi_names:
+        if not resume or not is_store(work_paths[vi_name]):
+            message('creating %s' % work_paths[vi_name])
+            create_outfile(vi_name).close()
+if mpi_size > 1:
+    # the other MPI ranks start on their share of the tiles once rank 0 has
+    #   started the tile directories (and made the work copies)
+    comm.Barrier()
+if direct_writes:
+    # a tile file only stands in for the rows written to the same store
+    #   they went to, not a store made again by a later run
+    for vi_name in vi_names:
+        store_created[vi_name] = date_strings([open_store(
+            work_paths[vi_name], 'r')['meta/created'][()]])[0]
+    if write_cube and not sparse_cube:
+        cube = open_store(work_paths[vi_names[0]],
+                          'r')['%s_cube' % vi_names[0]]
+        direct_cube = tile_rows % cube.chunks[1] == 0
+    pool, results = start_tiles()
+#
+message('evaluating %s values at %d union mask locations (%d processes)' %
+        (','.join([vi_name.upper() for vi_name in vi_names]), union_npix,
+         max(workers, mpi_size)))
 evaluated = 0
-for j in range(nrows):
-    for i in range(ncols):
-        if union_mask[j, i] == 1:
-            returns = eval_stats(vi_cube[:, j, i], pctile)
-            vi_nvals[j, i] = returns[0]
-            vi_qval[j, i] = returns[1]
-            vi_median[j, i] = returns[2]
-            vi_mean[j, i] = returns[3]
-            vi_std[j, i] = returns[4]
-            vi_max[j, i] = returns[5]
-            evaluated += 1
-            if evaluated % 1E5 == 0:
-                message('-- %d pixels evaluated' % evaluated)
-message('-- %d pixels evaluated' % evaluated)
+for n, result in enumerate(results):
+    t, r0, r1, u0, slot, nidx, tile_npix = result
+    save_tile(result)
+    if slot is not None:
+        free_slots.put(slot)
+    evaluated += nidx
+    message('- tile %d (rows %d-%d) done, %d of %d: %d pixels evaluated' %
+            (t + 1, r0, r1 - 1, n + 1, len(own_tiles), evaluated))
+if pool is not None:
+    pool.close()
+    pool.join()
+elif h5infiles is not None:
+    for h5infile in h5infiles:
+        h5infile.close()
+for vi_name in h5oldfiles:
+    h5oldfiles[vi_name].close()
+if mpi_size > 1:
+    # every rank has saved its tiles before rank 0 makes the output files
+    comm.Barrier()
+    if mpi_rank > 0:
+        sys.exit(0)
 message(' ')
 #
-message('writing %s statistics to %s' % (vi_name, outfile))
-with hdf.File(outfile, 'r+') as h5outfile:
+scene_npix = np.zeros(nfiles, dtype=np.int64)
+for vi_name in vi_names:
+    if direct_writes:
+        h5outfile = open_grids(work_paths[vi_name], 'r+')
+    elif options.append:
+        message('appending to a copy of %s' % old_outfiles[vi_name])
+        h5outfile = copy_outfile(vi_name)
+    else:
+        message('creating %s' % work_paths[vi_name])
+        remove_output(work_paths[vi_name])
+        h5outfile = create_outfile(vi_name)
+    for t in range(ntiles):
+        with hdf.File('%s/%d.h5' % (tile_dirs[vi_name], t),
+                      'r') as h5tilefile:
+            write_tile(h5outfile, vi_name, h5tilefile)
+            if vi_name == vi_names[0]:
+                scene_npix += np.array(h5tilefile['tile_npix'])
     del h5outfile['meta/last_updated']
     h5outfile.create_dataset('meta/last_updated',
                              data=datetime.datetime.now().isoformat())
     del h5outfile['meta/at']
-    h5outfile.create_dataset('meta/at', data='process_L57_08 (vi stats)')
-    datapath = '%s_nvals' % vi_name.lower()
-    h5outfile.create_dataset(datapath, data=vi_nvals, dtype=np.float32,
-                             compression='gzip')
-    datapath = '%s_%dpctile' % (vi_name.lower(), pctile)
-    h5outfile.create_dataset(datapath, data=vi_qval, dtype=np.float32,
-                             compression='gzip')
-    datapath = '%s_median' % vi_name.lower()
-    h5outfile.create_dataset(datapath, data=vi_median, dtype=np.float32,
-                             compression='gzip')
-    datapath = '%s_mean' % vi_name.lower()
-    h5outfile.create_dataset(datapath, data=vi_mean, dtype=np.float32,
-                             compression='gzip')
-    datapath = '%s_std' % vi_name.lower()
-    h5outfile.create_dataset(datapath, data=vi_std, dtype=np.float32,
-                             compression='gzip')
-    datapath = '%s_max' % vi_name.lower()
-    h5outfile.create_dataset(datapath, data=vi_max, dtype=np.float32,
-                             compression='gzip')
+    if options.append:
+        h5outfile.create_dataset('meta/at',
+                                 data='process_L57_08 (vi stats, appended)')
+    else:
+        h5outfile.create_dataset('meta/at', data='process_L57_08 (vi stats)')
+    h5outfile.close()
+message(' ')
+#
+for k, date in enumerate(dates_all):
+    area_pct = float(scene_npix[k]) / float(union_npix) * 100.0
+    message('- grid %s has %d available pixels (%.1f%s of full union mask)' %
+            (date, scene_npix[k], area_pct, '%'))
+message(' ')
+#
+# the finished work copies replace the output files, and then the tile
+#   directories and any files that were appended to under an older name
+#   are removed
+for vi_name in vi_names:
+    replace_output(work_paths[vi_name], outfiles[vi_name])
+    if options.append and old_outfiles[vi_name] != outfiles[vi_name]:
+        message('replacing %s with %s' %
+                (old_outfiles[vi_name], outfiles[vi_name]))
+        remove_output(old_outfiles[vi_name])
+    shutil.rmtree(tile_dirs[vi_name])
+    message('wrote %s statistics to %s' % (vi_name.upper(), outfiles[vi_name]))
 message(' ')
 #
 message('process_L57_08.py completed at %s' %
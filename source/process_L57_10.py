@@ -0,0 +1,180 @@
+"""
+Python script "process_L57_10.py"
+by Matthew Garcia, PhD student
+Dept. of Forest and Wildlife Ecology
+University of Wisconsin - Madison
+matt.e.garcia@gmail.com
+
+Copyright (C) 2014-2016 by Matthew Garcia
+Licensed Gnu GPL v3; see 'LICENSE_GnuGPLv3.txt' for complete terms
+Send questions, bug reports, any related requests to matt.e.garcia@gmail.com
+See also 'README.md', 'DISCLAIMER.txt', 'ACKNOWLEDGEMENTS.txt'
+Treat others as you would be treated. Pay it forward. Valar dohaeris.
+
+PURPOSE: Per-pixel VI trends over the period of a process_L57_08.py grids
+         file: ordinary least squares slope, intercept and R^2, the robust
+         Theil-Sen slope, and the Mann-Kendall trend test
+
+DEPENDENCIES: h5py, numpy
+              Stack_Stats depends on numpy
+
+USAGE: '$ python process_L57_10.py ./P26R27 p026r027 1984 2013 NDII'
+       or, for several VIs,
+       '$ python process_L57_10.py ./P26R27 p026r027 1984 2013 NDVI,NDII,NBR'
+       with options
+       '--max-memory 8GB' to limit the memory used by the blocks in progress
+       '--min-obs 10' to set the fewest valid values for a pixel's trends
+       '--doy 150-250' and/or '--months 6-8' to use the grids file made
+           with the same seasonal window
+       '--output-format zarr' to use <...>_grids.zarr directory stores
+
+NOTE: The VI datacube of each grids file (dense or sparse, see
+      process_L57_08.py) is read in blocks of union mask pixels (Stack_Stats
+      cube_blocks), and every block is evaluated at once with array
+      operations (Stack_Stats trend_block), so memory use is set by
+      --max-memory. Values <= 0 are missing, as in the process_L57_08.py
+      statistics. Time is in years
+      since 1 January of year_begin, from the scene dates, so slopes are VI
+      units per year and intercepts are the fitted values at the start of
+      the period. The Theil-Sen slope and Mann-Kendall S use every pair of
+      a pixel's valid values, about nscenes^2 / 2 pairs per pixel, so the
+      blocks get smaller as the stack gets longer. Pixels with fewer than
+      --min-obs valid values get 0 in every trend grid (and a p-value of 1),
+      as do pixels outside the union mask.
+
+INPUT: Output of process_L57_08.py, with its VI datacube
+
+OUTPUT: '<vi>_ols_slope', '<vi>_ols_intercept', '<vi>_ols_r2',
+        '<vi>_sen_slope', '<vi>_mk_z' and '<vi>_mk_pvalue' grids added to
+        each grids file (replacing any from an earlier run)
+"""
+
+
+import sys
+import datetime
+import argparse
+import h5py as hdf
+import numpy as np
+from Stack_Stats import parse_memory, add_grids_options, window_tag, \
+    cube_cache, union_pixel_index, cube_blocks, save_pixel_grids, \
+    save_meta, date_strings, decimal_years, trend_pixel_bytes, trend_block
+from Chunk_Store import open_store
+
+
+def message(char_string):
+    """
+    prints a string to the terminal and flushes the buffer
+    """
+    print(char_string)
+    sys.stdout.flush()
+    return
+
+
+max_memory = '8GB'
+min_obs = 10
+trend_names = ['ols_slope', 'ols_intercept', 'ols_r2', 'sen_slope', 'mk_z',
+               'mk_pvalue']
+# grid values outside the union mask (no trend, so not significant)
+trend_fills = [0.0, 0.0, 0.0, 0.0, 0.0, 1.0]
+
+
+message(' ')
+message('process_L57_10.py started at %s' %
+        datetime.datetime.now().isoformat())
+message(' ')
+#
+if len(sys.argv) < 6:
+    message('input error: need VI calculation details')
+    sys.exit(1)
+else:
+    footprint = sys.argv[2]
+    year_begin = int(sys.argv[3])
+    year_end = int(sys.argv[4])
+    vi_names = [vi_name.strip().lower() for vi_name in sys.argv[5].split(',')]
+#
+if len(sys.argv) < 2:
+    message('input error: need directory path')
+    sys.exit(1)
+else:
+    path = sys.argv[1]
+#
+parser = argparse.ArgumentParser(
+    prog='process_L57_10.py path footprint year_begin year_end vi_names')
+add_grids_options(parser, max_memory)
+parser.add_argument('--min-obs', type=int, default=min_obs,
+                    help='fewest valid values for a pixel\'s trends')
+options = parser.parse_args(sys.argv[6:])
+max_bytes = parse_memory(options.max_memory)
+if options.output_format == 'zarr':
+    grids_ext = '.zarr'
+    open_grids = open_store
+else:
+    grids_ext = '.h5'
+    open_grids = hdf.File
+tag = window_tag(options.doy, options.months)
+#
+message('working in directory %s' % path)
+message(' ')
+for vi_name in vi_names:
+    fpath = '%s/%d-%d_%s_%s%s_grids%s' % \
+        (path, year_begin, year_end, footprint, vi_name, tag, grids_ext)
+    datapath = '%s_cube' % vi_name
+    with open_grids(fpath, 'r') as h5file:
+        if datapath not in h5file:
+            message('input error: %s has no %s datacube' % (fpath, vi_name))
+            sys.exit(1)
+        dates = date_strings(h5file['dates'])
+        union_mask = np.array(h5file['union_mask'], dtype=np.uint8)
+        cube_shape = h5file[datapath].shape
+        cube_chunks = h5file[datapath].chunks
+        out_chunks = h5file['%s_nvals' % vi_name].chunks
+    nrows, ncols = np.shape(union_mask)
+    nfiles = len(dates)
+    t = decimal_years(dates, year_begin)
+    block = max(1, (max_bytes // 2) // trend_pixel_bytes(nfiles))
+    message('%s trends from %s (%d scenes)' % (vi_name.upper(), fpath, nfiles))
+    message('- %d pixels per block' % block)
+    #
+    pixel_index = union_pixel_index(union_mask)
+    npix = len(pixel_index)
+    flat_grids = [np.zeros(npix, dtype=np.float32) for name in trend_names]
+    if options.output_format == 'zarr' or cube_chunks is None:
+        h5file = open_grids(fpath, 'r')
+    else:
+        rdcc_nbytes, rdcc_nslots = cube_cache(cube_shape, cube_chunks)
+        h5file = hdf.File(fpath, 'r', rdcc_nbytes=rdcc_nbytes,
+                          rdcc_nslots=rdcc_nslots)
+    evaluated = 0
+    next_report = 0
+    for p0, p1, vals in cube_blocks(h5file[datapath], union_mask, block,
+                                    max_bytes // 2):
+        returns = trend_block(vals, t, options.min_obs)
+        for flat_grid, trend in zip(flat_grids, returns[1:]):
+            flat_grid[p0:p1] = trend
+        evaluated += np.sum(returns[0] >= options.min_obs)
+        if p1 >= next_report or p1 == npix:
+            message('- %d of %d pixels done: %d with trends' %
+                    (p1, npix, evaluated))
+            next_report = p1 + max(npix // 10, 1)
+    h5file.close()
+    #
+    message('- saving %s trend grids to %s' % (vi_name.upper(), fpath))
+    with open_grids(fpath, 'r+') as h5file:
+        save_pixel_grids(h5file, [('%s_%s' % (vi_name, name), flat_grid, fill)
+                                  for name, flat_grid, fill
+                                  in zip(trend_names, flat_grids,
+                                         trend_fills)],
+                         pixel_index, (nrows, ncols), out_chunks)
+        save_meta(h5file, [('meta/trend_min_obs', options.min_obs),
+                           ('meta/trend_origin', year_begin),
+                           ('meta/last_updated',
+                            datetime.datetime.now().isoformat()),
+                           ('meta/at', 'process_L57_10 (vi trends)')])
+    message(' ')
+#
+message('process_L57_10.py completed at %s' %
+        datetime.datetime.now().isoformat())
+message(' ')
+sys.exit(0)
+
+# end process_L57_10.py
@@ -0,0 +1,206 @@
+"""
+Python script "process_L57_11.py"
+by Matthew Garcia, PhD student
+Dept. of Forest and Wildlife Ecology
+University of Wisconsin - Madison
+matt.e.garcia@gmail.com
+
+Copyright (C) 2014-2016 by Matthew Garcia
+Licensed Gnu GPL v3; see 'LICENSE_GnuGPLv3.txt' for complete terms
+Send questions, bug reports, any related requests to matt.e.garcia@gmail.com
+See also 'README.md', 'DISCLAIMER.txt', 'ACKNOWLEDGEMENTS.txt'
+Treat others as you would be treated. Pay it forward. Valar dohaeris.
+
+PURPOSE: Per-pixel harmonic (seasonal) models of the VI time series in a
+         process_L57_08.py grids file: mean, optional linear trend, and
+         annual/semiannual/... cosine and sine terms, fitted by least
+         squares to each pixel's valid values, plus gap-free synthetic VI
+         grids from the fitted models
+
+DEPENDENCIES: h5py, numpy
+              Stack_Stats depends on numpy
+
+USAGE: '$ python process_L57_11.py ./P26R27 p026r027 1984 2013 NDII'
+       or, for several VIs,
+       '$ python process_L57_11.py ./P26R27 p026r027 1984 2013 NDVI,NDII,NBR'
+       with options
+       '--harmonics 2' to set the number of harmonics (1 = annual only)
+       '--trend' to include a linear trend term
+       '--predict 2013_196,2013_227' to also write model VI grids for those
+           dates ('YYYY_DOY')
+       '--max-memory 8GB' to limit the memory used by the blocks in progress
+       '--min-obs 12' to set the fewest valid values for a pixel's model
+       '--doy 150-250' and/or '--months 6-8' to use the grids file made
+           with the same seasonal window
+       '--output-format zarr' to use <...>_grids.zarr directory stores
+
+NOTE: The design matrix is built once from the scene dates in the grids
+      file, with time in years since 1 January of year_begin. The VI
+      datacube is read in blocks of union mask pixels, as in
+      process_L57_10.py, and each block is fitted at once: every pixel's
+      normal equations (over its own valid values, > 0) are summed with one
+      einsum and solved together with one batched np.linalg.solve, instead
+      of one least squares fit per pixel. Pixels with fewer than --min-obs
+      (or number of terms + 1) valid values, or whose dates do not spread
+      over enough of the year to fit every term, get 0 in every grid.
+      Seasonal windows leave most of the year without values, so fit them
+      with '--harmonics 1' or not at all.
+
+INPUT: Output of process_L57_08.py, with its VI datacube
+
+OUTPUT: '<vi>_harm_<term>' coefficient grids (terms 'mean', 'trend',
+        'cos1', 'sin1', 'cos2', 'sin2', ...), '<vi>_harm_rmse' and any
+        '<vi>_harm_<YYYY_DOY>' model grids added to each grids file
+        (replacing any harmonic grids from an earlier run)
+"""
+
+
+import sys
+import datetime
+import argparse
+import h5py as hdf
+import numpy as np
+from Stack_Stats import parse_memory, add_grids_options, window_tag, \
+    cube_cache, union_pixel_index, cube_blocks, save_pixel_grids, \
+    save_meta, date_strings, decimal_years, harmonic_terms, \
+    harmonic_design, harmonic_pixel_bytes, harmonic_fit
+from Chunk_Store import open_store
+
+
+def message(char_string):
+    """
+    prints a string to the terminal and flushes the buffer
+    """
+    print(char_string)
+    sys.stdout.flush()
+    return
+
+
+max_memory = '8GB'
+min_obs = 12
+nharmonics = 2
+
+
+message(' ')
+message('process_L57_11.py started at %s' %
+        datetime.datetime.now().isoformat())
+message(' ')
+#
+if len(sys.argv) < 6:
+    message('input error: need VI calculation details')
+    sys.exit(1)
+else:
+    footprint = sys.argv[2]
+    year_begin = int(sys.argv[3])
+    year_end = int(sys.argv[4])
+    vi_names = [vi_name.strip().lower() for vi_name in sys.argv[5].split(',')]
+#
+if len(sys.argv) < 2:
+    message('input error: need directory path')
+    sys.exit(1)
+else:
+    path = sys.argv[1]
+#
+parser = argparse.ArgumentParser(
+    prog='process_L57_11.py path footprint year_begin year_end vi_names')
+parser.add_argument('--harmonics', type=int, default=nharmonics,
+                    help='number of harmonics (1 = annual cycle only)')
+parser.add_argument('--trend', action='store_true',
+                    help='include a linear trend term')
+parser.add_argument('--predict', default=None,
+                    help='dates (YYYY_DOY) for model VI grids')
+add_grids_options(parser, max_memory)
+parser.add_argument('--min-obs', type=int, default=min_obs,
+                    help='fewest valid values for a pixel\'s model')
+options = parser.parse_args(sys.argv[6:])
+max_bytes = parse_memory(options.max_memory)
+terms = harmonic_terms(options.harmonics, options.trend)
+nterms = len(terms)
+predict_dates = []
+if options.predict is not None:
+    predict_dates = [date.strip() for date in options.predict.split(',')]
+out_names = ['harm_%s' % term for term in terms] + ['harm_rmse'] + \
+    ['harm_%s' % date for date in predict_dates]
+if options.output_format == 'zarr':
+    grids_ext = '.zarr'
+    open_grids = open_store
+else:
+    grids_ext = '.h5'
+    open_grids = hdf.File
+tag = window_tag(options.doy, options.months)
+#
+message('working in directory %s' % path)
+message(' ')
+for vi_name in vi_names:
+    fpath = '%s/%d-%d_%s_%s%s_grids%s' % \
+        (path, year_begin, year_end, footprint, vi_name, tag, grids_ext)
+    datapath = '%s_cube' % vi_name
+    with open_grids(fpath, 'r') as h5file:
+        if datapath not in h5file:
+            message('input error: %s has no %s datacube' % (fpath, vi_name))
+            sys.exit(1)
+        dates = date_strings(h5file['dates'])
+        union_mask = np.array(h5file['union_mask'], dtype=np.uint8)
+        cube_shape = h5file[datapath].shape
+        cube_chunks = h5file[datapath].chunks
+        out_chunks = h5file['%s_nvals' % vi_name].chunks
+    nrows, ncols = np.shape(union_mask)
+    nfiles = len(dates)
+    X = harmonic_design(decimal_years(dates, year_begin), options.harmonics,
+                        options.trend)
+    X_predict = harmonic_design(decimal_years(predict_dates, year_begin),
+                                options.harmonics, options.trend)
+    block = max(1, (max_bytes // 2) // harmonic_pixel_bytes(nfiles, nterms))
+    message('%s %d-term harmonic models from %s (%d scenes)' %
+            (vi_name.upper(), nterms, fpath, nfiles))
+    message('- %d pixels per block' % block)
+    #
+    pixel_index = union_pixel_index(union_mask)
+    npix = len(pixel_index)
+    flat_grids = [np.zeros(npix, dtype=np.float32) for name in out_names]
+    if options.output_format == 'zarr' or cube_chunks is None:
+        h5file = open_grids(fpath, 'r')
+    else:
+        rdcc_nbytes, rdcc_nslots = cube_cache(cube_shape, cube_chunks)
+        h5file = hdf.File(fpath, 'r', rdcc_nbytes=rdcc_nbytes,
+                          rdcc_nslots=rdcc_nslots)
+    evaluated = 0
+    next_report = 0
+    for p0, p1, vals in cube_blocks(h5file[datapath], union_mask, block,
+                                    max_bytes // 2):
+        nvals, coefs, rmse = harmonic_fit(vals, X, options.min_obs)
+        fitted = np.any(coefs != 0.0, axis=0)
+        predicted = np.where(fitted, np.dot(X_predict, coefs), 0.0)
+        for flat_grid, grid_vals in zip(flat_grids, list(coefs) + [rmse] +
+                                        list(predicted)):
+            flat_grid[p0:p1] = grid_vals
+        evaluated += np.sum(fitted)
+        if p1 >= next_report or p1 == npix:
+            message('- %d of %d pixels done: %d with models' %
+                    (p1, npix, evaluated))
+            next_report = p1 + max(npix // 10, 1)
+    h5file.close()
+    #
+    message('- saving %s harmonic grids to %s' % (vi_name.upper(), fpath))
+    with open_grids(fpath, 'r+') as h5file:
+        for name in list(h5file.keys()):
+            if name.startswith('%s_harm_' % vi_name):
+                del h5file[name]
+        save_pixel_grids(h5file, [('%s_%s' % (vi_name, name), flat_grid, 0.0)
+                                  for name, flat_grid
+                                  in zip(out_names, flat_grids)],
+                         pixel_index, (nrows, ncols), out_chunks)
+        save_meta(h5file, [('meta/harmonic_terms', terms),
+                           ('meta/harmonic_min_obs', options.min_obs),
+                           ('meta/harmonic_origin', year_begin),
+                           ('meta/last_updated',
+                            datetime.datetime.now().isoformat()),
+                           ('meta/at', 'process_L57_11 (vi harmonics)')])
+    message(' ')
+#
+message('process_L57_11.py completed at %s' %
+        datetime.datetime.now().isoformat())
+message(' ')
+sys.exit(0)
+
+# end process_L57_11.py
@@ -0,0 +1,316 @@
+"""
+Python script "process_L57_12.py"
+by Matthew Garcia, PhD student
+Dept. of Forest and Wildlife Ecology
+University of Wisconsin - Madison
+matt.e.garcia@gmail.com
+
+Copyright (C) 2014-2016 by Matthew Garcia
+Licensed Gnu GPL v3; see 'LICENSE_GnuGPLv3.txt' for complete terms
+Send questions, bug reports, any related requests to matt.e.garcia@gmail.com
+See also 'README.md', 'DISCLAIMER.txt', 'ACKNOWLEDGEMENTS.txt'
+Treat others as you would be treated. Pay it forward. Valar dohaeris.
+
+PURPOSE: Best-available-pixel annual composites: for each year, the six
+         level2 reflectance bands of one clear (scswumask) observation per
+         union mask pixel, chosen by maximum NDVI, by the date closest to a
+         target day of year, or as the medoid of the year's observations
+
+DEPENDENCIES: h5py, numpy
+              Stack_Stats depends on numpy
+
+USAGE: '$ python process_L57_12.py ./P26R27 p026r027 1984 2013 maxndvi'
+       or
+       '$ python process_L57_12.py ./P26R27 p026r027 1984 2013 doy \
+            --target-doy 200'
+       or
+       '$ python process_L57_12.py ./P26R27 p026r027 1984 2013 medoid'
+       with options
+       '--max-memory 8GB' to limit the memory used by the tile in progress
+       '--doy 150-250' and/or '--months 6-8' to use only scenes acquired in
+           a seasonal window (as in process_L57_08.py)
+
+NOTE: Each year is composited in tiles (bands of rows): the tile's rows of
+      scswumask and the level2 bands (and NDVI, for 'maxndvi') are read
+      from each of the year's scenes, every clear observation of every
+      union mask pixel is scored at once, the winners are picked with one
+      argmax over the year's observations, and their bands are gathered
+      and written to the composite file before the next tile is read. So
+      memory use is set by --max-memory, not by the number of scenes in a
+      year. The medoid is the clear observation with the smallest summed
+      (Euclidean, six-band) distance to the pixel's other clear
+      observations that year; it needs every pair of a year's scenes, so
+      its tiles are smaller. Ties go to the earliest scene. Pixels with no
+      clear observation in a year are 0 in every composite grid.
+
+INPUT: Outputs of process_L57_05.py through process_L57_07.py
+
+OUTPUT: One composite file per year, e.g.
+        1995_p026r027_maxndvi_composite.h5 (or ..._doy200_composite.h5,
+        with any seasonal window tag as in process_L57_08.py), with
+        'composite/b1_refl' ... 'composite/b7_refl', the chosen day of year
+        in 'composite/doy' and the number of clear observations in
+        'composite/nobs'
+"""
+
+
+import sys
+import datetime
+import argparse
+import glob
+import h5py as hdf
+import numpy as np
+from Stack_Stats import parse_memory, tile_rows_for_memory, \
+    tile_cell_bytes, union_pixel_index
+
+
+def message(char_string):
+    """
+    prints a string to the terminal and flushes the buffer
+    """
+    print(char_string)
+    sys.stdout.flush()
+    return
+
+
+def parse_window(window, vmax):
+    """
+    set of allowed values (1 to vmax) in a window string of comma-separated
+    values and ranges, e.g. '150-250' or '12,1-2'; a range whose start is
+    after its end wraps around, e.g. '330-60'
+    """
+    allowed = set()
+    for part in window.split(','):
+        bounds = [int(bound) for bound in part.split('-')]
+        if len(bounds) == 1:
+            allowed.add(bounds[0])
+        elif bounds[0] <= bounds[1]:
+            allowed.update(range(bounds[0], bounds[1] + 1))
+        else:
+            allowed.update(range(bounds[0], vmax + 1))
+            allowed.update(range(1, bounds[1] + 1))
+    return allowed
+
+
+def composite_pixel_bytes(nscenes, method):
+    """
+    approximate bytes per pixel of a tile: the bands, mask and scores of
+    every scene, plus the pairwise distances for a medoid
+    """
+    pixel_bytes = nscenes * (len(band_names) + 2) * 4 + \
+        nscenes * tile_cell_bytes
+    if method == 'medoid':
+        pixel_bytes += nscenes * nscenes * 12
+    return pixel_bytes
+
+
+def medoid_scores(bands, clear):
+    """
+    negated sum of six-band distances from each clear observation to the
+    other clear observations of the same pixel, for (nscenes, nbands, npix)
+    bands and an (nscenes, npix) clear mask
+    """
+    dist = np.zeros((len(clear), len(clear), np.shape(clear)[1]),
+                    dtype=np.float32)
+    for b in range(np.shape(bands)[1]):
+        diff = bands[:, None, b, :] - bands[None, :, b, :]
+        dist += diff * diff
+    np.sqrt(dist, out=dist)
+    return -np.sum(dist * clear[None, :, :], axis=1)
+
+
+def composite_tile(h5infiles, scene_doys, r0, r1):
+    """
+    composite bands, chosen day of year and number of clear observations
+    for the union mask pixels in rows r0:r1 of a year's scenes
+    """
+    idx = union_pixel_index(union_mask[r0:r1, :])
+    nidx = len(idx)
+    nscenes = len(h5infiles)
+    bands = np.zeros((nscenes, len(band_names), nidx), dtype=np.float32)
+    clear = np.zeros((nscenes, nidx), dtype=bool)
+    scores = np.zeros((nscenes, nidx), dtype=np.float32)
+    for k, h5infile in enumerate(h5infiles):
+        clear[k, :] = \
+            np.ravel(h5infile['masks/scswumask'][r0:r1, :])[idx] == 1
+        for b, band_name in enumerate(band_names):
+            bands[k, b, :] = np.ravel(
+                h5infile['level2/%s_scswmask' % band_name][r0:r1, :])[idx]
+        if method == 'maxndvi':
+            scores[k, :] = np.ravel(h5infile['level3/ndvi'][r0:r1, :])[idx]
+        elif method == 'doy':
+            scores[k, :] = -abs(scene_doys[k] - options.target_doy)
+    if method == 'medoid':
+        scores = medoid_scores(bands, clear)
+    scores[~clear] = -np.inf
+    best = np.argmax(scores, axis=0)
+    nobs = np.sum(clear, axis=0)
+    cols = np.arange(nidx)
+    composite = np.where(nobs > 0, bands[best, :, cols].T, 0.0)
+    best_doy = np.where(nobs > 0, np.array(scene_doys)[best], 0)
+    return idx, composite, best_doy, nobs
+
+
+band_names = ['b1_refl', 'b2_refl', 'b3_refl', 'b4_refl', 'b5_refl',
+              'b7_refl']
+max_memory = '8GB'
+target_doy = 200
+
+
+message(' ')
+message('process_L57_12.py started at %s' %
+        datetime.datetime.now().isoformat())
+message(' ')
+#
+if len(sys.argv) < 6:
+    message('input error: need composite details')
+    sys.exit(1)
+else:
+    footprint = sys.argv[2]
+    year_begin = int(sys.argv[3])
+    year_end = int(sys.argv[4])
+    method = sys.argv[5].lower()
+if method not in ['maxndvi', 'doy', 'medoid']:
+    message('input error: method must be \'maxndvi\', \'doy\' or \'medoid\'')
+    sys.exit(1)
+#
+if len(sys.argv) < 2:
+    message('input error: need directory path')
+    sys.exit(1)
+else:
+    path = sys.argv[1]
+#
+parser = argparse.ArgumentParser(
+    prog='process_L57_12.py path footprint year_begin year_end method')
+parser.add_argument('--target-doy', type=int, default=target_doy,
+                    help='target day of year for the \'doy\' method')
+parser.add_argument('--max-memory', default=max_memory,
+                    help='memory limit for the tile in progress, e.g. 8GB')
+parser.add_argument('--doy', default=None,
+                    help='day of year window, e.g. 150-250')
+parser.add_argument('--months', default=None,
+                    help='month window, e.g. 6-8')
+options = parser.parse_args(sys.argv[6:])
+max_bytes = parse_memory(options.max_memory)
+method_tag = method
+if method == 'doy':
+    method_tag = 'doy%d' % options.target_doy
+#
+message('working in directory %s' % path)
+window_tag = ''
+if options.doy is not None:
+    doys = parse_window(options.doy, 366)
+    window_tag += '_doy%s' % options.doy.replace(',', '+')
+if options.months is not None:
+    months = parse_window(options.months, 12)
+    window_tag += '_m%s' % options.months.replace(',', '+')
+flist = sorted(glob.glob('%s/*_clipped.h5' % path))
+year_files = {}
+for file_path in flist:
+    path_parts = file_path.split('/')
+    h5yr = int(path_parts[-1][:4])
+    if h5yr < year_begin or h5yr > year_end:
+        continue
+    if options.doy is not None and int(path_parts[-1][9:12]) not in doys:
+        continue
+    if options.months is not None and \
+            int(path_parts[-1][4:6]) not in months:
+        continue
+    year_files.setdefault(h5yr, []).append(file_path)
+message('found %d Landsat files in specified date range' %
+        sum([len(files) for files in year_files.values()]))
+if window_tag != '':
+    message('- using only scenes in seasonal window (%s)' % window_tag[1:])
+if len(year_files) == 0:
+    message('input error: no scenes to composite')
+    sys.exit(1)
+#
+first_file = year_files[min(year_files.keys())][0]
+message('extracting metadata info and union (forest) mask from %s' %
+        first_file)
+with hdf.File(first_file, 'r') as h5infile:
+    projection = np.copy(h5infile['meta/projection'])
+    clipbounds = np.copy(h5infile['meta/clip_bounds'])
+    union_mask = np.array(h5infile['masks/forest/union'], dtype=np.uint8)
+    chunk_rows = h5infile['level2/b1_refl_scswmask'].chunks
+if chunk_rows is not None:
+    chunk_rows = chunk_rows[0]
+UTM_zone = int(projection[1])
+UTM_bounds = clipbounds[0:4]
+nrows, ncols = np.shape(union_mask)
+message(' ')
+#
+for year in sorted(year_files.keys()):
+    h5list = year_files[year]
+    scene_doys = [int(scene_path.split('/')[-1][9:12])
+                  for scene_path in h5list]
+    dates = ['%d_%03d' % (year, doy) for doy in scene_doys]
+    tile_rows = tile_rows_for_memory(max_bytes,
+                                     composite_pixel_bytes(len(h5list),
+                                                           method),
+                                     nrows, ncols, chunk_rows=chunk_rows,
+                                     grid_bytes=1 + 4 * len(band_names))
+    out_chunks = (tile_rows, min(ncols, 1024))
+    outfile = '%s/%d_%s_%s%s_composite.h5' % \
+        (path, year, footprint, method_tag, window_tag)
+    message('%d: %s composite of %d scenes in tiles of %d rows' %
+            (year, method_tag, len(h5list), tile_rows))
+    h5infiles = [hdf.File(scene_path, 'r') for scene_path in h5list]
+    with hdf.File(outfile, 'w') as h5outfile:
+        h5outfile.create_dataset('meta/filename', data=outfile)
+        h5outfile.create_dataset('meta/created',
+                                 data=datetime.datetime.now().isoformat())
+        h5outfile.create_dataset('meta/by', data='M. Garcia, UW-Madison')
+        h5outfile.create_dataset('meta/last_updated',
+                                 data=datetime.datetime.now().isoformat())
+        h5outfile.create_dataset('meta/at',
+                                 data='process_L57_12 (annual composite)')
+        h5outfile.create_dataset('meta/UTM_zone', data=UTM_zone)
+        h5outfile.create_dataset('meta/UTM_bounds', data=UTM_bounds)
+        h5outfile.create_dataset('meta/method', data=method)
+        if method == 'doy':
+            h5outfile.create_dataset('meta/target_doy',
+                                     data=options.target_doy)
+        if options.doy is not None:
+            h5outfile.create_dataset('meta/doy_window', data=options.doy)
+        if options.months is not None:
+            h5outfile.create_dataset('meta/month_window', data=options.months)
+        h5outfile.create_dataset('union_mask', data=union_mask, dtype=np.int8,
+                                 compression='gzip')
+        h5outfile.create_dataset('dates', data=dates, compression='gzip')
+        for band_name in band_names:
+            h5outfile.create_dataset('composite/%s' % band_name,
+                                     (nrows, ncols), dtype=np.float32,
+                                     chunks=out_chunks, compression='gzip')
+        for name in ['doy', 'nobs']:
+            h5outfile.create_dataset('composite/%s' % name, (nrows, ncols),
+                                     dtype=np.int16, chunks=out_chunks,
+                                     compression='gzip')
+        npix = 0
+        for r0 in range(0, nrows, tile_rows):
+            r1 = min(r0 + tile_rows, nrows)
+            idx, composite, best_doy, nobs = \
+                composite_tile(h5infiles, scene_doys, r0, r1)
+            for b, band_name in enumerate(band_names):
+                grid = np.zeros((r1 - r0) * ncols, dtype=np.float32)
+                grid[idx] = composite[b]
+                h5outfile['composite/%s' % band_name][r0:r1, :] = \
+                    grid.reshape((r1 - r0, ncols))
+            for name, vals in [('doy', best_doy), ('nobs', nobs)]:
+                grid = np.zeros((r1 - r0) * ncols, dtype=np.int16)
+                grid[idx] = vals
+                h5outfile['composite/%s' % name][r0:r1, :] = \
+                    grid.reshape((r1 - r0, ncols))
+            npix += np.sum(nobs > 0)
+    for h5infile in h5infiles:
+        h5infile.close()
+    message('- %d of %d union mask pixels composited, wrote %s' %
+            (npix, np.sum(union_mask), outfile))
+message(' ')
+#
+message('process_L57_12.py completed at %s' %
+        datetime.datetime.now().isoformat())
+message(' ')
+sys.exit(0)
+
+# end process_L57_12.py
@@ -0,0 +1,249 @@
+"""
+Python script "process_L57_13.py"
+by Matthew Garcia, PhD student
+Dept. of Forest and Wildlife Ecology
+University of Wisconsin - Madison
+matt.e.garcia@gmail.com
+
+Copyright (C) 2014-2016 by Matthew Garcia
+Licensed Gnu GPL v3; see 'LICENSE_GnuGPLv3.txt' for complete terms
+Send questions, bug reports, any related requests to matt.e.garcia@gmail.com
+See also 'README.md', 'DISCLAIMER.txt', 'ACKNOWLEDGEMENTS.txt'
+Treat others as you would be treated. Pay it forward. Valar dohaeris.
+
+PURPOSE: Zonal VI statistics for every scene in a period: count, sum, sum
+         of squares, minimum, maximum, mean and std of the clear-sky values
+         in each zone of a zone grid (forest types, NLCD classes, or a
+         user-supplied grid of e.g. management units)
+
+DEPENDENCIES: h5py, numpy, pandas
+              Stack_Stats depends on numpy
+
+USAGE: '$ python process_L57_13.py ./P26R27 p026r027 1984 2013 NDVI,NDII'
+       with options
+       '--zones forest' (default) for the deciduous, evergreen, mixed and
+           wetlands forest masks of each scene
+       '--zones nlcd' for the NLCD land cover classes of each scene
+       '--zones ./P26R27/units.h5' for the (non-negative) integer 'zones'
+           grid in that file, on the same grid as the clipped scenes
+       '--max-memory 8GB' to limit the memory used by the tile in progress
+
+NOTE: Each scene is read once, in tiles (bands of rows), and all of the
+      zones and VIs are summed in that one pass: the clear-sky (scswmask)
+      pixels of a tile are labeled with their zone, np.bincount adds up
+      their counts, sums and sums of squares per zone, and the minima and
+      maxima come from np.minimum/np.maximum.reduceat over the values
+      sorted by zone. Zone 0 is left out (no forest type, no NLCD class,
+      or outside every user zone). 'npix' is the number of pixels of the
+      zone in the scene, clear or not, so count / npix is the clear
+      fraction. The forest and NLCD zones follow each scene's own NLCD
+      year.
+
+INPUT: Outputs of process_L57_06.py and process_L57_07.py
+
+OUTPUT: A CSV table, e.g. 1984-2013_p026r027_forest_zonal.csv, with one
+        row per scene, zone and VI: 'date' (YYYY_DOY), 'zone', 'vi',
+        'npix', 'count', 'sum', 'sumsq', 'min', 'max', 'mean' and 'std'
+"""
+
+
+import sys
+import datetime
+import argparse
+import glob
+import h5py as hdf
+import numpy as np
+import pandas as pd
+from Stack_Stats import parse_memory, tile_rows_for_memory
+
+
+def message(char_string):
+    """
+    prints a string to the terminal and flushes the buffer
+    """
+    print(char_string)
+    sys.stdout.flush()
+    return
+
+
+def zone_tile(h5infile, r0, r1):
+    """ zone number of each pixel in rows r0:r1 of a scene """
+    if options.zones == 'forest':
+        zones = np.zeros((r1 - r0, ncols), dtype=np.int64)
+        for z, name in enumerate(forest_zones):
+            mask = np.array(h5infile['masks/forest/%s' % name][r0:r1, :])
+            zones[mask == 1] = z + 1
+        return zones
+    if options.zones == 'nlcd':
+        # lc_clip is stored as int8, so codes > 127 (e.g. 255) come back
+        #   negative
+        return np.array(h5infile['nlcd/lc_clip'][r0:r1, :]).astype(
+            np.uint8).astype(np.int64)
+    return np.maximum(np.array(zone_grid[r0:r1, :], dtype=np.int64), 0)
+
+
+def zone_sums(zones, vals, nzones):
+    """
+    per-zone count, sum, sum of squares, minimum and maximum of vals (1-D,
+    labeled by zones), as a (5, nzones) array in one pass
+    """
+    sums = np.zeros((5, nzones))
+    sums[3] = np.inf
+    sums[4] = -np.inf
+    if len(vals) == 0:
+        return sums
+    x = vals.astype(np.float64)
+    sums[0] = np.bincount(zones, minlength=nzones)
+    sums[1] = np.bincount(zones, weights=x, minlength=nzones)
+    sums[2] = np.bincount(zones, weights=x * x, minlength=nzones)
+    order = np.argsort(zones, kind='mergesort')
+    zones_sorted = zones[order]
+    starts = np.flatnonzero(np.diff(np.concatenate(([-1], zones_sorted))))
+    present = zones_sorted[starts]
+    sums[3, present] = np.minimum.reduceat(x[order], starts)
+    sums[4, present] = np.maximum.reduceat(x[order], starts)
+    return sums
+
+
+def merge_sums(sums_a, sums_b):
+    """ combine two sets of zone_sums() """
+    sums = sums_a + sums_b
+    sums[3] = np.minimum(sums_a[3], sums_b[3])
+    sums[4] = np.maximum(sums_a[4], sums_b[4])
+    return sums
+
+
+forest_zones = ['deciduous', 'evergreen', 'mixed', 'wetlands']
+max_memory = '8GB'
+
+
+message(' ')
+message('process_L57_13.py started at %s' %
+        datetime.datetime.now().isoformat())
+message(' ')
+#
+if len(sys.argv) < 6:
+    message('input error: need VI calculation details')
+    sys.exit(1)
+else:
+    footprint = sys.argv[2]
+    year_begin = int(sys.argv[3])
+    year_end = int(sys.argv[4])
+    vi_names = [vi_name.strip().lower() for vi_name in sys.argv[5].split(',')]
+#
+if len(sys.argv) < 2:
+    message('input error: need directory path')
+    sys.exit(1)
+else:
+    path = sys.argv[1]
+#
+parser = argparse.ArgumentParser(
+    prog='process_L57_13.py path footprint year_begin year_end vi_names')
+parser.add_argument('--zones', default='forest',
+                    help='\'forest\', \'nlcd\' or an h5 file with a '
+                         '\'zones\' grid')
+parser.add_argument('--max-memory', default=max_memory,
+                    help='memory limit for the tile in progress, e.g. 8GB')
+options = parser.parse_args(sys.argv[6:])
+max_bytes = parse_memory(options.max_memory)
+#
+message('working in directory %s' % path)
+flist = sorted(glob.glob('%s/*_clipped.h5' % path))
+h5list = [file_path for file_path in flist
+          if year_begin <= int(file_path.split('/')[-1][:4]) <= year_end]
+message('found %d Landsat files in specified date range' % len(h5list))
+if len(h5list) == 0:
+    message('input error: no scenes to process')
+    sys.exit(1)
+with hdf.File(h5list[0], 'r') as h5infile:
+    nrows, ncols = h5infile['masks/scswmask'].shape
+    chunk_rows = h5infile['level3/' + vi_names[0]].chunks
+if chunk_rows is not None:
+    chunk_rows = chunk_rows[0]
+#
+zone_file = None
+if options.zones == 'forest':
+    nzones = len(forest_zones) + 1
+    zone_names = [''] + forest_zones
+    zones_tag = 'forest'
+elif options.zones == 'nlcd':
+    nzones = 256
+    zone_names = [str(code) for code in range(nzones)]
+    zones_tag = 'nlcd'
+else:
+    zone_file = hdf.File(options.zones, 'r')
+    zone_grid = zone_file['zones']
+    if zone_grid.shape != (nrows, ncols):
+        message('input error: %s zones grid is %s, scene grids are %s' %
+                (options.zones, str(zone_grid.shape), str((nrows, ncols))))
+        sys.exit(1)
+    nzones = int(np.max(zone_grid)) + 1
+    zone_names = [str(zone) for zone in range(nzones)]
+    zones_tag = options.zones.split('/')[-1].rsplit('.', 1)[0]
+message('summing %s over %s zones' %
+        (', '.join([vi_name.upper() for vi_name in vi_names]), zones_tag))
+#
+# zones, mask and VI tiles as int64/float64 working copies
+pixel_bytes = 8 * (len(vi_names) + 2) * 3
+tile_rows = tile_rows_for_memory(max_bytes, pixel_bytes, nrows, ncols,
+                                 chunk_rows=chunk_rows)
+message('- reading each scene in tiles of %d rows' % tile_rows)
+message(' ')
+#
+tables = []
+for scene_path in h5list:
+    scene_file = scene_path.split('/')[-1]
+    date = '%s_%s' % (scene_file[:4], scene_file[9:12])
+    npix = np.zeros(nzones)
+    scene_sums = dict([(vi_name, zone_sums(np.zeros(0, dtype=np.int64),
+                                           np.zeros(0), nzones))
+                       for vi_name in vi_names])
+    with hdf.File(scene_path, 'r') as h5infile:
+        for r0 in range(0, nrows, tile_rows):
+            r1 = min(r0 + tile_rows, nrows)
+            zones = zone_tile(h5infile, r0, r1)
+            npix += np.bincount(zones.ravel(), minlength=nzones)
+            clear = (np.array(h5infile['masks/scswmask'][r0:r1, :]) == 1) & \
+                (zones > 0)
+            tile_zones = zones[clear]
+            for vi_name in vi_names:
+                vals = np.array(h5infile['level3/' + vi_name][r0:r1, :])
+                scene_sums[vi_name] = merge_sums(
+                    scene_sums[vi_name],
+                    zone_sums(tile_zones, vals[clear], nzones))
+    present = np.flatnonzero(npix[1:]) + 1
+    for vi_name in vi_names:
+        sums = scene_sums[vi_name][:, present]
+        count = sums[0]
+        mean = sums[1] / np.maximum(count, 1.0)
+        var = np.maximum(sums[2] / np.maximum(count, 1.0) - mean * mean, 0.0)
+        tables.append(pd.DataFrame(
+            {'date': date, 'zone': [zone_names[z] for z in present],
+             'vi': vi_name, 'npix': npix[present].astype(np.int64),
+             'count': count.astype(np.int64), 'sum': sums[1],
+             'sumsq': sums[2],
+             'min': np.where(count > 0, sums[3], np.nan),
+             'max': np.where(count > 0, sums[4], np.nan),
+             'mean': np.where(count > 0, mean, np.nan),
+             'std': np.where(count > 0, np.sqrt(var), np.nan)},
+            columns=['date', 'zone', 'vi', 'npix', 'count', 'sum', 'sumsq',
+                     'min', 'max', 'mean', 'std']))
+    message('- %s: %d zones, %d clear zone pixels' %
+            (date, len(present), np.sum(scene_sums[vi_names[0]][0])))
+if zone_file is not None:
+    zone_file.close()
+message(' ')
+#
+outfile = '%s/%d-%d_%s_%s_zonal.csv' % \
+    (path, year_begin, year_end, footprint, zones_tag)
+table = pd.concat(tables, ignore_index=True)
+table.to_csv(outfile, index=False)
+message('wrote %d rows to %s' % (len(table), outfile))
+message(' ')
+#
+message('process_L57_13.py completed at %s' %
+        datetime.datetime.now().isoformat())
+message(' ')
+sys.exit(0)
+
+# end process_L57_13.py
@@ -0,0 +1,295 @@
+"""
+Python test module 'test_memory_budget.py'
+by Matthew Garcia, PhD student
+Dept. of Forest and Wildlife Ecology
+University of Wisconsin - Madison
+matt.e.garcia@gmail.com
+
+Copyright (C) 2014-2016 by Matthew Garcia
+Licensed Gnu GPL v3; see 'LICENSE_GnuGPLv3.txt' for complete terms
+Send questions, bug reports, any related requests to matt.e.garcia@gmail.com
+See also 'README.md', 'DISCLAIMER.txt', 'ACKNOWLEDGEMENTS.txt'
+Treat others as you would be treated. Pay it forward. Valar dohaeris.
+
+PURPOSE: Peak traced memory of processing stages 03-08 on a small synthetic
+         footprint, checked against a per-pixel budget for each stage, and
+         the HTCondor request_memory of each stage checked against what
+         that budget comes to for a full footprint
+
+DEPENDENCIES: pytest, h5py, numpy, matplotlib (for process_L57_05.py)
+              tracemalloc (Python 3.4+)
+
+USAGE: '$ python -m pytest tests' from the top of the repository
+
+NOTE: Each stage script is run in this process (as with '$ python ...')
+      with tracemalloc on, which counts the numpy arrays and other Python
+      allocations but not the interpreter and libraries themselves or
+      h5py's chunk caches (those are base_memory below); the shared memory
+      (RawArray) that process_L57_08.py makes is added to its peak. The
+      libraries are imported before tracing starts.
+
+      Stages 03-07 hold whole grids, so their budgets are bytes per pixel
+      of the (raw or clipped) scene grids, and stage 07 runs 8 processes
+      that each hold one scene's grids. process_L57_08.py holds tiles
+      under --max-memory, so its budget is a fraction of that limit (less
+      the reserve it keeps for the interpreter and open files).
+
+      A full P26R27 scene is about 7100 x 8200 raw pixels and 44.5M
+      clipped pixels (36GB of float32 datacube over 202 scenes). The
+      request_memory in each stage's HTCondor submit file is its budget
+      for those pixels (or for --max-memory 10GB), times its processes,
+      plus base_memory, rounded up to a whole GB.
+
+INPUT: synthetic scenes made here, laid out as process_L57_01.py and
+       process_L57_02.py leave them
+
+OUTPUT: pytest results
+"""
+
+
+import os
+import re
+import sys
+import datetime
+import runpy
+import importlib
+import ctypes
+import multiprocessing as mp
+import pytest
+import h5py as hdf
+import numpy as np
+
+tracemalloc = pytest.importorskip('tracemalloc')
+
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+source_dir = os.path.join(repo_dir, 'source')
+htcondor_dir = os.path.join(repo_dir, 'htcondor')
+
+
+# synthetic footprint: scenes, clipped grid size and raw border
+nscenes = 4
+nrows_clip = 240
+ncols_clip = 320
+border = 8
+
+
+# full footprint sizes that the HTCondor requests are made for
+raw_npix = 7100 * 8200
+clip_npix = 44500000
+
+
+# memory used by the interpreter, h5py/numpy and h5 chunk caches, which
+#   tracemalloc does not see
+base_memory = 1 << 30
+
+
+# peak traced bytes per raw (03) or clipped (04-07) pixel of one scene, and
+#   for stage 08 as a fraction of --max-memory (less reserve_bytes)
+stage_budgets = {'03': 20.0, '04': 72.0, '05': 72.0, '06': 104.0,
+                 '07': 24.0, '08': 0.95}
+
+
+# processes that each hold a stage's arrays in its HTCondor job (the stage
+#   08 workers share --max-memory)
+stage_processes = {'03': 1, '04': 1, '05': 1, '06': 1, '07': 8, '08': 1}
+
+
+# modules that the stages import
+imported_modules = ['matplotlib.pyplot', 'matplotlib.patches',
+                    'matplotlib.path', 'Scene_Stats', 'Stack_Stats',
+                    'Chunk_Store']
+optional_modules = ['numba', 'mpi4py']
+
+
+# stage 06 runs the NumPy index calculations, which hold more temporary
+#   grids than the fused numba kernels (and need no compiling)
+stage_06_backend = 'numpy'
+
+
+# stage 08 settings for the synthetic run and for the HTCondor job; its
+#   --max-memory includes reserve_bytes (Stack_Stats.tile_rows_for_memory)
+#   for the interpreter and open files, which tracemalloc does not see
+reserve_bytes = 256 << 20
+max_memory_08 = reserve_bytes + (16 << 20)
+htcondor_max_memory_08 = 10 << 30
+
+
+def make_footprint(path):
+    """
+    raw surface reflectance and cloud/shadow mask files plus the clipped
+    scene files with metadata and NLCD land cover, as left by
+    process_L57_01.py and process_L57_02.py
+    """
+    rng = np.random.RandomState(0)
+    nrows_raw = nrows_clip + 2 * border
+    ncols_raw = ncols_clip + 2 * border
+    lc_years = [1992, 2001, 2006, 2011]
+    lc_maps = {}
+    for lc_year in lc_years:
+        lc_maps[lc_year] = rng.choice([11, 21, 41, 42, 43, 90, 91, 81],
+                                      size=(nrows_clip, ncols_clip))
+    for s in range(nscenes):
+        year = 1984 + 8 * s
+        doy = 150 + 20 * s
+        date = datetime.date(year, 1, 1) + datetime.timedelta(doy - 1)
+        scene = '%s_%03d_lndsr_p026r027T5' % (date.strftime('%Y%m%d'), doy)
+        with open('%s/%s.h5.hdr' % (path, scene), 'w') as hdr_file:
+            hdr_file.write('ENVI\n')
+        with hdf.File('%s/%s.h5' % (path, scene), 'w') as h5file:
+            for b, band in enumerate(['band1', 'band2', 'band3', 'band4',
+                                      'band5', 'band7']):
+                refl = rng.uniform(0.01, 0.5, size=(nrows_raw, ncols_raw))
+                if band == 'band4':
+                    refl += 0.2
+                vals = (refl * 10000).astype(np.int16)
+                vals[rng.uniform(size=vals.shape) < 0.02] = -9999
+                h5file.create_dataset('Grid/Data Fields/%s' % band,
+                                      data=vals)
+        mask = rng.choice([0, 1, 2, 4, 255], p=[0.7, 0.05, 0.1, 0.1, 0.05],
+                          size=(nrows_raw, ncols_raw)).astype(np.uint8)
+        mask.tofile('%s/%s_csmask.dat' % (path, scene[:12]))
+        lc_year = max([lc_years[0]] + [y for y in lc_years if y <= year])
+        with hdf.File('%s/%s_clipped.h5' % (path, scene), 'w') as h5file:
+            h5file.create_dataset('meta/last_updated', data='synthetic')
+            h5file.create_dataset('meta/at', data='synthetic')
+            h5file.create_dataset('meta/projection',
+                                  data=[b'UTM', b'15', b'North', b'WGS-84',
+                                        b'Meters'])
+            h5file.create_dataset('meta/orig_grid',
+                                  data=[499760.0, 5000240.0, ncols_raw,
+                                        nrows_raw, 30.0, 0, 0])
+            # [W, N, E, S, Wcol, Nrow, Ecol, Srow, ncols_clip, nrows_clip]
+            h5file.create_dataset('meta/clip_bounds',
+                                  data=[500000.0, 5000000.0,
+                                        500000.0 + 30.0 * ncols_clip,
+                                        5000000.0 - 30.0 * nrows_clip,
+                                        border, border, border + ncols_clip,
+                                        border + nrows_clip, ncols_clip,
+                                        nrows_clip])
+            h5file.create_dataset('nlcd/lc_clip', data=lc_maps[lc_year],
+                                  dtype=np.int8, compression='gzip')
+            h5file.create_dataset('nlcd/meta/year', data=lc_year)
+    return
+
+
+def run_stage(stage, args):
+    """
+    run a stage script in this process and return its peak traced memory
+    plus any shared memory it made (bytes)
+    """
+    script = os.path.join(source_dir, 'process_L57_%s.py' % stage)
+    argv = sys.argv
+    sys.argv = [script] + [str(arg) for arg in args]
+    shared_bytes = [0]
+    raw_array = mp.RawArray
+
+    def counted_raw_array(typecode, size):
+        array = raw_array(typecode, size)
+        shared_bytes[0] += ctypes.sizeof(array)
+        return array
+    mp.RawArray = counted_raw_array
+    tracemalloc.start()
+    try:
+        runpy.run_path(script, run_name='__main__')
+    except SystemExit as exit_code:
+        assert exit_code.code in [0, None], \
+            'process_L57_%s.py %s failed' % (stage, ' '.join(sys.argv[1:]))
+    finally:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        mp.RawArray = raw_array
+        sys.argv = argv
+    return peak + shared_bytes[0]
+
+
+def request_memory(stage):
+    """ request_memory (bytes) in a stage's HTCondor submit file """
+    with open(os.path.join(htcondor_dir, 'process_L57_%s.sub' % stage),
+              'r') as sub_file:
+        for line in sub_file:
+            match = re.match(r'request_memory\s*=\s*(\d+)GB', line)
+            if match:
+                return int(match.group(1)) << 30
+    return 0
+
+
+@pytest.fixture(scope='module')
+def peaks(tmpdir_factory):
+    """ peak traced memory of each stage over the synthetic footprint """
+    path = str(tmpdir_factory.mktemp('P26R27'))
+    make_footprint(path)
+    sys.path.insert(0, source_dir)
+    stage_peaks = dict([(stage, 0) for stage in stage_budgets])
+    try:
+        # the stages' libraries are imported before tracing, so the peaks
+        #   are the stages' own arrays
+        importlib.import_module('matplotlib').use('Agg')
+        for module in imported_modules:
+            importlib.import_module(module)
+        for module in optional_modules:
+            try:
+                importlib.import_module(module)
+            except ImportError:
+                pass
+        for s in range(nscenes):
+            for stage, args in [('03', []), ('04', []), ('05', []),
+                                ('06', [stage_06_backend])]:
+                stage_peaks[stage] = max(stage_peaks[stage],
+                                         run_stage(stage, [path, s] + args))
+        stage_peaks['07'] = run_stage('07', [path])
+        stage_peaks['08'] = run_stage('08', [path, 'p026r027', 1984, 2013,
+                                             'NDVI,NDII', '50,90',
+                                             '--max-memory',
+                                             '%dB' % max_memory_08])
+    finally:
+        sys.path.remove(source_dir)
+    with hdf.File('%s/1984-2013_p026r027_ndii_grids.h5' % path,
+                  'r') as h5file:
+        assert h5file['meta/tile_rows'][()] < nrows_clip
+    return stage_peaks
+
+
+def stage_budget(stage):
+    """ peak memory budget (bytes) of a stage on the test footprint """
+    if stage == '03':
+        npix = (nrows_clip + 2 * border) * (ncols_clip + 2 * border)
+    elif stage == '08':
+        return stage_budgets[stage] * (max_memory_08 - reserve_bytes)
+    else:
+        npix = nrows_clip * ncols_clip
+    return stage_budgets[stage] * npix
+
+
+def stage_need(stage):
+    """ memory (bytes) that a stage's HTCondor job needs by its budget """
+    if stage == '03':
+        need = stage_budgets[stage] * raw_npix
+    elif stage == '08':
+        need = stage_budgets[stage] * (htcondor_max_memory_08 -
+                                       reserve_bytes)
+    else:
+        need = stage_budgets[stage] * clip_npix
+    return need * stage_processes[stage] + base_memory
+
+
+@pytest.mark.parametrize('stage', sorted(stage_budgets))
+def test_peak_memory(peaks, stage):
+    """ each stage stays within its budget on the synthetic footprint """
+    assert 0 < peaks[stage] <= stage_budget(stage), \
+        'process_L57_%s.py peak %d bytes, budget %d bytes' % \
+        (stage, peaks[stage], stage_budget(stage))
+
+
+@pytest.mark.parametrize('stage', sorted(stage_budgets))
+def test_request_memory(stage):
+    """
+    each HTCondor job asks for what its budget comes to, rounded up to a
+    whole GB
+    """
+    need = stage_need(stage)
+    assert need <= request_memory(stage) < need + (1 << 30), \
+        'process_L57_%s.sub request_memory should be %dGB' % \
+        (stage, -(-need // (1 << 30)))
+
+# end test_memory_budget.py
@@ -0,0 +1,134 @@
+"""
+Python script "convert_grids.py"
+by Matthew Garcia, PhD student
+Dept. of Forest and Wildlife Ecology
+University of Wisconsin - Madison
+matt.e.garcia@gmail.com
+
+Copyright (C) 2014-2016 by Matthew Garcia
+Licensed Gnu GPL v3; see 'LICENSE_GnuGPLv3.txt' for complete terms
+Send questions, bug reports, any related requests to matt.e.garcia@gmail.com
+See also 'README.md', 'DISCLAIMER.txt', 'ACKNOWLEDGEMENTS.txt'
+Treat others as you would be treated. Pay it forward. Valar dohaeris.
+
+PURPOSE: Convert a process_L57_08.py grids file from hdf5 to a chunk-per-file
+         directory store (Chunk_Store, Zarr v2 layout) or back again, with
+         the same dataset names, chunks and metadata
+
+DEPENDENCIES: h5py, numpy
+              Chunk_Store depends on numpy
+
+USAGE: '$ python convert_grids.py ./P26R27/1984-2013_p026r027_ndii_grids.h5'
+       makes ./P26R27/1984-2013_p026r027_ndii_grids.zarr, and
+       '$ python convert_grids.py ./P26R27/1984-2013_p026r027_ndii_grids.zarr'
+       makes ./P26R27/1984-2013_p026r027_ndii_grids.h5
+
+NOTE: Datasets are copied one block of chunks (along their first two axes)
+      at a time, so memory use is about one band of the datacube, as in
+      rechunk_cube.py. An existing output file or store is replaced.
+
+INPUT: Output of process_L57_08.py (either format)
+
+OUTPUT: The same grids in the other format
+"""
+
+
+import sys
+import datetime
+import h5py as hdf
+import numpy as np
+from Chunk_Store import open_store, is_store
+
+
+def message(char_string):
+    """
+    prints a string to the terminal and flushes the buffer
+    """
+    print(char_string)
+    sys.stdout.flush()
+    return
+
+
+def copy_dataset(src, dest, name, to_store):
+    """ copy one dataset, a block of chunks at a time """
+    dataset = src[name]
+    shape = dataset.shape
+    if len(shape) == 0 or dataset.dtype.kind in ['O', 'S', 'U']:
+        vals = dataset[()]
+        if len(shape) > 0 and dataset.dtype.kind == 'O':
+            vals = np.array(vals, dtype=bytes)
+        dest.create_dataset(name, data=vals)
+        return
+    chunks = dataset.chunks
+    if chunks is None:
+        chunks = shape
+    if to_store:
+        dest.create_dataset(name, shape, dtype=dataset.dtype, chunks=chunks)
+    else:
+        dest.create_dataset(name, shape, dtype=dataset.dtype, chunks=chunks,
+                            maxshape=(None,) + tuple(shape[1:]),
+                            compression='gzip')
+    block0 = chunks[0]
+    if len(shape) > 1:
+        block1 = chunks[1]
+    else:
+        block1 = 1
+    for b0 in range(0, shape[0], block0):
+        if len(shape) == 1:
+            dest[name][b0:b0 + block0] = dataset[b0:b0 + block0]
+            continue
+        for b1 in range(0, shape[1], block1):
+            dest[name][b0:b0 + block0, b1:b1 + block1] = \
+                dataset[b0:b0 + block0, b1:b1 + block1]
+    return
+
+
+def copy_group(src, dest, to_store):
+    """ copy every group and dataset in a group """
+    for name in src.keys():
+        if hasattr(src[name], 'keys'):
+            dest.create_group(name)
+            copy_group(src[name], dest[name], to_store)
+        else:
+            copy_dataset(src, dest, name, to_store)
+    return
+
+
+message(' ')
+message('convert_grids.py started at %s' % datetime.datetime.now().isoformat())
+message(' ')
+#
+if len(sys.argv) < 2:
+    message('input error: need grids file or store path')
+    sys.exit(1)
+else:
+    infile = sys.argv[1].rstrip('/')
+#
+if is_store(infile):
+    outfile = '%s.h5' % infile.rsplit('.zarr', 1)[0]
+    h5infile = open_store(infile, 'r')
+    h5outfile = hdf.File(outfile, 'w')
+    to_store = False
+else:
+    outfile = '%s.zarr' % infile.rsplit('.h5', 1)[0]
+    h5infile = hdf.File(infile, 'r')
+    h5outfile = open_store(outfile, 'w')
+    to_store = True
+message('converting %s to %s' % (infile, outfile))
+copy_group(h5infile, h5outfile, to_store)
+del h5outfile['meta/filename']
+h5outfile.create_dataset('meta/filename', data=outfile)
+del h5outfile['meta/last_updated']
+h5outfile.create_dataset('meta/last_updated',
+                         data=datetime.datetime.now().isoformat())
+h5infile.close()
+h5outfile.close()
+message('wrote %s' % outfile)
+message(' ')
+#
+message('convert_grids.py completed at %s' %
+        datetime.datetime.now().isoformat())
+message(' ')
+sys.exit(0)
+
+# end convert_grids.py
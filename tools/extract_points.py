@@ -0,0 +1,200 @@
+"""
+Python script "extract_points.py"
+by Matthew Garcia, PhD student
+Dept. of Forest and Wildlife Ecology
+University of Wisconsin - Madison
+matt.e.garcia@gmail.com
+
+Copyright (C) 2014-2016 by Matthew Garcia
+Licensed Gnu GPL v3; see 'LICENSE_GnuGPLv3.txt' for complete terms
+Send questions, bug reports, any related requests to matt.e.garcia@gmail.com
+See also 'README.md', 'DISCLAIMER.txt', 'ACKNOWLEDGEMENTS.txt'
+Treat others as you would be treated. Pay it forward. Valar dohaeris.
+
+PURPOSE: VI values and clear-sky mask flags at field plot locations from
+         every scene of a footprint, as one long-format table
+
+DEPENDENCIES: h5py, numpy, pandas
+              UTM_Geo_Convert depends on osgeo.osr (uses gdal)
+
+USAGE: '$ python extract_points.py ./P26R27 ./plots.csv NDVI,NDII'
+       with options
+       '--years 1990-1999' to use only the scenes from those years
+       '--clear-only' to keep only clear-sky (scswmask) values
+       '--output ./plots_P26R27.csv' to name the output file
+
+NOTE: All of the plot coordinates are converted to UTM (in the zone of the
+      footprint) with a single coordinate transform, then mapped to rows
+      and columns of the clipped grids with 'meta/clip_bounds'. Plots are
+      then grouped by the h5 chunk they fall in, and each scene file is
+      opened once and read one touched chunk at a time (for each VI and
+      mask), so the time taken grows with the number of chunks that hold
+      plots rather than with the size of the grids. Plots outside the clip
+      boundaries are listed and skipped.
+
+INPUT: *_clipped.h5 files from process_L57_06.py and process_L57_07.py;
+       a CSV file of plots with 'plot', 'lon' and 'lat' columns (decimal
+       degrees, WGS84)
+
+OUTPUT: A CSV file (default <plots file>_values.csv) with one row per plot,
+        scene and VI: 'plot', 'date' (YYYY_DOY), 'vi', 'value', and the
+        'scswmask' (clear sky) and 'scswumask' (clear sky, forest union)
+        flags of the plot's pixel in that scene
+"""
+
+
+import sys
+import datetime
+import argparse
+import glob
+import h5py as hdf
+import numpy as np
+import pandas as pd
+from UTM_Geo_Convert import geographic_to_utm_points
+
+
+def message(char_string):
+    """
+    prints a string to the terminal and flushes the buffer
+    """
+    print(char_string)
+    sys.stdout.flush()
+    return
+
+
+def chunk_groups(rows, cols, chunks, shape):
+    """
+    (r0, r1, c0, c1) bounds of each chunk of a grid that holds any of the
+    points at rows, cols, with the indices of those points, in chunk order;
+    a contiguous grid (chunks None) is read by rows
+    """
+    if chunks is None:
+        chunks = (1, shape[1])
+    nchunk_cols = -(-shape[1] // chunks[1])
+    keys = (rows // chunks[0]) * nchunk_cols + cols // chunks[1]
+    order = np.argsort(keys, kind='mergesort')
+    chunk_keys, starts = np.unique(keys[order], return_index=True)
+    groups = []
+    for key, members in zip(chunk_keys, np.split(order, starts[1:])):
+        r0 = (key // nchunk_cols) * chunks[0]
+        c0 = (key % nchunk_cols) * chunks[1]
+        groups.append((r0, min(r0 + chunks[0], shape[0]),
+                       c0, min(c0 + chunks[1], shape[1]), members))
+    return groups
+
+
+def read_points(dataset, rows, cols, groups):
+    """ grid values at rows, cols, reading each touched chunk once """
+    vals = np.zeros(len(rows), dtype=dataset.dtype)
+    for r0, r1, c0, c1, members in groups:
+        block = dataset[r0:r1, c0:c1]
+        vals[members] = block[rows[members] - r0, cols[members] - c0]
+    return vals
+
+
+message(' ')
+message('extract_points.py started at %s' %
+        datetime.datetime.now().isoformat())
+message(' ')
+#
+if len(sys.argv) < 4:
+    message('input error: need directory path, plots file and VI names')
+    sys.exit(1)
+else:
+    path = sys.argv[1]
+    plots_file = sys.argv[2]
+    vi_names = [vi_name.strip().lower() for vi_name in sys.argv[3].split(',')]
+#
+parser = argparse.ArgumentParser(
+    prog='extract_points.py path plots_file vi_names')
+parser.add_argument('--years', default=None,
+                    help='range of scene years, e.g. 1990-1999')
+parser.add_argument('--clear-only', action='store_true',
+                    help='keep only clear-sky values')
+parser.add_argument('--output', default=None,
+                    help='output CSV file')
+options = parser.parse_args(sys.argv[4:])
+if options.output is None:
+    outfile = '%s_values.csv' % plots_file.rsplit('.', 1)[0]
+else:
+    outfile = options.output
+#
+message('working in directory %s' % path)
+flist = sorted(glob.glob('%s/*_clipped.h5' % path))
+if options.years is not None:
+    year_begin, year_end = [int(year) for year in options.years.split('-')]
+    flist = [file_path for file_path in flist
+             if year_begin <= int(file_path.split('/')[-1][:4]) <= year_end]
+message('found %d Landsat files' % len(flist))
+if len(flist) == 0:
+    message('input error: no scenes to read')
+    sys.exit(1)
+with hdf.File(flist[0], 'r') as h5infile:
+    projection = [str(item.decode('ascii')) if isinstance(item, bytes)
+                  else str(item) for item in h5infile['meta/projection']]
+    # [W, N, E, S, Wcol, Nrow, Ecol, Srow, ncols_clip, nrows_clip]
+    clipbounds = np.copy(h5infile['meta/clip_bounds'])
+UTM_zone = int(projection[1])
+northern = int(projection[2] == 'North')
+W, N, E, S = clipbounds[0:4]
+ncols = int(clipbounds[8])
+nrows = int(clipbounds[9])
+pixelsize = (E - W) / float(ncols)
+#
+plots = pd.read_csv(plots_file)
+message('converting %d plot locations to UTM zone %d' %
+        (len(plots), UTM_zone))
+eastings, northings = \
+    geographic_to_utm_points(plots['lon'], plots['lat'], UTM_zone, northern)
+cols = np.floor((np.array(eastings) - W) / pixelsize).astype(np.int64)
+rows = np.floor((N - np.array(northings)) / pixelsize).astype(np.int64)
+inside = (rows >= 0) & (rows < nrows) & (cols >= 0) & (cols < ncols)
+for plot in plots['plot'][~inside]:
+    message('- plot %s is outside the clipped grids, skipped' % str(plot))
+plot_ids = np.array(plots['plot'])[inside]
+rows = rows[inside]
+cols = cols[inside]
+message(' ')
+#
+datapaths = ['level3/%s' % vi_name for vi_name in vi_names] + \
+    ['masks/scswmask', 'masks/scswumask']
+groups = {}
+tables = []
+nchunks = 0
+for scene_path in flist:
+    scene_file = scene_path.split('/')[-1]
+    date = '%s_%s' % (scene_file[:4], scene_file[9:12])
+    values = {}
+    with hdf.File(scene_path, 'r') as h5infile:
+        for datapath in datapaths:
+            dataset = h5infile[datapath]
+            if dataset.chunks not in groups:
+                groups[dataset.chunks] = \
+                    chunk_groups(rows, cols, dataset.chunks, (nrows, ncols))
+            values[datapath] = read_points(dataset, rows, cols,
+                                           groups[dataset.chunks])
+            nchunks += len(groups[dataset.chunks])
+    for vi_name in vi_names:
+        table = pd.DataFrame({'plot': plot_ids, 'date': date, 'vi': vi_name,
+                              'value': values['level3/%s' % vi_name],
+                              'scswmask': values['masks/scswmask'],
+                              'scswumask': values['masks/scswumask']},
+                             columns=['plot', 'date', 'vi', 'value',
+                                      'scswmask', 'scswumask'])
+        if options.clear_only:
+            table = table[table['scswmask'] == 1]
+        tables.append(table)
+message('read %d chunks from %d scenes for %d plots' %
+        (nchunks, len(flist), len(plot_ids)))
+#
+table = pd.concat(tables, ignore_index=True)
+table.to_csv(outfile, index=False)
+message('wrote %d rows to %s' % (len(table), outfile))
+message(' ')
+#
+message('extract_points.py completed at %s' %
+        datetime.datetime.now().isoformat())
+message(' ')
+sys.exit(0)
+
+# end extract_points.py
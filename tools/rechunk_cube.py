@@ -0,0 +1,131 @@
+"""
+Python script "rechunk_cube.py"
+by Matthew Garcia, PhD student
+Dept. of Forest and Wildlife Ecology
+University of Wisconsin - Madison
+matt.e.garcia@gmail.com
+
+Copyright (C) 2014-2016 by Matthew Garcia
+Licensed Gnu GPL v3; see 'LICENSE_GnuGPLv3.txt' for complete terms
+Send questions, bug reports, any related requests to matt.e.garcia@gmail.com
+See also 'README.md', 'DISCLAIMER.txt', 'ACKNOWLEDGEMENTS.txt'
+Treat others as you would be treated. Pay it forward. Valar dohaeris.
+
+PURPOSE: Rewrite the VI datacube(s) in a process_L57_08.py grids file with
+         a different chunk layout: 'time' (all scenes x 64 x 64 pixels, for
+         per-pixel time series access) or 'scene' (one scene by a band of
+         rows, for whole-grid access); sparse (time, union pixel) cubes
+         are rechunked by runs of pixels instead of bands of rows
+
+DEPENDENCIES: h5py, numpy
+              Stack_Stats depends on numpy
+
+USAGE: '$ python rechunk_cube.py ./P26R27/1984-2013_p026r027_ndii_grids.h5 time'
+
+NOTE: The cube is copied one band of rows at a time, so memory use is about
+      one band of the cube (e.g. 202 scenes x 64 rows x all columns) plus
+      the chunk cache for reading it. Everything else in the file is copied
+      as is, and the original file is replaced only when the copy is done.
+
+INPUT: Output of process_L57_08.py
+
+OUTPUT: The same grids file, with rechunked '<vi>_cube' dataset(s)
+"""
+
+
+import os
+import sys
+import datetime
+import h5py as hdf
+import numpy as np
+from Stack_Stats import cube_chunks, cube_cache, cube_tile, \
+    sparse_cube_chunks
+
+
+def message(char_string):
+    """
+    prints a string to the terminal and flushes the buffer
+    """
+    print(char_string)
+    sys.stdout.flush()
+    return
+
+
+message(' ')
+message('rechunk_cube.py started at %s' % datetime.datetime.now().isoformat())
+message(' ')
+#
+if len(sys.argv) < 3:
+    layout = 'time'
+else:
+    layout = sys.argv[2]
+if layout not in ['time', 'scene']:
+    message('input error: cube layout must be \'time\' or \'scene\'')
+    sys.exit(1)
+#
+if len(sys.argv) < 2:
+    message('input error: need grids file path')
+    sys.exit(1)
+else:
+    infile = sys.argv[1]
+#
+with hdf.File(infile, 'r') as h5infile:
+    cube_names = [name for name in h5infile.keys()
+                  if name.endswith('_cube')]
+    cube_shapes = [h5infile[name].shape for name in cube_names]
+    cube_old_chunks = [h5infile[name].chunks for name in cube_names]
+if len(cube_names) == 0:
+    message('no datacube found in %s' % infile)
+    sys.exit(1)
+#
+outfile = '%s.rechunk' % infile
+message('rewriting %s with \'%s\' cube layout' % (infile, layout))
+with hdf.File(outfile, 'w') as h5outfile:
+    for name, shape, old_chunks in zip(cube_names, cube_shapes,
+                                       cube_old_chunks):
+        if len(shape) == 2:
+            nfiles, npix = shape
+            new_chunks = sparse_cube_chunks(layout, nfiles, npix)
+        else:
+            nfiles, nrows, ncols = shape
+            new_chunks = cube_chunks(layout, nfiles, nrows, ncols, cube_tile)
+        message('- %s %s: chunks %s -> %s' %
+                (name, str(shape), str(old_chunks), str(new_chunks)))
+        if old_chunks is None:
+            h5infile = hdf.File(infile, 'r')
+        else:
+            rdcc_nbytes, rdcc_nslots = cube_cache(shape, old_chunks, nbands=2)
+            h5infile = hdf.File(infile, 'r', rdcc_nbytes=rdcc_nbytes,
+                                rdcc_nslots=rdcc_nslots)
+        h5outfile.create_dataset(name, shape,
+                                 maxshape=(None,) + tuple(shape[1:]),
+                                 dtype=np.float32, chunks=new_chunks,
+                                 compression='gzip')
+        band = new_chunks[1]
+        for b0 in range(0, shape[1], band):
+            b1 = min(b0 + band, shape[1])
+            h5outfile[name][:, b0:b1] = h5infile[name][:, b0:b1]
+        if len(shape) == 2:
+            message('-- copied %d runs of %d pixels' %
+                    (-(-shape[1] // band), band))
+        else:
+            message('-- copied %d bands of %d rows' %
+                    (-(-shape[1] // band), band))
+        h5infile.close()
+    with hdf.File(infile, 'r') as h5infile:
+        for name in h5infile.keys():
+            if name not in cube_names:
+                h5infile.copy(name, h5outfile)
+    del h5outfile['meta/last_updated']
+    h5outfile.create_dataset('meta/last_updated',
+                             data=datetime.datetime.now().isoformat())
+os.rename(outfile, infile)
+message('replaced %s' % infile)
+message(' ')
+#
+message('rechunk_cube.py completed at %s' %
+        datetime.datetime.now().isoformat())
+message(' ')
+sys.exit(0)
+
+# end rechunk_cube.py
@@ -0,0 +1,178 @@
+"""
+Python script "year_range_stats.py"
+by Matthew Garcia, PhD student
+Dept. of Forest and Wildlife Ecology
+University of Wisconsin - Madison
+matt.e.garcia@gmail.com
+
+Copyright (C) 2014-2016 by Matthew Garcia
+Licensed Gnu GPL v3; see 'LICENSE_GnuGPLv3.txt' for complete terms
+Send questions, bug reports, any related requests to matt.e.garcia@gmail.com
+See also 'README.md', 'DISCLAIMER.txt', 'ACKNOWLEDGEMENTS.txt'
+Treat others as you would be treated. Pay it forward. Valar dohaeris.
+
+PURPOSE: VI statistics grids for any run of years, from the per-year
+         summaries kept by 'process_L57_08.py ... --year-summaries',
+         without reading any scene files
+
+DEPENDENCIES: h5py, numpy
+              Stack_Stats depends on numpy
+
+USAGE: '$ python year_range_stats.py \
+            ./P26R27/1984-2013_p026r027_ndii_grids.h5 50,90 1990 1999'
+       or, for every 10-year window from 1984-1993 to 2004-2013,
+       '$ python year_range_stats.py \
+            ./P26R27/1984-2013_p026r027_ndii_grids.h5 50,90 1984 2013 10'
+
+NOTE: The count, sum, sumsq, max and histogram layers of the years in each
+      range are added up in runs of union mask pixels, so memory use is
+      about one run of histograms (4096 pixels x bins) per year, whatever
+      the grid size. nvals, mean, std and max are exact; percentiles and
+      median are within one histogram bin width, as in '--quantiles sketch'.
+
+INPUT: Output of process_L57_08.py with '--year-summaries'
+
+OUTPUT: One statistics file per year range, e.g.
+        1990-1999_p026r027_ndii_yrstats.h5 next to the input file, with the
+        same '<vi>_nvals', '<vi>_<N>pctile', '<vi>_median', '<vi>_mean',
+        '<vi>_std' and '<vi>_max' grids as process_L57_08.py (named apart
+        from its _grids.h5 files, so that neither replaces the other)
+"""
+
+
+import sys
+import datetime
+import h5py as hdf
+import numpy as np
+from Stack_Stats import moments_from_sums, eval_stats_sketch, \
+    scatter_pixels, date_strings
+
+
+def message(char_string):
+    """
+    prints a string to the terminal and flushes the buffer
+    """
+    print(char_string)
+    sys.stdout.flush()
+    return
+
+
+# number of union mask pixels summed and evaluated at a time
+pixel_run = 4096
+
+
+message(' ')
+message('year_range_stats.py started at %s' %
+        datetime.datetime.now().isoformat())
+message(' ')
+#
+if len(sys.argv) < 5:
+    message('input error: need grids file, percentiles and year range')
+    sys.exit(1)
+else:
+    infile = sys.argv[1]
+    pctiles = [int(pctile) for pctile in sys.argv[2].split(',')]
+    query_begin = int(sys.argv[3])
+    query_end = int(sys.argv[4])
+if len(sys.argv) < 6:
+    window = query_end - query_begin + 1
+else:
+    window = int(sys.argv[5])
+if window < 1 or query_end - query_begin + 1 < window:
+    message('input error: year window does not fit in %d-%d' %
+            (query_begin, query_end))
+    sys.exit(1)
+#
+path_parts = infile.split('/')
+source_name = path_parts[-1]
+vi_name = source_name.split('_')[2]
+with hdf.File(infile, 'r') as h5infile:
+    if '%s_years' % vi_name not in h5infile:
+        message('input error: %s has no per-year summaries' % infile)
+        sys.exit(1)
+    group = h5infile['%s_years' % vi_name]
+    year_list = [int(year) for year in group['years']]
+    vmin, vmax = np.copy(group['hist_range'])
+    nbins = group['hist'].shape[2]
+    union_mask = np.array(h5infile['union_mask'], dtype=np.uint8)
+    pixel_index = np.copy(h5infile['pixel_index'])
+    UTM_zone = np.copy(h5infile['meta/UTM_zone'])
+    UTM_bounds = np.copy(h5infile['meta/UTM_bounds'])
+    dates = date_strings(h5infile['dates'])
+nrows, ncols = np.shape(union_mask)
+npix = len(pixel_index)
+stats_names = ['%s_nvals' % vi_name] + \
+    ['%s_%dpctile' % (vi_name, pctile) for pctile in pctiles] + \
+    ['%s_median' % vi_name, '%s_mean' % vi_name, '%s_std' % vi_name,
+     '%s_max' % vi_name]
+message('%s has %s summaries for %d years (%d-%d), %d-bin histograms' %
+        (infile, vi_name.upper(), len(year_list), min(year_list),
+         max(year_list), nbins))
+message(' ')
+#
+for range_begin in range(query_begin, query_end - window + 2):
+    range_end = range_begin + window - 1
+    layers = [year_list.index(year) for year in year_list
+              if range_begin <= year <= range_end]
+    outfile = '/'.join(path_parts[:-1] +
+                       ['%d-%d%s' % (range_begin, range_end,
+                                     source_name[9:].replace('_grids',
+                                                             '_yrstats'))])
+    if outfile == infile:
+        message('input error: %d-%d output would replace %s' %
+                (range_begin, range_end, infile))
+        sys.exit(1)
+    message('summing %d of %d years for %d-%d' %
+            (len(layers), window, range_begin, range_end))
+    flat_grids = [np.zeros(npix, dtype=np.float32) for name in stats_names]
+    with hdf.File(infile, 'r') as h5infile:
+        group = h5infile['%s_years' % vi_name]
+        for p0 in range(0, npix, pixel_run):
+            p1 = min(p0 + pixel_run, npix)
+            counts = np.zeros((p1 - p0, nbins), dtype=np.int64)
+            sums = np.zeros((4, p1 - p0), dtype=np.float64)
+            for y in layers:
+                counts += group['hist'][y, p0:p1, :]
+                sums[0] += group['count'][y, p0:p1]
+                sums[1] += group['sum'][y, p0:p1]
+                sums[2] += group['sumsq'][y, p0:p1]
+                sums[3] = np.maximum(sums[3], group['max'][y, p0:p1])
+            returns = eval_stats_sketch(counts, moments_from_sums(sums),
+                                        pctiles, vmin, vmax)
+            for flat_grid, vals in zip(flat_grids, [returns[0]] +
+                                       returns[1] + list(returns[2:])):
+                flat_grid[p0:p1] = vals
+    message('writing %s' % outfile)
+    with hdf.File(outfile, 'w') as h5outfile:
+        h5outfile.create_dataset('meta/filename', data=outfile)
+        h5outfile.create_dataset('meta/created',
+                                 data=datetime.datetime.now().isoformat())
+        h5outfile.create_dataset('meta/by', data='M. Garcia, UW-Madison')
+        h5outfile.create_dataset('meta/last_updated',
+                                 data=datetime.datetime.now().isoformat())
+        h5outfile.create_dataset('meta/at',
+                                 data='year_range_stats (vi stats)')
+        h5outfile.create_dataset('meta/UTM_zone', data=UTM_zone)
+        h5outfile.create_dataset('meta/UTM_bounds', data=UTM_bounds)
+        h5outfile.create_dataset('meta/source', data=infile)
+        h5outfile.create_dataset('meta/quantiles', data='sketch')
+        h5outfile.create_dataset('meta/sketch_bins', data=nbins)
+        h5outfile.create_dataset('meta/sketch_range', data=[vmin, vmax])
+        h5outfile.create_dataset('union_mask', data=union_mask,
+                                 dtype=np.int8, compression='gzip')
+        h5outfile.create_dataset('dates', data=[date for date in dates
+                                                if range_begin <=
+                                                int(date[:4]) <= range_end],
+                                 compression='gzip')
+        for name, flat_grid in zip(stats_names, flat_grids):
+            h5outfile.create_dataset(name, data=scatter_pixels(
+                flat_grid, pixel_index, (nrows, ncols)), dtype=np.float32,
+                compression='gzip')
+message(' ')
+#
+message('year_range_stats.py completed at %s' %
+        datetime.datetime.now().isoformat())
+message(' ')
+sys.exit(0)
+
+# end year_range_stats.py